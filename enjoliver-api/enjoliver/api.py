@@ -1,29 +1,80 @@
+import atexit
 import logging
 import os
+import threading
+import time
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from werkzeug.contrib.cache import FileSystemCache
 
 from enjoliver.app import create_app
+from enjoliver.cache import create_cache
+from enjoliver.events import EventLog
 from enjoliver.routes import register_routes
 from enjoliver.configs import EnjoliverConfig
 from enjoliver.repositories.registry import RepositoryRegistry
+from enjoliver.schedulerv2 import get_placement_policy
 
 logger = logging.getLogger(__name__)
 
 
+def start_periodic(name: str, interval: float, job):
+    """
+    Run a background job in a daemon thread of the worker
+    :param name: name of the thread
+    :param interval: seconds between two runs
+    :param job: callable without argument
+    :return: the daemon thread
+    """
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                job()
+            except Exception as e:
+                logger.error("fail to run %s: %s" % (name, e))
+
+    thread = threading.Thread(target=loop, name=name, daemon=True)
+    thread.start()
+    return thread
+
+
 def gunicorn():
     ec = EnjoliverConfig(importer=__file__)
     engine = create_engine(ec.db_uri, echo=bool(os.environ.get('SQLALCHEMY_ECHO', False)))
     sess_maker = sessionmaker(bind=engine)
-    cache = FileSystemCache(ec.werkzeug_fs_cache_dir)
+    cache = create_cache(ec)
     app = create_app(
         name='enjoliver-api',
         ec=ec,
     )
     registry = RepositoryRegistry(sess_maker)
-    register_routes(app=app, ec=ec, cache=cache, sess_maker=sess_maker, registry=registry)
+    registry.lifecycle_ignition.max_delay = ec.lifecycle_ignition_flush_sec
+    registry.machine_state.max_delay = ec.machine_state_flush_ms / 1000.
+    registry.machine_state.max_batch = ec.machine_state_flush_max
+    registry.machine_schedule.placement = get_placement_policy(ec.scheduler_placement)
+    # the renders of a booting fleet must not evict sync-notify
+    render_cache = create_cache(ec, "ignition", ec.ignition_cache_threshold)
+    # an evicted event moves the sequence backward: every consumer would resync
+    events_cache = create_cache(ec, "events", EventLog.cache_threshold)
+    register_routes(app=app, ec=ec, cache=cache, sess_maker=sess_maker, registry=registry, render_cache=render_cache,
+                    events_cache=events_cache)
+
+    def backfill_fqdn():
+        # the interfaces still resolving after the /discovery deadline
+        if registry.discovery.backfill_fqdn():
+            cache.delete("/discovery")
+
+    if ec.discovery_fqdn_verify:
+        start_periodic("fqdn-backfill", float(ec.discovery_fqdn_backfill_sec), backfill_fqdn)
+    start_periodic("lifecycle-ignition-flush", ec.lifecycle_ignition_flush_sec, registry.lifecycle_ignition.flush)
+    if registry.machine_state.max_delay > 0:
+        start_periodic("machine-state-flush", registry.machine_state.max_delay, registry.machine_state.flush)
+
+    # gunicorn workers exit through sys.exit on graceful shutdown
+    atexit.register(registry.machine_state.flush)
+    atexit.register(registry.lifecycle_ignition.flush)
     return app
 
 
@@ -0,0 +1,332 @@
+"""
+Cache backends of the API routes, selected by EnjoliverConfig.cache_backend
+All of them implement the werkzeug BaseCache API, a timeout of 0 indicates that the key never expires
+"""
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from werkzeug.contrib.cache import BaseCache, FileSystemCache, RedisCache
+
+from enjoliver.monitoring import CacheMonitoring
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache(BaseCache):
+    """
+    In-process cache, the least recently used key is evicted above the threshold
+    Each gunicorn worker has its own copy: only for a single worker
+    """
+
+    def __init__(self, threshold=500, default_timeout=300, backend="lru"):
+        BaseCache.__init__(self, default_timeout)
+        self.backend = backend
+        self._threshold = threshold
+        self._cache = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _normalize_timeout(self, timeout):
+        timeout = BaseCache._normalize_timeout(self, timeout)
+        return time.time() + timeout if timeout != 0 else 0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._cache[key]
+            except KeyError:
+                return None
+            if expires != 0 and expires <= time.time():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        item = (self._normalize_timeout(timeout), pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self._lock:
+            self._cache[key] = item
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._threshold:
+                self._cache.popitem(last=False)
+                CacheMonitoring().eviction_count.labels(self.backend).inc()
+        return True
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if self.has(key):
+                return False
+            return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            return self._cache.pop(key, None) is not None
+
+    def has(self, key):
+        try:
+            expires, _ = self._cache[key]
+        except KeyError:
+            return False
+        return expires == 0 or expires > time.time()
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+        return True
+
+
+class MmapCache(BaseCache):
+    """
+    Cache in a file mapped in memory, shared by the gunicorn workers
+    The file is a hash table of fixed size slots: a key lives in one of the max_probes slots following its hash.
+    When they are all taken, the slot expiring first is evicted.
+    The processes are serialized with flock, the threads with a lock.
+    A value bigger than a slot is stored in the overflow cache and its slot keeps an empty value as marker.
+    Without overflow cache, it's not stored.
+    """
+    header = struct.Struct("<QdII")
+
+    def __init__(self, path: str, slots=500, slot_size=1024 * 1024, max_probes=8, default_timeout=300,
+                 backend="mmap", overflow: BaseCache = None):
+        BaseCache.__init__(self, default_timeout)
+        self.backend = backend
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.max_probes = min(max_probes, slots)
+        self.overflow = overflow
+        self._too_big = set()
+        self._lock = threading.RLock()
+        self._pid = None
+        self._fd = None
+        self._map = None
+
+    def _open(self):
+        """
+        The file is opened again after a fork: the flock of an inherited file descriptor is shared with the parent
+        """
+        if self._pid == os.getpid():
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = self.slots * self.slot_size
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self._fd, self._map, self._pid = fd, mmap.mmap(fd, size), os.getpid()
+
+    @contextmanager
+    def _locked(self, operation: int):
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _hash(key: bytes):
+        return struct.unpack("<Q", hashlib.blake2b(key, digest_size=8).digest())[0]
+
+    def _normalize_timeout(self, timeout):
+        timeout = BaseCache._normalize_timeout(self, timeout)
+        return time.time() + timeout if timeout != 0 else 0
+
+    def _probes(self, key_hash: int):
+        for i in range(self.max_probes):
+            yield (key_hash + i) % self.slots * self.slot_size
+
+    def _read_header(self, offset: int):
+        return self.header.unpack_from(self._map, offset)
+
+    def _find(self, key: bytes, key_hash: int):
+        """
+        :return: offset of the slot of the key, None if missing
+        """
+        for offset in self._probes(key_hash):
+            h, _, key_len, _ = self._read_header(offset)
+            if h != key_hash or key_len != len(key):
+                continue
+            start = offset + self.header.size
+            if self._map[start:start + key_len] == key:
+                return offset
+        return None
+
+    @staticmethod
+    def _alive(expires: float, now: float):
+        return expires == 0 or expires > now
+
+    def _get(self, key: bytes):
+        offset = self._find(key, self._hash(key))
+        if offset is None:
+            return None
+        _, expires, key_len, value_len = self._read_header(offset)
+        if not self._alive(expires, time.time()):
+            return None
+        start = offset + self.header.size + key_len
+        return self._map[start:start + value_len]
+
+    def get(self, key):
+        with self._locked(fcntl.LOCK_SH):
+            value = self._get(key.encode())
+        if value == b"":
+            return self.overflow.get(key)
+        return None if value is None else pickle.loads(value)
+
+    def _set(self, key: bytes, value, timeout):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if self.header.size + len(key) + len(data) > self.slot_size:
+            if self.overflow is None:
+                if key not in self._too_big:
+                    self._too_big.add(key)
+                    logger.warning("not caching %s: %d bytes is bigger than a slot of %d bytes" % (
+                        key, len(data), self.slot_size))
+                self._delete(key)
+                return False
+            if not self.overflow.set(key.decode(), value, timeout):
+                self._delete(key)
+                return False
+            data = b""
+
+        key_hash, now = self._hash(key), time.time()
+        offset = self._find(key, key_hash)
+        if offset is None:
+            candidates = []
+            for probe in self._probes(key_hash):
+                _, expires, key_len, _ = self._read_header(probe)
+                if key_len == 0 or not self._alive(expires, now):
+                    offset = probe
+                    break
+                candidates.append((expires, probe))
+            else:
+                _, offset = min(candidates, key=lambda k: float("inf") if k[0] == 0 else k[0])
+                CacheMonitoring().eviction_count.labels(self.backend).inc()
+
+        start = offset + self.header.size
+        self._map[start:start + len(key) + len(data)] = key + data
+        self.header.pack_into(self._map, offset, key_hash, self._normalize_timeout(timeout), len(key), len(data))
+        return True
+
+    def set(self, key, value, timeout=None):
+        with self._locked(fcntl.LOCK_EX):
+            return self._set(key.encode(), value, timeout)
+
+    def add(self, key, value, timeout=None):
+        key = key.encode()
+        with self._locked(fcntl.LOCK_EX):
+            if self._get(key) is not None:
+                return False
+            return self._set(key, value, timeout)
+
+    def _delete(self, key: bytes):
+        offset = self._find(key, self._hash(key))
+        if offset is None:
+            return False
+        self.header.pack_into(self._map, offset, 0, 0, 0, 0)
+        return True
+
+    def delete(self, key):
+        with self._locked(fcntl.LOCK_EX):
+            overflowed = self._get(key.encode()) == b""
+            deleted = self._delete(key.encode())
+        if overflowed:
+            self.overflow.delete(key)
+        return deleted
+
+    def has(self, key):
+        with self._locked(fcntl.LOCK_SH):
+            value = self._get(key.encode())
+        if value == b"":
+            return self.overflow.has(key)
+        return value is not None
+
+    def clear(self):
+        with self._locked(fcntl.LOCK_EX):
+            for i in range(self.slots):
+                self.header.pack_into(self._map, i * self.slot_size, 0, 0, 0, 0)
+        if self.overflow is not None:
+            self.overflow.clear()
+        return True
+
+
+class MonitoredCache(BaseCache):
+    """
+    Count the hits and the misses of a cache backend
+    """
+
+    def __init__(self, cache: BaseCache, backend: str):
+        BaseCache.__init__(self, cache.default_timeout)
+        self.cache = cache
+        self.backend = backend
+
+    def get(self, key):
+        value = self.cache.get(key)
+        CacheMonitoring().request_count.labels(self.backend, "miss" if value is None else "hit").inc()
+        return value
+
+    def set(self, key, value, timeout=None):
+        return self.cache.set(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        return self.cache.add(key, value, timeout)
+
+    def delete(self, key):
+        return self.cache.delete(key)
+
+    def has(self, key):
+        return self.cache.has(key)
+
+    def clear(self):
+        return self.cache.clear()
+
+    def inc(self, key, delta=1):
+        return self.cache.inc(key, delta)
+
+    def dec(self, key, delta=1):
+        return self.cache.dec(key, delta)
+
+
+def create_cache(ec, namespace: str = None, threshold: int = None):
+    """
+    :param ec: EnjoliverConfig
+    :param namespace: a cache of its own: another directory, file or key prefix, its keys don't evict the ones of the
+        API cache
+    :param threshold: the number of keys, cache_threshold if None
+    :return: the cache backend set in cache_backend: filesystem, lru, mmap or redis
+    """
+    backend = ec.cache_backend
+    threshold = ec.cache_threshold if threshold is None else threshold
+    fs_cache_dir = ec.werkzeug_fs_cache_dir if namespace is None else "%s-%s" % (ec.werkzeug_fs_cache_dir, namespace)
+    if backend == "filesystem":
+        cache = FileSystemCache(fs_cache_dir, threshold=threshold)
+    elif backend == "lru":
+        if int(ec.gunicorn_workers) != 1:
+            logger.warning("the lru cache is not shared by the %s gunicorn workers" % ec.gunicorn_workers)
+        cache = LRUCache(threshold=threshold)
+    elif backend == "mmap":
+        root, ext = os.path.splitext(ec.cache_mmap_path)
+        # the values bigger than a slot, like a large /discovery, are shared through the filesystem
+        overflow = FileSystemCache(os.path.join(fs_cache_dir, "mmap-overflow"), threshold=threshold)
+        cache = MmapCache(ec.cache_mmap_path if namespace is None else "%s-%s%s" % (root, namespace, ext),
+                          slots=threshold, slot_size=ec.cache_mmap_slot_kb * 1024, overflow=overflow)
+    elif backend == "redis":
+        # any server speaking the Redis protocol, needs the redis module
+        cache = RedisCache(host=ec.cache_redis_host, port=ec.cache_redis_port, db=ec.cache_redis_db,
+                           key_prefix="enjoliver:" if namespace is None else "enjoliver-%s:" % namespace)
+    else:
+        raise ValueError("unknown cache_backend: %s" % backend)
+    name = backend if namespace is None else "%s-%s" % (backend, namespace)
+    logger.info("using the %s cache" % name)
+    return MonitoredCache(cache, name)
@@ -62,6 +62,21 @@ class EnjoliverConfig:
         # self.matchbox_path = self.config_override("matchbox_path", "%s/matchbox" % PROJECT_PATH)
         self.matchbox_path = self.config_override("matchbox_path", "%s/matchbox" % '/usr/local/')
         self.matchbox_assets = self.config_override("matchbox_assets", "%s/assets" % self.matchbox_path)
+        # HTTP client of matchbox: timeouts in seconds, retries of the idempotent requests
+        self.matchbox_connect_timeout = float(self.config_override("matchbox_connect_timeout", 2))
+        self.matchbox_read_timeout = float(self.config_override("matchbox_read_timeout", 10))
+        self.matchbox_retries = int(self.config_override("matchbox_retries", 2))
+        self.matchbox_backoff_factor = float(self.config_override("matchbox_backoff_factor", 0.1))
+        self.matchbox_pool_size = int(self.config_override("matchbox_pool_size", 10))
+        # /assets: served from matchbox_assets when it's on the local disk, by nginx if the X-Accel-Redirect location
+        # is set, else proxied to matchbox by chunks
+        self.assets_serve_local = self.config_override("assets_serve_local", True)
+        self.assets_x_accel_redirect = self.config_override("assets_x_accel_redirect", None)
+        self.assets_chunk_kb = int(self.config_override("assets_chunk_kb", 256))
+        # Seconds to keep the ignition rendered by matchbox, 0 to disable the cache
+        self.ignition_cache_ttl = int(self.config_override("ignition_cache_ttl", 3600))
+        # Renders kept, two by machine: in a cache of their own, they don't evict sync-notify
+        self.ignition_cache_threshold = int(self.config_override("ignition_cache_threshold", 2000))
         # For Health check
         self.matchbox_urls = self.config_override("matchbox_urls", [
             "/",
@@ -81,6 +96,17 @@ class EnjoliverConfig:
             "werkzeug_fs_cache_dir",
             '%s/werkzeug_cache' % os.path.dirname(os.path.abspath(__file__))
         )
+        # Cache of the API: filesystem, lru, mmap or redis
+        self.cache_backend = self.config_override("cache_backend", "filesystem")
+        self.cache_threshold = int(self.config_override("cache_threshold", 500))
+        self.cache_mmap_path = self.config_override(
+            "cache_mmap_path",
+            os.path.join(self.werkzeug_fs_cache_dir, "cache.mmap")
+        )
+        self.cache_mmap_slot_kb = int(self.config_override("cache_mmap_slot_kb", 1024))
+        self.cache_redis_host = self.config_override("cache_redis_host", "localhost")
+        self.cache_redis_port = int(self.config_override("cache_redis_port", 6379))
+        self.cache_redis_db = int(self.config_override("cache_redis_db", 0))
         self.prometheus_multiproc_dir = self.config_override(
             "prometheus_multiproc_dir",
             '%s/prometheus_multiproc_dir' % os.path.dirname(os.path.abspath(__file__))
@@ -108,6 +134,10 @@ class EnjoliverConfig:
         # Scheduler
         self.apply_deps_tries = int(self.config_override("apply_deps_tries", 15))
         self.apply_deps_delay = int(self.config_override("apply_deps_delay", 60))
+        # http: through the api_uri, repository: direct to the db_uri when the plan runs next to the API
+        self.scheduler_backend = self.config_override("scheduler_backend", "http")
+        # the machines allocated to a role: mac, spread-chassis, spread-rack or largest-disk
+        self.scheduler_placement = self.config_override("scheduler_placement", "mac")
 
         self.etcd_member_kubernetes_control_plane_expected_nb = int(self.config_override(
             "etcd_member_kubernetes_control_plane_expected_nb", 3)
@@ -127,6 +157,18 @@ class EnjoliverConfig:
         # Notify in Sync
         self.sync_notify_ttl = int(self.config_override("sync_notify_ttl", 60))
 
+        # Event driven sync: max wait of GET /events, ignored by sync workers, and full sync interval as a safety net
+        self.events_long_poll_sec = float(self.config_override("events_long_poll_sec", 20))
+        self.events_poll_sec = float(self.config_override("events_poll_sec", 2))
+        self.sync_interval_sec = float(self.config_override("sync_interval_sec", 300))
+        # Min gap between the starts of two syncs while the events keep coming
+        self.sync_min_interval_sec = float(self.config_override("sync_min_interval_sec", 5))
+        # Parallel sync: processes computing the metadata, 0 or 1 for a sequential sync, and threads writing the groups
+        self.sync_workers = int(self.config_override("sync_workers", 0))
+        self.sync_write_threads = int(self.config_override("sync_write_threads", 8))
+        # Sync the groups and profiles to the disk before and after their batch rename into matchbox
+        self.sync_fsync = self.config_override("sync_fsync", True)
+
         # Application config
         self.kubernetes_apiserver_insecure_port = int(self.config_override(
             "kubernetes_apiserver_insecure_port", 8080)
@@ -208,12 +250,23 @@ class EnjoliverConfig:
 
         self.vault_polling_sec = self.config_override("vault_polling_sec", 30)
         self.lifecycle_update_polling_sec = self.config_override("lifecycle_update_polling_sec", 30)
+        # max delay of the batched writes of the up-to-date /lifecycle/ignition
+        self.lifecycle_ignition_flush_sec = float(self.config_override("lifecycle_ignition_flush_sec", 5))
+        # Write-behind buffer of the machine states, 0 writes each state in its request
+        self.machine_state_flush_ms = int(self.config_override("machine_state_flush_ms", 200))
+        self.machine_state_flush_max = int(self.config_override("machine_state_flush_max", 500))
 
         self.disks_ladder_gb = self.config_override("disks_ladder_gb", {"S": 10, "M": 20, "L": 30})
 
         logger.debug('configs file: %s for %s', yaml_full_path, importer)
 
         self.discovery_fqdn_verify = self.config_override("discovery_fqdn_verify", True)
+        self.discovery_fqdn_workers = self.config_override("discovery_fqdn_workers", 8)
+        self.discovery_fqdn_deadline_sec = self.config_override("discovery_fqdn_deadline_sec", 2)
+        self.discovery_fqdn_cache_ttl = self.config_override("discovery_fqdn_cache_ttl", 300)
+        self.discovery_fqdn_negative_ttl = self.config_override("discovery_fqdn_negative_ttl", 30)
+        self.discovery_fqdn_cache_size = self.config_override("discovery_fqdn_cache_size", 4096)
+        self.discovery_fqdn_backfill_sec = self.config_override("discovery_fqdn_backfill_sec", 60)
         self.sync_replace_ip_by_fqdn = self.config_override("sync_replace_ip_by_fqdn", False)
 
     def items(self):
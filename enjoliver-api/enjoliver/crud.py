@@ -5,7 +5,10 @@ Over the application Model, queries to the database
 import datetime
 import logging
 
+from sqlalchemy import case, exists, insert, literal, select
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import sessionmaker, Session, joinedload
+from sqlalchemy.sql import ClauseElement
 
 from enjoliver.db import session_commit
 from enjoliver import tools
@@ -18,6 +21,9 @@ logger = logging.getLogger(__name__)
 class InjectLifecycle:
     """
     Store the data from the Lifecycle machine state
+    Each report is a single upsert of the lifecycle row of the machine, unique by machine_id
+    The machine_id is read in the same transaction, by the unique index of MachineInterface.mac: a machine deleted or
+    discovered again is never written with a stale id
     """
 
     def __init__(self, session, request_raw_query):
@@ -27,63 +33,79 @@ class InjectLifecycle:
 
         self.mac = tools.get_mac_from_raw_query(request_raw_query)
 
-        self.machine = self.session.query(Machine).join(MachineInterface).filter(
-            MachineInterface.mac == self.mac).first()
-        if not self.machine:
+        self.machine_id = self.session.query(MachineInterface.machine_id).filter(
+            MachineInterface.mac == self.mac).scalar()
+        if self.machine_id is None:
             m = "InjectLifecycle mac: '%s' unknown in db" % self.mac
             logger.error(m)
             raise AttributeError(m)
         logger.debug("InjectLifecycle mac: %s" % self.mac)
 
-    def refresh_lifecycle_ignition(self, up_to_date: bool):
-        lifecycle = self.session.query(LifecycleIgnition).filter(
-            LifecycleIgnition.machine_id == self.machine.id).first()
-        if not lifecycle:
-            lifecycle = LifecycleIgnition(
-                machine_id=self.machine.id,
-                up_to_date=up_to_date
-            )
-            self.session.add(lifecycle)
-        else:
-            now = datetime.datetime.utcnow()
-            if lifecycle.up_to_date != up_to_date:
-                lifecycle.last_change_date = now
-            lifecycle.up_to_date = up_to_date
-            lifecycle.updated_date = now
+    def _upsert(self, model, values: dict, updates: dict):
+        """
+        Insert the lifecycle row of the machine or update it, in one statement
+        :param model: a Lifecycle model with a unique machine_id
+        :param values: all the columns of the inserted row
+        :param updates: the columns to update, the values can be SQL expressions over the current row
+        :return:
+        """
+        if self.session.bind.dialect.name in ("postgresql", "cockroachdb"):
+            stmt = postgresql.insert(model).values(machine_id=self.machine_id, **values)
+            self.session.execute(stmt.on_conflict_do_update(index_elements=[model.machine_id], set_=updates))
+            return
+
+        # INSERT OR REPLACE deletes the current row: the kept and updated columns are read from it
+        current = model.machine_id == self.machine_id
+        row = {"id": select([model.id]).where(current).as_scalar(), "machine_id": self.machine_id}
+        for name, value in values.items():
+            column = model.__table__.c[name]
+            update = updates.get(name, column)
+            if not isinstance(update, ClauseElement):
+                update = literal(update, column.type)
+            row[name] = case([(exists().where(current), select([update]).where(current).as_scalar())],
+                             else_=literal(value, column.type))
+        self.session.execute(insert(model).prefix_with("OR REPLACE").values(**row))
 
-        self.session.commit()
+    def refresh_lifecycle_ignition(self, up_to_date: bool):
+        now = datetime.datetime.utcnow()
+        self._upsert(LifecycleIgnition, values={
+            "created_date": now,
+            "updated_date": None,
+            "last_change_date": None,
+            "up_to_date": up_to_date,
+        }, updates={
+            "last_change_date": case([(LifecycleIgnition.up_to_date == up_to_date, LifecycleIgnition.last_change_date)],
+                                     else_=now),
+            "up_to_date": up_to_date,
+            "updated_date": now,
+        })
 
     def refresh_lifecycle_coreos_install(self, success: bool):
-        lifecycle = self.session.query(LifecycleCoreosInstall).filter(
-            LifecycleCoreosInstall.machine_id == self.machine.id).first()
-        if not lifecycle:
-            lifecycle = LifecycleCoreosInstall(
-                machine_id=self.machine.id,
-                success=success
-            )
-            self.session.add(lifecycle)
-        else:
-            lifecycle.up_to_date = success
-            lifecycle.updated_date = datetime.datetime.utcnow()
-
-        self.session.commit()
+        now = datetime.datetime.utcnow()
+        self._upsert(LifecycleCoreosInstall, values={
+            "created_date": now,
+            "updated_date": now,
+            "success": success,
+        }, updates={
+            "success": success,
+            "updated_date": now,
+        })
 
     def apply_lifecycle_rolling(self, enable: bool, strategy="kexec"):
-        lifecycle = self.session.query(LifecycleRolling).filter(
-            LifecycleRolling.machine_id == self.machine.id).first()
-        if not lifecycle:
-            lifecycle = LifecycleRolling(
-                machine_id=self.machine.id,
-                enable=enable,
-                strategy=strategy,
-            )
-            self.session.add(lifecycle)
-        else:
-            lifecycle.enable = enable
-            lifecycle.strategy = strategy
-            lifecycle.updated_date = datetime.datetime.utcnow()
-
-        self.session.commit()
+        if strategy not in LifecycleRolling._strategy_choice:
+            raise LookupError("%s not in %s" % (strategy, LifecycleRolling._strategy_choice))
+
+        now = datetime.datetime.utcnow()
+        self._upsert(LifecycleRolling, values={
+            "created_date": now,
+            "updated_date": None,
+            "enable": enable,
+            "strategy": strategy,
+        }, updates={
+            "enable": enable,
+            "strategy": strategy,
+            "updated_date": now,
+        })
 
 
 class FetchLifecycle:
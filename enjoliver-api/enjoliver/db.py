@@ -1,17 +1,22 @@
 from contextlib import contextmanager
 
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.orm import Query, Session, sessionmaker
 
 
 @contextmanager
-def session_commit(sess_maker: sessionmaker) -> Session:
+def session_commit(sess_maker: sessionmaker, session: Session = None) -> Session:
     """
     Yield a session created with the given sessionmaker. The yeld session is set with autocommit=False, no matter what
     is the sessiomaker's setting.
     When exiting from the cm, try to commit the transaction. If it fails, rollback the transaction.
     Finally, the session is closed.
+    A given session is yielded as is: its own session_commit commits it, several repositories share its transaction
     """
+    if session is not None:
+        yield session
+        return
+
     session = sess_maker(autocommit=False)
     assert not session.autocommit
     try:
@@ -22,3 +27,33 @@ def session_commit(sess_maker: sessionmaker) -> Session:
         raise
     finally:
         session.close()
+
+
+def iter_by_keyset(query: Query, column, after=None, limit=None, batch_size=500):
+    """
+    Yield the rows of the query by batches, ordered by the given unique column, starting after the given key.
+    Each batch is a new 'WHERE column > last_key ORDER BY column LIMIT batch_size' query, so the memory stays bounded
+    by the batch size and it works with joined eager loading, unlike Query.yield_per.
+    :param query: the query to page through
+    :param column: a unique and sortable column, like Machine.id
+    :param after: start strictly after this key, None to start from the beginning
+    :param limit: max number of rows to yield over all the batches, None for no limit
+    :param batch_size: number of rows fetched per query
+    :return: generator of list of rows
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        page = query
+        if after is not None:
+            page = page.filter(column > after)
+        batch = page.order_by(column).limit(size).all()
+        if not batch:
+            return
+        yield batch
+
+        if len(batch) < size:
+            return
+        after = getattr(batch[-1], column.key)
+        if remaining is not None:
+            remaining -= len(batch)
@@ -0,0 +1,88 @@
+"""
+Change events published by the API workers in a shared cache of their own and long-polled by the sync process on GET /events
+"""
+import logging
+import threading
+import time
+
+from werkzeug.contrib.cache import BaseCache
+
+logger = logging.getLogger(__name__)
+
+
+class EventLog:
+    """
+    Each event takes the next free sequence number with an atomic cache add, so the workers don't need to agree on a
+    counter: the head of the log is found by probing the sequence numbers after the last known one.
+    The events are hints, a consumer resyncs everything when the sequence moves, even backward after an eviction.
+    Publishing an event deletes the one max_events before: the log takes about max_events keys of the cache, kept
+    apart from the other keys so that they can't evict the events.
+    A cache not shared by the workers, like lru, would give a sequence per worker: nothing is published.
+    """
+    head_key = "events-head"
+    event_key = "event:%d"
+    # twice the keys of the default max_events: room for the probes of mmap
+    cache_threshold = 256
+
+    def __init__(self, cache: BaseCache, ttl=600, max_events=100, poll_interval=0.2, shared=True):
+        self.cache = cache
+        self.ttl = ttl
+        self.max_events = max_events
+        self.poll_interval = poll_interval
+        self.shared = shared
+        self._lock = threading.Lock()
+        if not shared:
+            logger.warning("the cache is not shared by the workers: no events, the sync falls back to its interval")
+
+    def seq(self):
+        """
+        :return: the sequence number of the last event, 0 if none
+        """
+        seq = self.cache.get(self.head_key) or 0
+        while self.cache.get(self.event_key % (seq + 1)) is not None:
+            seq += 1
+        return seq
+
+    def publish(self, kind: str, **data):
+        """
+        :param kind: what changed, like discovery or schedule
+        :param data: details of the change
+        :return: the sequence number of the event, 0 if not published
+        """
+        if not self.shared:
+            return 0
+        with self._lock:
+            seq = self.seq() + 1
+            while not self.cache.add(self.event_key % seq, dict(seq=seq, kind=kind, ts=time.time(), **data),
+                                     timeout=self.ttl):
+                seq += 1
+            self.cache.set(self.head_key, seq, timeout=0)
+            if seq > self.max_events:
+                self.cache.delete(self.event_key % (seq - self.max_events))
+        return seq
+
+    def since(self, seq: int, head: int):
+        """
+        :param seq: the last sequence number known by the consumer
+        :param head: the current sequence number
+        :return: the events still in the cache after seq, up to head
+        """
+        first = max(seq + 1, head - self.max_events + 1)
+        if first > head:
+            return []
+        events = self.cache.get_many(*[self.event_key % k for k in range(first, head + 1)])
+        return [k for k in events if k is not None]
+
+    def wait(self, since: int, timeout: float):
+        """
+        Block until the sequence differs from since or until the timeout
+        :param since: the last sequence number known by the consumer
+        :param timeout: seconds
+        :return: the current sequence number
+        """
+        deadline = time.time() + timeout
+        while True:
+            seq = self.seq()
+            if seq != since or time.time() >= deadline:
+                return seq
+            time.sleep(min(self.poll_interval, max(deadline - time.time(), 0)))
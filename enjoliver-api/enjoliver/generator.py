@@ -1,7 +1,11 @@
+import hashlib
 import json
 import logging
 import os
 import re
+import shutil
+import tempfile
+import threading
 
 import deepdiff
 
@@ -55,6 +59,82 @@ class Generator:
         self.group.dump()
 
 
+class BatchWriter:
+    """
+    Stage the renders in a temporary directory of the matchbox filesystem, fsync them in a batch and rename them into
+    place: matchbox never reads a half-written file and each target directory is synced once per batch
+    """
+
+    def __init__(self, matchbox_path: str, fsync=True):
+        """
+        :param matchbox_path: /var/lib/matchbox
+        :param fsync: sync the files and the directories to the disk before and after the renames
+        """
+        self.staging_path = tempfile.mkdtemp(dir=matchbox_path, prefix=".staging-")
+        self.fsync = fsync
+        self._staged = dict()  # target file path -> (staged file path, digest)
+        self._lock = threading.Lock()
+
+    def stage(self, file_path: str, content: str):
+        """
+        :param file_path: the target of the rename
+        :param content: data to write
+        :return: False if the same content is already staged for file_path
+        """
+        digest = hashlib.sha256(content.encode()).digest()
+        with self._lock:
+            staged = self._staged.get(file_path)
+            if staged is not None and staged[1] == digest:
+                return False
+            staged_path = os.path.join(self.staging_path, "%d.json" % len(self._staged))
+            if staged is not None:
+                staged_path = staged[0]
+            self._staged[file_path] = (staged_path, digest)
+        with open(staged_path, "w") as f:
+            f.write(content)
+        os.chmod(staged_path, 0o644)
+        return True
+
+    def commit(self):
+        """
+        Rename the staged files into their target directories
+        :return: the number of files replaced
+        """
+        with self._lock:
+            staged, self._staged = self._staged, dict()
+        if self.fsync:
+            for staged_path, _ in staged.values():
+                self._fsync(staged_path)
+        directories = set()
+        for file_path, (staged_path, _) in staged.items():
+            os.replace(staged_path, file_path)
+            directories.add(os.path.dirname(file_path))
+            logger.info("replaced: %s" % file_path)
+        for directory in directories:
+            if self.fsync:
+                self._fsync(directory)
+            # the ignition render cache of the API reloads the groups and profiles when their directory changes
+            os.utime(directory)
+        return len(staged)
+
+    def close(self):
+        """
+        Drop what is not committed and remove the staging directory
+        :return:
+        """
+        with self._lock:
+            self._staged = dict()
+        shutil.rmtree(self.staging_path, ignore_errors=True)
+
+    @staticmethod
+    def _fsync(path: str):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
 class GenerateCommon:
     """
     Common set of methods used to generate groups and profiles
@@ -74,26 +154,49 @@ class GenerateCommon:
         self.generate()
         return json.dumps(self._target_data, indent=indent, sort_keys=True)
 
-    def dump(self):
+    def dump(self, writer=None):
+        """
+        Write the render if it differs from the file on disk
+        :param writer: BatchWriter staging the file until its commit, None to replace the file now
+        :return: True if changed
+        """
         file_path = "%s/%s.json" % (self.target_path, self.target_data["id"])
+        render = self.render()
+        # the files are only written by render: an unchanged group or profile has the same bytes on disk
         try:
             with open(file_path, 'r') as f:
-                on_disk = json.loads(f.read())
+                on_disk = f.read()
         except Exception as e:
             logger.warning("get data of %s raise: %s" % (file_path, e))
-            on_disk = dict()
+            on_disk = None
 
-        render = self.render()
-        diff = deepdiff.DeepDiff(self._target_data, on_disk, ignore_order=True)
-        if not diff:
+        if on_disk == render:
             logger.debug("no diff: %s" % file_path)
             return False
 
-        if on_disk:
+        if on_disk and logger.isEnabledFor(logging.INFO):
+            try:
+                diff = deepdiff.DeepDiff(self._target_data, json.loads(on_disk))
+            except ValueError as e:
+                diff = e
             logger.info("diff on %s: %s" % (file_path, diff))
 
-        with open(file_path, "w") as fd:
-            fd.write(render)
+        if writer is not None:
+            writer.stage(file_path, render)
+            return True
+
+        # matchbox and the concurrent writers never read a half-written file
+        fd, tmp_path = tempfile.mkstemp(dir=self.target_path, prefix=".%s." % self.target_data["id"], suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(render)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, file_path)
+        except OSError:
+            os.remove(tmp_path)
+            raise
+        # the ignition render cache of the API reloads the groups and profiles when their directory changes
+        os.utime(self.target_path)
         logger.info("replaced: %s" % file_path)
         return True
 
@@ -201,7 +304,7 @@ class GenerateGroup(GenerateCommon):
         if os.path.isdir(self.ssh_authorized_keys_dir) is False:
             return keys
 
-        for k in os.listdir(self.ssh_authorized_keys_dir):
+        for k in sorted(os.listdir(self.ssh_authorized_keys_dir)):
             fp = "%s/%s" % (self.ssh_authorized_keys_dir, k)
             with open(fp, 'r') as key:
                 content = key.read()
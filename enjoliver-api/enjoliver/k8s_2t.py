@@ -1,14 +1,19 @@
 #! /usr/bin/env python3
+import atexit
 import json
 import logging
 
 import requests
 import sys
 import time
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
 
 from enjoliver.configs import EnjoliverConfig
 from enjoliver.generator import Generator
-from enjoliver.schedulerv2 import EtcdMemberKubernetesControlPlane, KubernetesNode
+from enjoliver.repositories.registry import RepositoryRegistry
+from enjoliver.schedulerv2 import EtcdMemberKubernetesControlPlane, KubernetesNode, RepositorySchedulerBackend, \
+    get_placement_policy
 from enjoliver.sync import ConfigSyncSchedules
 
 logger = logging.getLogger(__name__)
@@ -27,17 +32,22 @@ class Kubernetes2Tiers:
                  ignition_dict,
                  matchbox_path="/var/lib/matchbox",
                  api_uri="http://127.0.0.1:5000",
-                 extra_selectors=None):
+                 extra_selectors=None,
+                 scheduler_backend=None):
+        """
+        :param scheduler_backend: the backend of the schedulers, HTTP to the api_uri by default
+        """
         self.api_uri = api_uri
         self.ignition_dict = ignition_dict
         self.matchbox_path = matchbox_path
 
         self._init_discovery()
 
-        self._sch_k8s_control_plane = EtcdMemberKubernetesControlPlane(self.api_uri)
-        self._sch_k8s_node = KubernetesNode(self.api_uri, apply_dep=False)
+        self._sch_k8s_control_plane = EtcdMemberKubernetesControlPlane(self.api_uri, backend=scheduler_backend)
+        self._sch_k8s_node = KubernetesNode(self.api_uri, apply_dep=False, backend=scheduler_backend)
 
         self._sync = ConfigSyncSchedules(self.api_uri, self.matchbox_path, self.ignition_dict, extra_selectors)
+        self._events_seq = None
 
     def _init_discovery(self):
         if EC.extra_selectors:
@@ -74,6 +84,64 @@ class Kubernetes2Tiers:
         self._sch_k8s_node.apply(nb_try=5, seconds_sleep=1)
         return self._sync.apply(nb_try=10, seconds_sleep=2)
 
+    def wait_change(self, timeout: float):
+        """
+        Long poll the events of the API, the API can answer before the timeout without any change
+        :param timeout: max seconds to wait for a change
+        :return: True if something changed since the last call
+        """
+        url = "%s/events" % self.api_uri
+        params = {"timeout": timeout}
+        if self._events_seq is not None:
+            params["since"] = self._events_seq
+        try:
+            req = requests.get(url, params=params, timeout=timeout + self.wait)
+            seq = json.loads(req.content.decode())["seq"]
+            req.close()
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logger.error("fail to wait the events on %s: %s" % (url, e))
+            time.sleep(self.wait)
+            return False
+
+        changed = seq != self._events_seq
+        self._events_seq = seq
+        return changed
+
+    def run(self, interval: float, poll: float, notify_interval: float, min_interval: float = 0):
+        """
+        Sync on each change published by the API, and every interval seconds as a safety net
+        :param interval: seconds between two syncs without any change
+        :param poll: seconds waited for a change by request
+        :param notify_interval: seconds between two notifications of the sync state while idle
+        :param min_interval: min seconds between the starts of two syncs, the changes meanwhile go in the next one
+        :return: never
+        """
+        synced_at, notified_at = 0, 0
+        while True:
+            start = time.time()
+            changed = self.wait_change(poll)
+            if changed or time.time() - synced_at >= interval:
+                # during a burst of changes the long poll answers right away
+                time.sleep(max(min_interval - (time.time() - synced_at), 0))
+                if changed:
+                    self._sync.clear_cache()
+                self.apply()
+                synced_at = notified_at = time.time()
+                continue
+
+            if time.time() - notified_at >= notify_interval:
+                self._sync.notify()
+                notified_at = time.time()
+            # the API answers right away with sync workers
+            time.sleep(max(poll - (time.time() - start), 0))
+
+    def close(self):
+        """
+        Stop the pools of the parallel sync
+        :return:
+        """
+        self._sync.close()
+
     @property
     def etcd_member_ip_list(self):
         return self._sync.etcd_member_ip_list
@@ -124,20 +192,24 @@ if __name__ == '__main__':
                 raise
         time.sleep(5)
 
+    backend = None
+    if EC.scheduler_backend == "repository":
+        registry = RepositoryRegistry(sessionmaker(bind=create_engine(EC.db_uri)))
+        registry.machine_schedule.placement = get_placement_policy(EC.scheduler_placement)
+        backend = RepositorySchedulerBackend(registry)
+    elif EC.scheduler_backend != "http":
+        raise ValueError("scheduler_backend must be http or repository: %s" % EC.scheduler_backend)
+
     k2t = Kubernetes2Tiers(
         ignition_dict=EC.ignition_dict,
         matchbox_path=EC.matchbox_path,
         api_uri=EC.api_uri,
-        extra_selectors=EC.extra_selectors
+        extra_selectors=EC.extra_selectors,
+        scheduler_backend=backend,
     )
+    atexit.register(k2t.close)
 
-    wait = 10
-    if EC.sync_cache_ttl > 0:
-        wait = EC.sync_cache_ttl + (EC.sync_cache_ttl * 0.1)
-        logger.info("cache_ttl is set at %ds, using %ds as sleep interval" % (EC.sync_cache_ttl, wait))
-    else:
-        logger.warning("no cache_ttl is set switching to default sleep %ds" % wait)
-
-    while True:
-        k2t.apply()
-        time.sleep(wait)
+    # a sync worker of the API doesn't wait for the events
+    poll = EC.events_long_poll_sec if EC.gunicorn_worker_type != "sync" else EC.events_poll_sec
+    k2t.run(interval=EC.sync_interval_sec, poll=poll, notify_interval=EC.sync_notify_ttl / 3,
+            min_interval=EC.sync_min_interval_sec)
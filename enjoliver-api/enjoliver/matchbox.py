@@ -0,0 +1,206 @@
+"""
+HTTP client of matchbox used by the proxy routes and the cache of the ignition it renders
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import parse_qsl
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from werkzeug.contrib.cache import BaseCache
+
+from enjoliver.configs import EnjoliverConfig
+from enjoliver.monitoring import MatchboxMonitoring
+
+logger = logging.getLogger(__name__)
+
+
+class MatchboxClient:
+    """
+    A requests.Session per gunicorn worker: the connections to matchbox are kept alive in a pool
+    The idempotent requests are retried with an exponential backoff on connection errors and 502, 503, 504
+    """
+
+    def __init__(self, connect_timeout=2., read_timeout=10., retries=2, backoff_factor=0.1, pool_size=10):
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=backoff_factor,
+                status_forcelist=(502, 503, 504),
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @classmethod
+    def from_config(cls, ec: EnjoliverConfig):
+        return cls(
+            connect_timeout=ec.matchbox_connect_timeout,
+            read_timeout=ec.matchbox_read_timeout,
+            retries=ec.matchbox_retries,
+            backoff_factor=ec.matchbox_backoff_factor,
+            pool_size=ec.matchbox_pool_size,
+        )
+
+    def get(self, url: str, route: str, **kwargs) -> requests.Response:
+        """
+        :param url: full url to matchbox
+        :param route: the API route proxying matchbox, label of the latency histogram
+        :param kwargs: passed to requests.Session.get
+        :return: requests.Response, the body is read unless stream=True is given
+        """
+        start = time.time()
+        try:
+            return self.session.get(url, timeout=self.timeout, **kwargs)
+        finally:
+            MatchboxMonitoring().request_latency.labels(route).observe(time.time() - start)
+
+
+def ignition_digest(ignition):
+    """
+    Digest of the canonical JSON of an ignition, the machines compute the same with:
+    jq -cS . /usr/share/oem/coreos-install.json | sha256sum
+    :param ignition: the loaded ignition
+    :return: sha256 hex digest
+    """
+    canonical = json.dumps(ignition, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(("%s\n" % canonical).encode()).hexdigest()
+
+
+class IgnitionRenderCache:
+    """
+    The ignition rendered by matchbox, kept in a cache of its own to be shared by the workers
+    The key is made of the raw query, the content of the group selected like matchbox does, the content of its profile
+    and the mtime of the ignition file. GenerateCommon.dump bumps the mtime of the groups and profiles directories
+    to reload the index of the groups.
+    """
+
+    # an index younger than this can miss a write in the same timestamp granularity of the filesystem
+    racy_seconds = 2
+
+    def __init__(self, matchbox_path: str, cache: BaseCache, client: MatchboxClient, ttl=3600):
+        self.matchbox_path = matchbox_path
+        self.cache = cache
+        self.client = client
+        self.ttl = ttl
+        self._groups = []
+        self._profiles = dict()
+        self._mtimes = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _load(directory: str):
+        """
+        :return: dict of (json content, sha256 of the file) by id
+        """
+        data = dict()
+        for name in os.listdir(directory):
+            if not name.endswith(".json"):
+                continue
+            with open(os.path.join(directory, name), "rb") as f:
+                content = f.read()
+            try:
+                document = json.loads(content.decode())
+            except ValueError as e:
+                logger.error("fail to load %s/%s: %s" % (directory, name, e))
+                continue
+            data[document["id"]] = (document, hashlib.sha256(content).hexdigest())
+        return data
+
+    def _refresh_index(self):
+        directories = ["%s/groups" % self.matchbox_path, "%s/profiles" % self.matchbox_path]
+        mtimes = [os.stat(k).st_mtime for k in directories]
+        with self._lock:
+            if mtimes == self._mtimes and self._loaded_at - max(mtimes) > self.racy_seconds:
+                return
+            loaded_at = time.time()
+            groups = self._load(directories[0])
+            self._profiles = self._load(directories[1])
+            # like matchbox: the group with the most selectors first, then by id
+            self._groups = sorted(groups.values(), key=lambda k: (len(k[0].get("selector", {})), k[0]["id"]),
+                                  reverse=True)
+            self._mtimes, self._loaded_at = mtimes, loaded_at
+
+    def key(self, raw_query: str):
+        """
+        :param raw_query: the query of /ignition, like uuid=...&mac=...
+        :return: the cache key, None if matchbox would not find an ignition
+        """
+        try:
+            self._refresh_index()
+        except (OSError, KeyError) as e:
+            logger.error("fail to index the matchbox groups and profiles: %s" % e)
+            return None
+
+        labels = dict(parse_qsl(raw_query))
+        if "mac" in labels:
+            labels["mac"] = labels["mac"].replace("-", ":").lower()
+        for group, group_digest in self._groups:
+            if all(labels.get(k) == v for k, v in group.get("selector", {}).items()):
+                break
+        else:
+            return None
+
+        try:
+            profile, profile_digest = self._profiles[group["profile"]]
+            ignition_mtime = os.stat("%s/ignition/%s" % (self.matchbox_path, profile["ignition_id"])).st_mtime_ns
+        except (KeyError, OSError) as e:
+            logger.warning("no ignition for the group %s: %s" % (group["id"], e))
+            return None
+
+        return "ignition-render:%s" % hashlib.sha256(("%s|%s|%s|%s|%d" % (
+            raw_query, group["id"], group_digest, profile_digest, ignition_mtime)).encode()).hexdigest()
+
+    def _get(self, key, matchbox_uri: str, raw_query: str, route: str):
+        if key is not None:
+            content = self.cache.get(key)
+            if content is not None:
+                return 200, content
+
+        matchbox_resp = self.client.get("%s/ignition?%s" % (matchbox_uri, raw_query), route)
+        content = matchbox_resp.content
+        matchbox_resp.close()
+        if key is not None and matchbox_resp.status_code == 200:
+            self.cache.set(key, content, timeout=self.ttl)
+        return matchbox_resp.status_code, content
+
+    def get(self, matchbox_uri: str, raw_query: str, route: str):
+        """
+        :param matchbox_uri:
+        :param raw_query: the query of /ignition, like uuid=...&mac=...
+        :param route: the API route, see MatchboxClient.get
+        :return: tuple(status code, content), only a 200 of matchbox is cached
+        """
+        key = self.key(raw_query) if self.ttl > 0 else None
+        return self._get(key, matchbox_uri, raw_query, route)
+
+    def digest(self, matchbox_uri: str, raw_query: str, route: str):
+        """
+        The expected ignition_digest of a machine, computed once per render
+        :param matchbox_uri:
+        :param raw_query: the query of /ignition, like uuid=...&mac=...
+        :param route: the API route, see MatchboxClient.get
+        :return: sha256 hex digest, raise ValueError if matchbox doesn't render a JSON
+        """
+        key = self.key(raw_query) if self.ttl > 0 else None
+        if key is not None:
+            digest = self.cache.get("%s:digest" % key)
+            if digest is not None:
+                return digest
+
+        status, content = self._get(key, matchbox_uri, raw_query, route)
+        digest = ignition_digest(json.loads(content.decode()))
+        if key is not None and status == 200:
+            self.cache.set("%s:digest" % key, digest, timeout=self.ttl)
+        return digest
@@ -0,0 +1,49 @@
+"""
+Alembic migrations of the database schema, run by manage.py before starting the API
+"""
+import os
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, inspect
+
+from enjoliver.model import Base
+
+# the schema created by Base.metadata.create_all before the migrations
+BASELINE = "0001"
+
+
+def alembic_config(db_uri: str):
+    """
+    :param db_uri: the SQLAlchemy URI of the database to migrate
+    :return: alembic.config.Config without alembic.ini
+    """
+    config = Config()
+    config.set_main_option("script_location", os.path.dirname(os.path.abspath(__file__)))
+    # configparser interpolation
+    config.set_main_option("sqlalchemy.url", db_uri.replace("%", "%%"))
+    return config
+
+
+def upgrade(db_uri: str, revision="head"):
+    """
+    Create an empty database from the model, stamp a database created without the migrations at the baseline,
+    then upgrade it
+    :param db_uri: the SQLAlchemy URI of the database to migrate
+    :param revision: the target revision
+    :return:
+    """
+    config = alembic_config(db_uri)
+    engine = create_engine(db_uri)
+    try:
+        tables = inspect(engine).get_table_names()
+        if not tables:
+            Base.metadata.create_all(bind=engine)
+            command.stamp(config, "head")
+            return
+    finally:
+        engine.dispose()
+
+    if "alembic_version" not in tables:
+        command.stamp(config, BASELINE)
+    command.upgrade(config, revision)
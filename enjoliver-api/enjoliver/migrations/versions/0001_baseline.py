@@ -0,0 +1,20 @@
+"""
+Baseline: the schema created by Base.metadata.create_all before the migrations
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    pass
+
+
+def downgrade():
+    pass
@@ -0,0 +1,22 @@
+"""
+Fingerprint of the last discovery data of a machine
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("machine", sa.Column("fingerprint", sa.String(64), nullable=True))
+
+
+def downgrade():
+    op.drop_column("machine", "fingerprint")
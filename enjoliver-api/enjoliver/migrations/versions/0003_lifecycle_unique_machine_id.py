@@ -0,0 +1,29 @@
+"""
+One lifecycle row per machine, required by the upserts of crud.InjectLifecycle
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+TABLES = ["lifecycle_coreos_install", "lifecycle_ignition", "lifecycle_rolling"]
+
+
+def upgrade():
+    for table in TABLES:
+        # keep the last row of each machine
+        op.execute("DELETE FROM {0} WHERE id NOT IN (SELECT max(id) FROM {0} GROUP BY machine_id)".format(table))
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.create_unique_constraint("%s_machine_id_key" % table, ["machine_id"])
+
+
+def downgrade():
+    for table in TABLES:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_constraint("%s_machine_id_key" % table, type_="unique")
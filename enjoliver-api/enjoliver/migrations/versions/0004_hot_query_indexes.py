@@ -0,0 +1,35 @@
+"""
+Indexes of the hot queries: the machine by uuid, the boot interface of a machine and the machines by role
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the rows of a duplicated machine are referenced by its interfaces, disks and schedules: merged by hand
+    duplicates = [k for k, in op.get_bind().execute(
+        sa.text("SELECT uuid FROM machine GROUP BY uuid HAVING count(*) > 1"))]
+    if duplicates:
+        raise RuntimeError("machine uuids stored more than once, keep one row of each before the upgrade: %s" % (
+            ", ".join(sorted(duplicates))))
+
+    with op.batch_alter_table("machine") as batch_op:
+        batch_op.create_unique_constraint("machine_uuid_key", ["uuid"])
+    op.create_index("idx_machine_interface_machine_id_as_boot", "machine_interface", ["machine_id", "as_boot"])
+    op.create_index("idx_schedule_role_machine_id", "schedule", ["role", "machine_id"])
+
+
+def downgrade():
+    op.drop_index("idx_schedule_role_machine_id", "schedule")
+    op.drop_index("idx_machine_interface_machine_id_as_boot", "machine_interface")
+    with op.batch_alter_table("machine") as batch_op:
+        batch_op.drop_constraint("machine_uuid_key", type_="unique")
@@ -130,7 +130,7 @@ class LifecycleCoreosInstall(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     created_date = Column(DateTime, default=datetime.datetime.utcnow)
 
-    machine_id = Column(Integer, ForeignKey('machine.id'), nullable=False)
+    machine_id = Column(Integer, ForeignKey('machine.id'), nullable=False, unique=True)
 
     updated_date = Column(DateTime, default=datetime.datetime.utcnow)
     success = Column(Boolean)
@@ -146,7 +146,7 @@ class LifecycleIgnition(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     created_date = Column(DateTime, default=datetime.datetime.utcnow)
 
-    machine_id = Column(Integer, ForeignKey('machine.id'), nullable=False)
+    machine_id = Column(Integer, ForeignKey('machine.id'), nullable=False, unique=True)
 
     updated_date = Column(DateTime, default=None)
     last_change_date = Column(DateTime, default=None)
@@ -164,7 +164,7 @@ class LifecycleRolling(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     created_date = Column(DateTime, default=datetime.datetime.utcnow)
 
-    machine_id = Column(Integer, ForeignKey('machine.id'), nullable=False)
+    machine_id = Column(Integer, ForeignKey('machine.id'), nullable=False, unique=True)
     updated_date = Column(DateTime, default=None)
     enable = Column(Boolean, default=False)
     strategy = Column(String, default="kexec")
@@ -183,9 +183,11 @@ class Machine(Base):
     __tablename__ = 'machine'
     id = Column(Integer, primary_key=True, autoincrement=True)
 
-    uuid = Column(String(36), nullable=False)
+    uuid = Column(String(36), nullable=False, unique=True)
     created_date = Column(DateTime, default=datetime.datetime.utcnow)
     updated_date = Column(DateTime, default=None)
+    # sha256 of the last discovery data, see MachineDiscoveryRepository.fingerprint
+    fingerprint = Column(String(64), nullable=True)
 
     interfaces = relationship('MachineInterface')
     boot_interface = relationship('MachineInterface', primaryjoin="and_(Machine.id==MachineInterface.machine_id, MachineInterface.as_boot==True)", uselist=False)
@@ -275,6 +277,9 @@ class MachineInterface(Base):
     machine_id = Column(Integer, ForeignKey('machine.id'))
     chassis_port = relationship('ChassisPort')
 
+    # the boot interface of a machine
+    Index('idx_machine_interface_machine_id_as_boot', machine_id, as_boot)
+
     @validates('mac')
     def validate_mac(self, key, mac):
         """
@@ -312,6 +317,9 @@ class Schedule(Base):
 
     role = Column(String(len(max(ScheduleRoles.roles, key=len))), nullable=False)
 
+    # the machines by role
+    Index('idx_schedule_role_machine_id', role, machine_id)
+
     @validates('role')
     def validate_role(self, key, role_name):
         if role_name not in ScheduleRoles.roles:
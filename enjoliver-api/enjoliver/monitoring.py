@@ -4,7 +4,7 @@ from contextlib import contextmanager
 import sys
 import time
 from flask import request, Flask, Response, g
-from prometheus_client import Counter, Histogram, CollectorRegistry, multiprocess, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, multiprocess, generate_latest, CONTENT_TYPE_LATEST
 
 
 def once(__init__):
@@ -46,6 +46,13 @@ class DatabaseMonitoring:
                                              ['caller'])
         self.exception_count = Counter("enjoliver_db_exception_total", "Counter of number error during session",
                                        ["caller", "exception"])
+        self.discovery_rows_count = Counter("enjoliver_discovery_rows_total",
+                                            "Rows of the discovery data by table and by upsert action",
+                                            ["table", "action"])
+        self.state_queue_depth = Gauge("enjoliver_machine_state_queue_depth",
+                                       "Machine states buffered and not flushed yet", multiprocess_mode="livesum")
+        self.state_flush_latency = Histogram("enjoliver_machine_state_flush_duration_seconds",
+                                             "Latency of the flush of the buffered machine states")
 
     @contextmanager
     def observe_transaction(self, caller: str):
@@ -66,6 +73,44 @@ class DatabaseMonitoring:
             self.request_count.labels(caller).inc()
 
 
+class CacheMonitoring:
+    _instance = None
+    _init = False
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance:
+            return cls._instance
+
+        o = object.__new__(cls)
+        cls._instance = o
+        return o
+
+    @once
+    def __init__(self):
+        self.request_count = Counter("enjoliver_cache_request_total", "Cache get count by result: hit or miss",
+                                     ["backend", "result"])
+        self.eviction_count = Counter("enjoliver_cache_eviction_total", "Keys evicted before their expiration",
+                                      ["backend"])
+
+
+class MatchboxMonitoring:
+    _instance = None
+    _init = False
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance:
+            return cls._instance
+
+        o = object.__new__(cls)
+        cls._instance = o
+        return o
+
+    @once
+    def __init__(self):
+        self.request_latency = Histogram("enjoliver_matchbox_request_duration_seconds",
+                                         "Matchbox upstream latency by proxy route", ["route"])
+
+
 def extract_exception_name(exc_info=None):
     """
     Function to get the exception name and module
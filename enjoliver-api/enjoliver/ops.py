@@ -10,19 +10,20 @@ import shutil
 import time
 
 import psutil
-import requests
 from flask import jsonify
 from sqlalchemy.orm import Session, sessionmaker
 
 from enjoliver.db import session_commit
+from enjoliver.matchbox import MatchboxClient
 from enjoliver.model import Healthz
 
 logger = logging.getLogger(__name__)
 
 
-def healthz(application, sess_maker: sessionmaker, request):
+def healthz(application, sess_maker: sessionmaker, request, matchbox: MatchboxClient):
     """
     Query all services and return the status
+    :param matchbox: the HTTP client of matchbox
     :return: json
     """
     status = {
@@ -40,7 +41,7 @@ def healthz(application, sess_maker: sessionmaker, request):
         application.logger.error("MATCHBOX_URI is None")
     for k in status["matchbox"]:
         try:
-            req = requests.get("%s%s" % (application.config["MATCHBOX_URI"], k))
+            req = matchbox.get("%s%s" % (application.config["MATCHBOX_URI"], k), "/healthz")
             req.close()
             status["matchbox"][k] = True
         except Exception as e:
@@ -51,7 +52,7 @@ def healthz(application, sess_maker: sessionmaker, request):
     # Try a functional testing in discovery stages
     try:
         # here try if a default profile let any new machine boot in iPXE
-        req = requests.get("%s%s" % (application.config["MATCHBOX_URI"], "/ipxe"))
+        req = matchbox.get("%s%s" % (application.config["MATCHBOX_URI"], "/ipxe"), "/healthz")
         req.close()
         if req.status_code != 200:
             raise AssertionError("/ipxe returned a bad status code: %d" % req.status_code)
@@ -63,7 +64,7 @@ def healthz(application, sess_maker: sessionmaker, request):
     try:
         # create a random mac address to see if matchbox respond us something like it should
         ignition_url = "/ignition?mac=00-00-00-00-00-00"
-        req = requests.get("%s%s" % (application.config["MATCHBOX_URI"], ignition_url))
+        req = matchbox.get("%s%s" % (application.config["MATCHBOX_URI"], ignition_url), "/healthz")
         req.close()
         # Later parse the result to improve the coverage of this check
         json.loads(req.content.decode())
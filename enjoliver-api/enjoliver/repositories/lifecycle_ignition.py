@@ -0,0 +1,102 @@
+import datetime
+import logging
+import threading
+import time
+
+from sqlalchemy import case, or_
+from sqlalchemy.orm import sessionmaker
+
+from enjoliver.db import session_commit
+from enjoliver.model import LifecycleIgnition
+
+logger = logging.getLogger(__name__)
+
+
+class LifecycleIgnitionRepository:
+    """
+    Buffer the up-to-date reports of the machines polling /lifecycle/ignition and write them by batch:
+    one UPDATE of the LifecycleIgnition rows instead of a transaction per poll.
+    Only the machines with a LifecycleIgnition row already created by crud.InjectLifecycle are buffered.
+    """
+
+    def __init__(self, sess_maker: sessionmaker, max_batch=500, max_delay=5):
+        self.__sess_maker = sess_maker
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._machine_ids = dict()
+        # machine_id -> datetime of its last up-to-date report
+        self._pending = dict()
+        self._flushed_at = time.time()
+        self._lock = threading.Lock()
+
+    def remember(self, mac: str, machine_id: int):
+        """
+        :param mac: the mac of the lifecycle raw query
+        :param machine_id: the Machine.id having a LifecycleIgnition row
+        """
+        with self._lock:
+            self._machine_ids[mac] = machine_id
+
+    def discard(self, mac: str):
+        """
+        Drop the buffered up-to-date report of a machine going out of date, and forget its machine_id
+        :param mac: the mac of the lifecycle raw query
+        """
+        with self._lock:
+            machine_id = self._machine_ids.pop(mac, None)
+            self._pending.pop(machine_id, None)
+
+    def bump_up_to_date(self, mac: str):
+        """
+        Buffer an up-to-date report, flush the buffer when it's full or too old
+        :param mac: the mac of the lifecycle raw query
+        :return: False if the machine is unknown: the caller has to go through crud.InjectLifecycle
+        """
+        with self._lock:
+            machine_id = self._machine_ids.get(mac)
+            if machine_id is None:
+                return False
+            self._pending[machine_id] = datetime.datetime.utcnow()
+            due = len(self._pending) >= self.max_batch or time.time() - self._flushed_at >= self.max_delay
+
+        if due:
+            self.flush()
+        return True
+
+    def flush(self):
+        """
+        Set the buffered machines up to date in one statement, last_change_date changes only for the ones outdated
+        Each row is dated by its report: the rows written after it, like an outdated report of another worker, are
+        newer and left as is
+        The machine_ids without row are forgotten: their next report goes through crud.InjectLifecycle
+        :return: number of machines updated
+        """
+        with self._lock:
+            pending, self._pending = self._pending, dict()
+            self._flushed_at = time.time()
+        if not pending:
+            return 0
+
+        machine_ids = list(pending)
+        reported_at = case(pending, value=LifecycleIgnition.machine_id)
+        with session_commit(sess_maker=self.__sess_maker) as session:
+            known = {k for k, in session.query(LifecycleIgnition.machine_id)
+                     .filter(LifecycleIgnition.machine_id.in_(machine_ids))}
+            updated = session.query(LifecycleIgnition) \
+                .filter(LifecycleIgnition.machine_id.in_(machine_ids)) \
+                .filter(or_(LifecycleIgnition.updated_date == None, LifecycleIgnition.updated_date <= reported_at)) \
+                .update({
+                    LifecycleIgnition.last_change_date: case(
+                        [(LifecycleIgnition.up_to_date == True, LifecycleIgnition.last_change_date)],
+                        else_=reported_at),
+                    LifecycleIgnition.up_to_date: True,
+                    LifecycleIgnition.updated_date: reported_at,
+                }, synchronize_session=False)
+
+        if len(known) != len(machine_ids):
+            with self._lock:
+                for mac, machine_id in list(self._machine_ids.items()):
+                    if machine_id in machine_ids and machine_id not in known:
+                        del self._machine_ids[mac]
+        logger.debug("%d lifecycle ignition up to date" % updated)
+        return updated
@@ -1,21 +1,99 @@
 import datetime
+import hashlib
+import json
 import logging
+import threading
+from collections import OrderedDict, defaultdict
 
 from sqlalchemy.orm import joinedload, Session, sessionmaker
 
 from enjoliver import tools
-from enjoliver.db import session_commit
-from enjoliver.model import MachineInterface, Machine, MachineDisk, Chassis, ChassisPort
+from enjoliver.db import session_commit, iter_by_keyset
+from enjoliver.model import MachineInterface, Machine, MachineDisk, Chassis, ChassisPort, MachineCurrentState, \
+    MachineStates
+from enjoliver.monitoring import DatabaseMonitoring
 
 
 logger = logging.getLogger(__name__)
 
 
+class DiscoveryDiff:
+    """
+    Track the rows to write for an upsert of discovery data and count them by table and by action
+    The updated rows are ORM instances attached to the session: they are written during the flush
+    """
+    actions = ["unchanged", "updated", "inserted", "deleted"]
+
+    def __init__(self):
+        self.counts = {action: defaultdict(int) for action in self.actions}
+        self.inserted = defaultdict(list)
+        self.deleted = defaultdict(list)
+
+    def _count(self, action: str, row):
+        self.counts[action][row.__tablename__] += 1
+
+    def unchanged(self, row):
+        self._count("unchanged", row)
+
+    def update(self, row):
+        self._count("updated", row)
+
+    def insert(self, row):
+        self._count("inserted", row)
+        self.inserted[type(row)].append(row)
+
+    def delete(self, row):
+        self._count("deleted", row)
+        self.deleted[type(row)].append(row)
+
+    def total(self, action: str):
+        return sum(self.counts[action].values())
+
+    def apply_deletes(self, session: Session):
+        """
+        One DELETE statement per table, the chassis ports before the interfaces they reference
+        """
+        for model in [ChassisPort, MachineInterface, MachineDisk]:
+            ids = [row.id for row in self.deleted.get(model, [])]
+            if ids:
+                session.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+                for row in self.deleted.pop(model):
+                    session.expunge(row)
+
+    def apply_inserts(self, session: Session, model, return_defaults=False):
+        """
+        Insert the new rows of the given model
+        :param session: a DB session
+        :param model: the model class
+        :param return_defaults: the rows get their primary key back, at the cost of one INSERT per row
+        :return:
+        """
+        rows = self.inserted.get(model, [])
+        if not rows:
+            return
+        if return_defaults:
+            session.add_all(rows)
+            session.flush()
+        else:
+            session.bulk_save_objects(rows)
+
+    def report(self):
+        monitoring = DatabaseMonitoring()
+        for action in self.actions:
+            for table, count in self.counts[action].items():
+                monitoring.discovery_rows_count.labels(table, action).inc(count)
+        logger.debug("discovery rows: %s" % ", ".join(["%s=%d" % (k, self.total(k)) for k in self.actions]))
+
+
 class MachineDiscoveryRepository:
     __name__ = "MachineDiscoveryRepository"
 
+    max_unresolved = 4096
+
     def __init__(self, sess_maker: sessionmaker):
         self.__sess_maker = sess_maker
+        self._unresolved = OrderedDict()
+        self._unresolved_lock = threading.Lock()
 
     @staticmethod
     def _lint_discovery_data(discovery_data: dict):
@@ -31,140 +109,338 @@ class MachineDiscoveryRepository:
         return discovery_data
 
     @staticmethod
-    def _delete_all_attached(session: Session, machine: Machine):
+    def fingerprint(discovery_data: dict):
         """
-        Delete all resources attached to a machine
-        As we don't need performance we can avoid heuristics by dropping and re-creating theses needed resources
-        The discovery data is the reference of the reality
-        :param session: a DB session
-        :param machine:
+        Stable hash of the linted discovery data, the order of the keys doesn't matter
+        :param discovery_data:
+        :return: sha256 hex digest
+        """
+        payload = json.dumps(discovery_data, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def is_unchanged(self, discovery_data: dict):
+        """
+        Read only check to short-circuit the repeated discovery data:
+        the machine already reported the same content and its boot MAC is still in the discovery state
+        :param discovery_data:
+        :return: True if there is nothing to write
+        """
+        discovery_data = self._lint_discovery_data(discovery_data)
+        fingerprint = self.fingerprint(discovery_data)
+        with session_commit(sess_maker=self.__sess_maker) as session:
+            return session.query(Machine.id) \
+                       .join(MachineCurrentState, MachineCurrentState.machine_id == Machine.id) \
+                       .filter(Machine.uuid == discovery_data["boot-info"]["uuid"]) \
+                       .filter(Machine.fingerprint == fingerprint) \
+                       .filter(MachineCurrentState.machine_mac == discovery_data["boot-info"]["mac"]) \
+                       .filter(MachineCurrentState.state_name == MachineStates.discovery) \
+                       .first() is not None
+
+    @staticmethod
+    def _diff_disks(machine_id: int, disks: list, on_db: list, diff: DiscoveryDiff):
+        """
+        Diff the disks of a machine by path
+        :param machine_id: Machine.id
+        :param disks: the disks of the discovery data
+        :param on_db: the MachineDisk of the machine
+        :param diff: the DiscoveryDiff to fill
         :return:
         """
-        session.query(MachineDisk) \
-            .filter(MachineDisk.machine_id == machine.id) \
-            .delete()
+        by_path = {}
+        for row in on_db:
+            if row.path in by_path:
+                diff.delete(row)
+            else:
+                by_path[row.path] = row
 
-        all_mi = session.query(MachineInterface) \
-            .filter(MachineInterface.machine_id == machine.id)
-        for i in all_mi:
-            session.query(ChassisPort) \
-                .filter(ChassisPort.machine_interface == i.id) \
-                .delete()
-            session.delete(i)
+        for d in disks:
+            row = by_path.pop(d["path"], None)
+            if row is None:
+                diff.insert(MachineDisk(path=d["path"], size=d["size-bytes"], machine_id=machine_id))
+            elif row.size != d["size-bytes"]:
+                row.size = d["size-bytes"]
+                diff.update(row)
+            else:
+                diff.unchanged(row)
 
-        session.flush()
+        for row in by_path.values():
+            diff.delete(row)
 
     @staticmethod
-    def _insert_network(session: Session, machine: Machine, discovery_data: dict):
+    def _diff_interfaces(machine_id: int, discovery_data: dict, fqdns: dict, on_db: list, diff: DiscoveryDiff):
+        """
+        Diff the interfaces of a machine by mac
+        The fqdn of an interface missing from fqdns is still resolving: the stored one is kept
+        :param machine_id: Machine.id
+        :param discovery_data: the discovery data
+        :param fqdns: dict of verified fqdn by mac, see tools.get_verified_dns_queries
+        :param on_db: the MachineInterface of the machine
+        :param diff: the DiscoveryDiff to fill
+        :return: dict of MachineInterface by name, used to link the LLDP chassis ports
+        """
+        by_mac = {row.mac: row for row in on_db}
         machine_interfaces = dict()
         for i in discovery_data["interfaces"]:
-            if i["mac"]:
-                machine_interface = MachineInterface(
-                    mac=i["mac"],
-                    name=i["name"],
-                    netmask=i["netmask"],
-                    ipv4=i["ipv4"],
-                    cidrv4=i["cidrv4"],
-                    as_boot=i["mac"] == discovery_data["boot-info"]["mac"],
-                    gateway=i["gateway"],
-                    fqdn=tools.get_verified_dns_query(i),
-                    machine_id=machine.id
-                )
-                # track machine interfaces to get them after during the LLDP section
-                machine_interfaces[machine_interface.name] = machine_interface
-                session.add(machine_interface)
+            if not i["mac"]:
+                continue
+            wanted = {
+                "name": i["name"],
+                "netmask": i["netmask"],
+                "ipv4": i["ipv4"],
+                "cidrv4": i["cidrv4"],
+                "as_boot": i["mac"] == discovery_data["boot-info"]["mac"],
+                "gateway": i["gateway"],
+            }
+            if i["mac"] in fqdns:
+                wanted["fqdn"] = fqdns[i["mac"]]
+            row = by_mac.pop(i["mac"], None)
+            if row is None:
+                row = MachineInterface(mac=i["mac"], machine_id=machine_id, **wanted)
+                diff.insert(row)
+            else:
+                changes = {k: v for k, v in wanted.items() if getattr(row, k) != v}
+                for k, v in changes.items():
+                    setattr(row, k, v)
+                if changes:
+                    diff.update(row)
+                else:
+                    diff.unchanged(row)
+            machine_interfaces[row.name] = row
 
-        session.flush()
+        for row in by_mac.values():
+            diff.delete(row)
+        return machine_interfaces
 
-        if discovery_data["lldp"]["is_file"] and discovery_data["lldp"]["data"]["interfaces"]:
-            for lldp_interface in discovery_data["lldp"]["data"]["interfaces"]:
-                chassis = session.query(Chassis) \
-                    .filter(Chassis.name == lldp_interface["chassis"]["name"] and
-                            Chassis.name == lldp_interface["chassis"]["id"]) \
-                    .first()
-                if not chassis:
-                    chassis = Chassis(
-                        name=lldp_interface["chassis"]["name"],
-                        mac=lldp_interface["chassis"]["id"],
-                    )
-                session.add(chassis)
-                session.flush()
-                machine_interface_id = machine_interfaces[lldp_interface["name"]].id
-                session.add(
-                    ChassisPort(
-                        # TODO on some vendor it's not a MAC but a string like Ethernet1/22
-                        mac=lldp_interface["port"]["id"],
-                        machine_interface=machine_interface_id,
-                        chassis_id=chassis.id
-                    )
+    @staticmethod
+    def _diff_chassis_ports(session: Session, lldp_interfaces: list, ports_by_interface: dict, diff: DiscoveryDiff):
+        """
+        Diff the chassis ports of the reported LLDP interfaces, the missing chassis are created
+        The new interfaces must be flushed to have their id
+        :param session: a DB session
+        :param lldp_interfaces: list of tuple (MachineInterface, lldp interface data)
+        :param ports_by_interface: dict of list of ChassisPort by MachineInterface.id
+        :param diff: the DiscoveryDiff to fill
+        :return:
+        """
+        chassis_by_name = dict()
+        chassis_names = list({k[1]["chassis"]["name"] for k in lldp_interfaces})
+        if chassis_names:
+            chassis_by_name = {c.name: c for c in session.query(Chassis).filter(Chassis.name.in_(chassis_names))}
+        for _, lldp_interface in lldp_interfaces:
+            if lldp_interface["chassis"]["name"] not in chassis_by_name:
+                chassis = Chassis(
+                    name=lldp_interface["chassis"]["name"],
+                    mac=lldp_interface["chassis"]["id"],
                 )
+                chassis_by_name[chassis.name] = chassis
+                session.add(chassis)
+        session.flush()
 
-    def upsert(self, discovery_data: dict):
-        discovery_data = self._lint_discovery_data(discovery_data)
+        for machine_interface, lldp_interface in lldp_interfaces:
+            chassis_id = chassis_by_name[lldp_interface["chassis"]["name"]].id
+            ports = ports_by_interface.pop(machine_interface.id, [])
+            kept = None
+            for port in ports:
+                if kept is None and port.mac == lldp_interface["port"]["id"] and port.chassis_id == chassis_id:
+                    kept = port
+                    diff.unchanged(port)
+                else:
+                    diff.delete(port)
+            if kept is None:
+                diff.insert(ChassisPort(
+                    # TODO on some vendor it's not a MAC but a string like Ethernet1/22
+                    mac=lldp_interface["port"]["id"],
+                    machine_interface=machine_interface.id,
+                    chassis_id=chassis_id
+                ))
+
+        # the ports of interfaces not reported anymore by LLDP
+        for ports in ports_by_interface.values():
+            for port in ports:
+                diff.delete(port)
+
+    def upsert(self, discovery_data: dict, session: Session = None):
+        """
+        Upsert the discovery data of one machine
+        :param discovery_data:
+        :param session: the transaction of the caller, None for a new one
+        :return: True if the machine is new
+        """
+        return self.upsert_many([discovery_data], session)[0]
+
+    def upsert_many(self, discovery_list: list, session: Session = None):
+        """
+        Upsert the discovery data of many machines in one transaction
+        See _upsert_many
+        :param discovery_list: list of discovery data
+        :param session: the transaction of the caller, None for a new one
+        :return: list of bool, True if the machine is new, in the order of discovery_list
+        """
+        new, _ = self._upsert_many(discovery_list, session)
+        return new
+
+    def _upsert_many(self, discovery_list: list, session: Session = None):
+        """
+        The stored disks, interfaces and LLDP chassis ports are diffed against the discovery data,
+        only the changed rows are written. When nothing changed only the Machine.updated_date is bumped.
+        The Machine.fingerprint is set to the hash of the discovery data, see is_unchanged
+        When the same uuid is given twice, the last discovery data wins
+        :param discovery_list: list of discovery data
+        :return: tuple(list of bool: True if the machine is new, DiscoveryDiff)
+        """
+        diff = DiscoveryDiff()
+        if not discovery_list:
+            return [], diff
+
+        discovery_list = [self._lint_discovery_data(k) for k in discovery_list]
+        discovery_by_uuid = OrderedDict((k["boot-info"]["uuid"], k) for k in discovery_list)
+        interfaces = [i for k in discovery_by_uuid.values() for i in k["interfaces"] if i["mac"]]
+        fqdns = tools.get_verified_dns_queries(interfaces)
+        self._remember_unresolved([i for i in interfaces if i["mac"] not in fqdns])
         now = datetime.datetime.utcnow()
 
-        new = True
+        with session_commit(sess_maker=self.__sess_maker, session=session) as session:
+            machines = {
+                m.uuid: m for m in session.query(Machine).filter(Machine.uuid.in_(list(discovery_by_uuid)))
+            }
+            new_uuids = set(discovery_by_uuid) - set(machines)
+
+            disks_by_machine = defaultdict(list)
+            interfaces_by_machine = defaultdict(list)
+            ports_by_interface = defaultdict(list)
+            if machines:
+                existing_ids = [m.id for m in machines.values()]
+                session.query(Machine) \
+                    .filter(Machine.id.in_(existing_ids)) \
+                    .update({Machine.updated_date: now}, synchronize_session=False)
+
+                for row in session.query(MachineDisk).filter(MachineDisk.machine_id.in_(existing_ids)):
+                    disks_by_machine[row.machine_id].append(row)
+                for row in session.query(MachineInterface).filter(MachineInterface.machine_id.in_(existing_ids)):
+                    interfaces_by_machine[row.machine_id].append(row)
+                interface_ids = [row.id for rows in interfaces_by_machine.values() for row in rows]
+                if interface_ids:
+                    for row in session.query(ChassisPort).filter(ChassisPort.machine_interface.in_(interface_ids)):
+                        ports_by_interface[row.machine_interface].append(row)
+
+            for uuid in discovery_by_uuid:
+                if uuid in new_uuids:
+                    machines[uuid] = Machine(uuid=uuid, created_date=now, updated_date=now)
+                    session.add(machines[uuid])
+            session.flush()
+
+            lldp_interfaces = []
+            for uuid, discovery_data in discovery_by_uuid.items():
+                machines[uuid].fingerprint = self.fingerprint(discovery_data)
+                machine_id = machines[uuid].id
+                self._diff_disks(machine_id, discovery_data["disks"], disks_by_machine[machine_id], diff)
+                machine_interfaces = self._diff_interfaces(
+                    machine_id, discovery_data, fqdns, interfaces_by_machine[machine_id], diff)
+
+                if discovery_data["lldp"]["is_file"] and discovery_data["lldp"]["data"]["interfaces"]:
+                    for lldp_interface in discovery_data["lldp"]["data"]["interfaces"]:
+                        lldp_interfaces.append((machine_interfaces[lldp_interface["name"]], lldp_interface))
+
+            # the deleted interfaces must not be linked anymore to a chassis port
+            for row in diff.deleted.get(MachineInterface, []):
+                for port in ports_by_interface.pop(row.id, []):
+                    diff.delete(port)
+
+            diff.apply_deletes(session)
+            diff.apply_inserts(session, MachineDisk)
+            diff.apply_inserts(session, MachineInterface, return_defaults=True)
+            self._diff_chassis_ports(session, lldp_interfaces, ports_by_interface, diff)
+            diff.apply_deletes(session)
+            diff.apply_inserts(session, ChassisPort)
+
+        diff.report()
+        return [k["boot-info"]["uuid"] in new_uuids for k in discovery_list], diff
+
+    def _remember_unresolved(self, interfaces: list):
+        with self._unresolved_lock:
+            for i in interfaces:
+                self._unresolved[i["mac"]] = i
+                self._unresolved.move_to_end(i["mac"])
+            while len(self._unresolved) > self.max_unresolved:
+                self._unresolved.popitem(last=False)
+
+    def backfill_fqdn(self, deadline: float = None):
+        """
+        Store the fqdn of the interfaces whose DNS lookup didn't end before the deadline of their upsert
+        Called periodically by a background job
+        :param deadline: seconds to wait for the lookups, see tools.get_verified_dns_queries
+        :return: number of interfaces backfilled
+        """
+        with self._unresolved_lock:
+            interfaces = list(self._unresolved.values())
+        if not interfaces:
+            return 0
+
+        fqdns = tools.get_verified_dns_queries(interfaces, deadline=deadline)
+        if not fqdns:
+            return 0
+
         with session_commit(sess_maker=self.__sess_maker) as session:
+            for row in session.query(MachineInterface).filter(MachineInterface.mac.in_(list(fqdns))):
+                row.fqdn = fqdns[row.mac]
 
-            machine = session.query(Machine) \
-                .filter(Machine.uuid == discovery_data["boot-info"]["uuid"]) \
-                .first()
+        with self._unresolved_lock:
+            for mac in fqdns:
+                self._unresolved.pop(mac, None)
+        logger.info("backfilled the fqdn of %d interfaces" % len(fqdns))
+        return len(fqdns)
 
-            if machine:
-                new = False
-                machine.updated_date = now
-                self._delete_all_attached(session, machine)
-            else:
-                machine = Machine(
-                    uuid=discovery_data["boot-info"]["uuid"],
-                    created_date=now, updated_date=now
-                )
-                session.add(machine)
-                session.flush()
+    @staticmethod
+    def _construct_discovery(machine: Machine):
+        boot_interface = None
+        interfaces = []
+        for i in machine.interfaces:
+            if i.as_boot:
+                boot_interface = i
+            interfaces.append({
+                "as_boot": i.as_boot,
+                "cidrv4": i.cidrv4,
+                "fqdn": i.fqdn,
+                "gateway": i.gateway,
+                "ipv4": i.ipv4,
+                "mac": i.mac,
+                "name": i.name,
+                "netmask": i.netmask
+            })
 
-            for d in discovery_data["disks"]:
-                session.add(MachineDisk(path=d["path"], size=d["size-bytes"], machine_id=machine.id))
+        return {
+            "boot-info": {
+                "uuid": machine.uuid,
+                "created-date": machine.created_date,
+                "updated-date": machine.updated_date,
+                "mac": boot_interface.mac
+            },
+            "interfaces": interfaces,
+            "disks": [{"size-bytes": d.size, "path": d.path} for d in machine.disks]
+        }
 
-            self._insert_network(session, machine, discovery_data)
-            session.commit()
-        return new
+    def iter_discovery(self, after=None, limit=None):
+        """
+        Stream the discovery data ordered by machine id, batch by batch
+        The session stays open until the generator is exhausted or closed
+        :param after: machine id to start after, the cursor
+        :param limit: max number of machines, None for all
+        :return: generator of (machine id, discovery data)
+        """
+        with session_commit(sess_maker=self.__sess_maker) as session:
+            query = session.query(Machine) \
+                .options(joinedload("interfaces")) \
+                .options(joinedload("disks")) \
+                .filter(Machine.interfaces.any(MachineInterface.as_boot == True))
+            for batch in iter_by_keyset(query, Machine.id, after=after, limit=limit):
+                for m in batch:
+                    yield m.id, self._construct_discovery(m)
 
-    def fetch_all_discovery(self):
+    def fetch_all_discovery(self, after=None, limit=None):
         """
         Get discovery data of interfaces, disks and the boot-info
-        :return:
+        :param after: machine id to start after, the cursor
+        :param limit: max number of machines, None for all
+        :return: list of discovery data
         """
-        machines = []
-        with session_commit(sess_maker=self.__sess_maker) as session:
-            for m in session.query(Machine) \
-                    .options(joinedload("interfaces")) \
-                    .options(joinedload("disks")) \
-                    .join(MachineInterface):
-
-                boot_interface = None
-                interfaces = []
-                for i in m.interfaces:
-                    if i.as_boot:
-                        boot_interface = i
-                    interfaces.append({
-                        "as_boot": i.as_boot,
-                        "cidrv4": i.cidrv4,
-                        "fqdn": i.fqdn,
-                        "gateway": i.gateway,
-                        "ipv4": i.ipv4,
-                        "mac": i.mac,
-                        "name": i.name,
-                        "netmask": i.netmask
-                    })
-
-                machines.append({
-                    "boot-info": {
-                        "uuid": m.uuid,
-                        "created-date": m.created_date,
-                        "updated-date": m.updated_date,
-                        "mac": boot_interface.mac
-                    },
-                    "interfaces": interfaces,
-                    "disks": [{"size-bytes": d.size, "path": d.path} for d in m.disks]
-                })
-            return machines
+        return [data for _, data in self.iter_discovery(after=after, limit=limit)]
@@ -1,9 +1,11 @@
 import logging
 
-from sqlalchemy.orm import joinedload, sessionmaker
+from sqlalchemy import and_, case, exists, func
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session, joinedload, sessionmaker
 
 from enjoliver.db import session_commit
-from enjoliver.model import Machine, Schedule, MachineInterface
+from enjoliver.model import Chassis, ChassisPort, Machine, MachineDisk, MachineInterface, Schedule, ScheduleRoles
 
 logger = logging.getLogger(__name__)
 
@@ -11,8 +13,13 @@ logger = logging.getLogger(__name__)
 class MachineScheduleRepository:
     __name__ = "MachineScheduleRepository"
 
-    def __init__(self, sess_maker: sessionmaker):
+    def __init__(self, sess_maker: sessionmaker, placement=None):
+        """
+        :param sess_maker: the DB session factory
+        :param placement: schedulerv2.PlacementPolicy choosing the machines to allocate, None for the lowest macs
+        """
         self.__sess_maker = sess_maker
+        self.placement = placement
 
     @staticmethod
     def _lint_schedule_data(schedule_data: dict):
@@ -28,29 +35,163 @@ class MachineScheduleRepository:
         return schedule_data
 
     def create_schedule(self, schedule_data: dict):
-        schedule_data = self._lint_schedule_data(schedule_data)
+        self.create_schedules_batch([schedule_data])
 
+    def create_schedules_batch(self, schedules_data: list):
+        """
+        Schedule many machines in one transaction: the machines are found with one query by mac and the new
+        schedules are inserted in bulk
+        :param schedules_data: list of schedule data, like {"roles": [...], "selector": {"mac": ...}}
+        :return: list of dict(mac, roles scheduled by this call) in the order of schedules_data, roles is None
+            when the machine isn't in db
+        """
+        for schedule_data in schedules_data:
+            self._lint_schedule_data(schedule_data)
+            for role in schedule_data["roles"]:
+                if role not in ScheduleRoles.roles:
+                    raise LookupError("%s not in %s" % (role, ScheduleRoles.roles))
+
+        if not schedules_data:
+            return []
+
+        macs = {k["selector"]["mac"] for k in schedules_data}
+        results = []
         with session_commit(sess_maker=self.__sess_maker) as session:
-            machine = session.query(Machine) \
-                .join(MachineInterface) \
-                .options(joinedload("schedules")) \
-                .filter(MachineInterface.mac == schedule_data["selector"]["mac"]) \
-                .first()
-
-            if not machine:
-                logger.error("machine mac %s not in db", schedule_data["selector"]["mac"])
-            else:
-                machine_already_scheduled = [s.role for s in machine.schedules]
+            machine_ids = dict(session.query(MachineInterface.mac, MachineInterface.machine_id)
+                               .filter(MachineInterface.mac.in_(macs)))
+            scheduled = set(session.query(Schedule.machine_id, Schedule.role)
+                            .filter(Schedule.machine_id.in_(set(machine_ids.values()))))
+
+            rows = []
+            for schedule_data in schedules_data:
+                mac = schedule_data["selector"]["mac"]
+                machine_id = machine_ids.get(mac)
+                if machine_id is None:
+                    logger.error("machine mac %s not in db", mac)
+                    results.append({"mac": mac, "roles": None})
+                    continue
+                roles = []
                 for role in schedule_data["roles"]:
-                    if role in machine_already_scheduled:
-                        logger.info("machine mac %s already scheduled with role %s",
-                                    schedule_data["selector"]["mac"], role)
+                    if (machine_id, role) in scheduled:
+                        logger.info("machine mac %s already scheduled with role %s", mac, role)
                         continue
-                    session.add(Schedule(machine_id=machine.id, role=role))
-                    logger.info(
-                        "scheduling machine mac %s as role %s",
-                        schedule_data["selector"]["mac"], role
-                    )
+                    scheduled.add((machine_id, role))
+                    rows.append({"machine_id": machine_id, "role": role})
+                    roles.append(role)
+                    logger.info("scheduling machine mac %s as role %s", mac, role)
+                results.append({"mac": mac, "roles": roles})
+
+            if rows:
+                session.execute(Schedule.__table__.insert(), rows)
+
+        return results
+
+    def allocate(self, roles: list, nb=None, tries=3):
+        """
+        Schedule available machines with the roles until nb machines have them, in one transaction
+        The transaction is serializable and the available machines are taken with FOR UPDATE SKIP LOCKED where the
+        database supports it: concurrent allocations never schedule more than nb machines
+        :param roles: the roles
+        :param nb: the number of machines expected with the roles, all or nothing, None for every available machine
+        :param tries: attempts when the database aborts the transaction on a serialization failure
+        :return: dict(scheduled=the number of machines with the roles, allocated=mac addresses allocated by this call)
+        """
+        for role in roles:
+            if role not in ScheduleRoles.roles:
+                raise LookupError("%s not in %s" % (role, ScheduleRoles.roles))
+
+        for i in range(tries):
+            try:
+                result = self._allocate(sorted(set(roles)), nb)
+                if result is not None:
+                    return result
+                logger.warning("retry %d/%d the allocation of %s: concurrent allocation", i + 1, tries, roles)
+            except DBAPIError as e:
+                # serialization_failure: a concurrent allocation won
+                if getattr(e.orig, "pgcode", None) != "40001" or i + 1 == tries:
+                    raise
+                logger.warning("retry %d/%d the allocation of %s: %s", i + 1, tries, roles, e)
+
+        raise RuntimeError("fail to allocate %s after %d tries" % (roles, tries))
+
+    def _allocate(self, roles: list, nb):
+        """
+        :return: the result of allocate, None when a concurrent allocation is detected and nothing is written
+        """
+        with session_commit(sess_maker=self.__sess_maker) as session:
+            dialect = session.bind.dialect.name
+            if dialect == "postgresql":
+                session.connection(execution_options={"isolation_level": "SERIALIZABLE"})
+
+            scheduled = self._query_machine_ids_by_roles(session, roles).count()
+            missing = None if nb is None else nb - scheduled
+            if missing is not None and missing <= 0:
+                return {"scheduled": scheduled, "allocated": []}
+
+            query = session.query(Machine.id, MachineInterface.mac) \
+                .join(MachineInterface, and_(MachineInterface.machine_id == Machine.id,
+                                             MachineInterface.as_boot == True)) \
+                .filter(~exists().where(Schedule.machine_id == Machine.id)) \
+                .order_by(MachineInterface.mac)
+            placed = missing is not None and self.placement is not None and not self.placement.by_mac
+            if missing is not None and not placed:
+                query = query.limit(missing)
+            if dialect in ("postgresql", "cockroachdb"):
+                query = query.with_for_update(of=Machine, skip_locked=dialect == "postgresql")
+            available = query.all()
+
+            if missing is not None and len(available) < missing:
+                logger.info("not enough machines available for %s: %d/%d", roles, len(available), missing)
+                return {"scheduled": scheduled, "allocated": []}
+
+            if placed:
+                available = self._place(session, roles, available, missing)
+
+            if available:
+                session.execute(Schedule.__table__.insert(), [
+                    {"machine_id": machine_id, "role": role} for machine_id, _ in available for role in roles])
+                # without serializable transactions, like SQLite, the concurrent writes are only seen after ours
+                conflict = session.query(Schedule) \
+                    .filter(Schedule.machine_id.in_([machine_id for machine_id, _ in available])) \
+                    .count() != len(available) * len(roles)
+                if conflict or (nb is not None and self._query_machine_ids_by_roles(session, roles).count() > nb):
+                    session.rollback()
+                    return None
+                logger.info("allocated %d machines as roles %s", len(available), roles)
+            return {"scheduled": scheduled + len(available), "allocated": [mac for _, mac in available]}
+
+    def _place(self, session: Session, roles: list, available: list, nb: int):
+        """
+        :param available: list of tuple(machine id, mac) of the candidates
+        :return: list of tuple(machine id, mac) chosen by the placement policy
+        """
+        scheduled_ids = [k for k, in self._query_machine_ids_by_roles(session, roles)]
+        machines = self._describe_machines(session, [k for k, _ in available] + scheduled_ids)
+        chosen = self.placement.place(
+            [machines[k] for k, _ in available], [machines[k] for k in scheduled_ids if k in machines], nb)
+        machine_ids = {mac: machine_id for machine_id, mac in available}
+        logger.info("placed %d machines as roles %s with %s", len(chosen), roles, self.placement.name)
+        return [(machine_ids[k["mac"]], k["mac"]) for k in chosen]
+
+    @staticmethod
+    def _describe_machines(session: Session, machine_ids: list):
+        """
+        :return: dict machine id -> dict(mac, fqdn, chassis, disks_size) for the placement policies
+        """
+        machines = dict()
+        for machine_id, mac, fqdn, chassis in session.query(
+                MachineInterface.machine_id, MachineInterface.mac, MachineInterface.fqdn, Chassis.mac) \
+                .outerjoin(ChassisPort, ChassisPort.machine_interface == MachineInterface.id) \
+                .outerjoin(Chassis, Chassis.id == ChassisPort.chassis_id) \
+                .filter(MachineInterface.as_boot == True, MachineInterface.machine_id.in_(machine_ids)):
+            machines.setdefault(machine_id, {"mac": mac, "fqdn": fqdn, "chassis": chassis, "disks_size": 0})
+
+        for machine_id, size in session.query(MachineDisk.machine_id, func.sum(MachineDisk.size)) \
+                .filter(MachineDisk.machine_id.in_(machine_ids)) \
+                .group_by(MachineDisk.machine_id):
+            if machine_id in machines:
+                machines[machine_id]["disks_size"] = int(size)
+        return machines
 
     def get_all_schedules(self):
         result = dict()
@@ -115,22 +256,47 @@ class MachineScheduleRepository:
         with session_commit(sess_maker=self.__sess_maker) as session:
             for machine in session.query(Machine) \
                     .join(Schedule) \
+                    .options(joinedload("boot_interface")) \
+                    .options(joinedload("disks")) \
                     .filter(Schedule.role == role):
                 machines.append(self._construct_machine_dict(machine, role))
 
         return machines
 
+    @staticmethod
+    def _query_machine_ids_by_roles(session: Session, roles: list):
+        """
+        :return: query of the ids of the machines with the role, or with exactly the set of roles if many
+        """
+        if len(roles) == 1:
+            return session.query(Schedule.machine_id).filter(Schedule.role == roles[0]).distinct()
+
+        expected = len(set(roles))
+        return session.query(Schedule.machine_id) \
+            .group_by(Schedule.machine_id) \
+            .having(func.count(Schedule.role.distinct()) == expected) \
+            .having(func.count(case([(Schedule.role.in_(roles), Schedule.role)]).distinct()) == expected)
+
     def get_machines_by_roles(self, *roles):
+        """
+        Get the machines scheduled with exactly the given set of roles
+        The role set equality is done by the database with a GROUP BY / HAVING over the schedules
+        :param roles: the roles
+        :return: list of machine dict
+        """
         if len(roles) == 1:
             return self.get_machines_by_role(roles[0])
         machines = []
         roles = list(roles)
 
         with session_commit(sess_maker=self.__sess_maker) as session:
-            for machine in session.query(Machine):
-                # TODO Maybe do this with a sqlalchemy filter func
-                if set(k.role for k in machine.schedules) == set(roles):
-                    machines.append(self._construct_machine_dict(machine, roles))
+            matching_ids = self._query_machine_ids_by_roles(session, roles).subquery()
+
+            for machine in session.query(Machine) \
+                    .options(joinedload("boot_interface")) \
+                    .options(joinedload("disks")) \
+                    .filter(Machine.id.in_(matching_ids)):
+                machines.append(self._construct_machine_dict(machine, roles))
 
         return machines
 
@@ -1,17 +1,32 @@
 import datetime
 import logging
+import threading
+import time
 
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import joinedload, sessionmaker, Session
 
 from enjoliver.db import session_commit
-from enjoliver.model import MachineCurrentState, MachineInterface
+from enjoliver.model import MachineCurrentState, MachineInterface, MachineStates
+from enjoliver.monitoring import DatabaseMonitoring
 
 logger = logging.getLogger(__name__)
 
 
 class MachineStateRepository:
-    def __init__(self, sess_maker: sessionmaker):
+    """
+    The states are transient: the updates are coalesced by mac in a write-behind buffer, the last write wins.
+    The buffer is flushed with one upsert when it reaches max_batch macs or when the oldest write is max_delay seconds
+    old. A max_delay of 0 disables the buffer: each update is written before returning.
+    """
+
+    def __init__(self, sess_maker: sessionmaker, max_batch=500, max_delay=0):
         self.__sess_maker = sess_maker
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._pending = dict()
+        self._flushed_at = time.time()
+        self._lock = threading.Lock()
 
     def _update_state(self, session: Session, machine_current_state: MachineCurrentState):
         try:
@@ -38,33 +53,119 @@ class MachineStateRepository:
             return results
 
     def update(self, mac: str, state: str):
-        with session_commit(sess_maker=self.__sess_maker) as session:
-            state_machine = session.query(MachineCurrentState) \
-                .filter(MachineCurrentState.machine_mac == mac) \
-                .one_or_none()
-
-            machine_interface = session.query(MachineInterface) \
-                .filter(MachineInterface.mac == mac) \
-                .one_or_none()
-
-            now = datetime.datetime.utcnow()
-            machine_id = None
-            if machine_interface is not None:
-                machine_id = machine_interface.machine_id
-
-            if not state_machine:
-                logger.debug(
-                    "machine with mac: %s doesn't exist in table %s: creating with state %s" % (
-                        mac, MachineCurrentState.__tablename__, state))
-                self._update_state(session, MachineCurrentState(
-                    machine_id=machine_id,
-                    state_name=state,
-                    machine_mac=mac,
-                    created_date=now,
-                    updated_date=now,
-                ))
-            else:
-                state_machine.state_name = state
-                state_machine.machine_id = machine_id
-                state_machine.updated_date = now
-                self._update_state(session, state_machine)
+        """
+        Buffer the state of a machine, flush the buffer when it's full or too old
+        :param mac: the mac of the machine
+        :param state: one of MachineStates.states
+        :return:
+        """
+        if state not in MachineStates.states:
+            raise LookupError("%s not in %s" % (state, MachineStates.states))
+
+        with self._lock:
+            self._pending[mac] = (state, datetime.datetime.utcnow())
+            depth = len(self._pending)
+            due = depth >= self.max_batch or time.time() - self._flushed_at >= self.max_delay
+        DatabaseMonitoring().state_queue_depth.set(depth)
+
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered states, a failure is logged and the states are dropped: they are not critical
+        :return: number of states written
+        """
+        with self._lock:
+            pending, self._pending = self._pending, dict()
+            self._flushed_at = time.time()
+        DatabaseMonitoring().state_queue_depth.set(0)
+        if not pending:
+            return 0
+
+        start = time.time()
+        try:
+            self._write(pending)
+        except Exception as e:
+            logger.error("fail to flush %d machine states: %s" % (len(pending), e))
+            return 0
+        finally:
+            DatabaseMonitoring().state_flush_latency.observe(time.time() - start)
+        logger.debug("%d machine states flushed" % len(pending))
+        return len(pending)
+
+    def update_many(self, states: dict, session: Session = None):
+        """
+        Update the current state of many machines in one transaction
+        :param states: dict of state by mac
+        :param session: the transaction of the caller, None for a new one
+        :return:
+        """
+        with self._lock:
+            for mac in states:
+                self._pending.pop(mac, None)
+        now = datetime.datetime.utcnow()
+        self._write({mac: (state, now) for mac, state in states.items()}, session)
+
+    def _write(self, states: dict, session: Session = None):
+        """
+        :param states: dict of tuple(state, date) by mac
+        :param session: the transaction of the caller, None for a new one
+        :return:
+        """
+        macs = list(states)
+        with session_commit(sess_maker=self.__sess_maker, session=session) as session:
+            machine_ids = dict(
+                session.query(MachineInterface.mac, MachineInterface.machine_id)
+                .filter(MachineInterface.mac.in_(macs))
+            )
+            if session.bind.dialect.name in ("postgresql", "cockroachdb"):
+                self._upsert(session, states, machine_ids)
+                return
+
+            state_machines = {
+                k.machine_mac: k for k in session.query(MachineCurrentState)
+                .filter(MachineCurrentState.machine_mac.in_(macs))
+            }
+            for mac, (state, date) in states.items():
+                machine_id = machine_ids.get(mac)
+                state_machine = state_machines.get(mac)
+                if not state_machine:
+                    logger.debug(
+                        "machine with mac: %s doesn't exist in table %s: creating with state %s" % (
+                            mac, MachineCurrentState.__tablename__, state))
+                    self._update_state(session, MachineCurrentState(
+                        machine_id=machine_id,
+                        state_name=state,
+                        machine_mac=mac,
+                        created_date=date,
+                        updated_date=date,
+                    ))
+                elif state_machine.updated_date is None or state_machine.updated_date <= date:
+                    state_machine.state_name = state
+                    state_machine.machine_id = machine_id
+                    state_machine.updated_date = date
+                    self._update_state(session, state_machine)
+
+    @staticmethod
+    def _upsert(session: Session, states: dict, machine_ids: dict):
+        """
+        INSERT ... ON CONFLICT (machine_mac) DO UPDATE of all the states
+        """
+        stmt = insert(MachineCurrentState).values([{
+            "machine_id": machine_ids.get(mac),
+            "machine_mac": mac,
+            "state_name": state,
+            "created_date": date,
+            "updated_date": date,
+        } for mac, (state, date) in states.items()])
+        session.execute(stmt.on_conflict_do_update(
+            index_elements=[MachineCurrentState.machine_mac],
+            set_={
+                "machine_id": stmt.excluded.machine_id,
+                "state_name": stmt.excluded.state_name,
+                "updated_date": stmt.excluded.updated_date,
+            },
+            # a flush racing with update_many doesn't overwrite a newer state
+            where=MachineCurrentState.updated_date <= stmt.excluded.updated_date,
+        ))
@@ -1,3 +1,4 @@
+from enjoliver.repositories.lifecycle_ignition import LifecycleIgnitionRepository
 from enjoliver.repositories.machine_discovery import MachineDiscoveryRepository
 from enjoliver.repositories.machine_schedule import MachineScheduleRepository
 from enjoliver.repositories.machine_state import MachineStateRepository
@@ -17,3 +18,4 @@ class RepositoryRegistry:
         self.machine_state = MachineStateRepository(sess_maker)
         self.user_interface = UserInterfaceRepository(sess_maker)
         self.machine_schedule = MachineScheduleRepository(sess_maker)
+        self.lifecycle_ignition = LifecycleIgnitionRepository(sess_maker)
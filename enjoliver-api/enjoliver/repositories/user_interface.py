@@ -1,7 +1,9 @@
+from collections import defaultdict
+
 from sqlalchemy.orm import sessionmaker
 
 from enjoliver import sync
-from enjoliver.db import session_commit
+from enjoliver.db import session_commit, iter_by_keyset
 from enjoliver.model import (
     Machine,
     MachineInterface,
@@ -12,6 +14,19 @@ from enjoliver.model import (
 )
 
 
+def _index_by(rows, key: str):
+    """
+    Group the rows in a dict of lists by the given attribute, keeping the order of the rows
+    :param rows: iterable of model instances
+    :param key: attribute name used as key, eg: machine_id
+    :return: defaultdict(list)
+    """
+    index = defaultdict(list)
+    for row in rows:
+        index[getattr(row, key)].append(row)
+    return index
+
+
 class UserInterfaceRepository:
     """
     Get the data for the User Interface View
@@ -20,62 +35,95 @@ class UserInterfaceRepository:
     def __init__(self, sess_maker: sessionmaker):
         self.__sess_maker = sess_maker
 
+    @staticmethod
+    def _build_overview(machines, mis, mds, mss, lis, lrs, srs):
+        """
+        Join the fetched tables in one pass over each of them
+        :param machines: Machine rows
+        :param mis: boot MachineInterface rows
+        :param mds: MachineDisk rows
+        :param mss: MachineCurrentState rows
+        :param lis: LifecycleIgnition rows
+        :param lrs: LifecycleRolling rows
+        :param srs: Schedule rows
+        :return: list of dict
+        """
+        interfaces_by_machine = _index_by(mis, "machine_id")
+        disks_by_machine = _index_by(mds, "machine_id")
+        states_by_mac = _index_by(mss, "machine_mac")
+        ignition_by_machine = _index_by(lis, "machine_id")
+        rolling_by_machine = _index_by(lrs, "machine_id")
+        schedules_by_machine = _index_by(srs, "machine_id")
+
+        data = list()
+        for machine in machines:
+            row = dict()
+
+            machine_interfaces = interfaces_by_machine.get(machine.id, [])
+            booting_mac = machine_interfaces[0].mac if machine_interfaces else ""
+            machine_states = states_by_mac.get(booting_mac, [])
+            lifecycle_ignition = ignition_by_machine.get(machine.id, [])
+            lifecycle_rolling = rolling_by_machine.get(machine.id, [])
+            machine_schedules = schedules_by_machine.get(machine.id, [])
+
+            disks = [{"path": disk.path, "size-bytes": disk.size} for disk in disks_by_machine.get(machine.id, [])]
+
+            row['LastState'] = machine_states[0].state_name if machine_states else None
+            row['FQDN'] = machine_interfaces[0].fqdn if machine_interfaces else None
+            row['CIDR'] = machine_interfaces[0].cidrv4 if machine_interfaces else None
+            row['MAC'] = machine_interfaces[0].mac if machine_interfaces else None
+            row['Roles'] = ",".join([r.role for r in machine_schedules])
+            row['DiskProfile'] = sync.ConfigSyncSchedules.compute_disks_size(disks)
+            row['LastReport'] = lifecycle_ignition[0].updated_date if lifecycle_ignition else None
+            row['UpToDate'] = lifecycle_ignition[0].up_to_date if lifecycle_ignition else None
+            row['LastChange'] = lifecycle_ignition[0].last_change_date if lifecycle_ignition else None
+            row['UpdateStrategy'] = lifecycle_rolling[0].strategy if lifecycle_rolling and lifecycle_rolling[
+                0].enable else "Disable"
+
+            data.append(row)
+
+        return data
+
     def get_machines_overview(self):
         """
-        TODO refactor this ugly stuff
-        :return:
+        Fetch each table once and join them in memory with indexes keyed on machine_id / machine_mac
+        :return: list of dict
         """
         with session_commit(sess_maker=self.__sess_maker) as session:
-            # Fetching data
-            mis = session.query(MachineInterface).filter(MachineInterface.as_boot == True).all()
-            mds = session.query(MachineDisk).all()
-            mss = session.query(MachineCurrentState).all()
-            lis = session.query(LifecycleIgnition).all()
-            lrs = session.query(LifecycleRolling).all()
-            srs = session.query(Schedule).all()
-
-            data = list()
-            for machine in session.query(Machine):
-                row = dict()
-
-                # Filtering data
-                machine_disks = [md for md in mds if md.machine_id == machine.id]
-                machine_interfaces = [mi for mi in mis if mi.machine_id == machine.id]
-
-                # MachineInterface
-                booting_mac = ""
-                for i in mis:
-                    if i.as_boot is True:
-                        machine_interfaces.append(i)
-                        booting_mac = i.mac
-
-                machine_states = [ms for ms in mss if ms.machine_mac == booting_mac]
-                lifecycle_ignition = [li for li in lis if li.machine_id == machine.id]
-                lifecycle_rolling = [lr for lr in lrs if lr.machine_id == machine.id]
-                machine_schedules = [sr for sr in srs if sr.machine_id == machine.id]
-
-                # Processing data
-                disks = list()
-                if machine_disks:
-                    for disk in machine_disks:
-                        disks.append({
-                            "path": disk.path,
-                            "size-bytes": disk.size
-                        })
-
-                # Adding data
-                row['LastState'] = machine_states[0].state_name if machine_states else None
-                row['FQDN'] = machine_interfaces[0].fqdn if machine_interfaces else None
-                row['CIDR'] = machine_interfaces[0].cidrv4 if machine_interfaces else None
-                row['MAC'] = machine_interfaces[0].mac if machine_interfaces else None
-                row['Roles'] = ",".join([r.role for r in machine_schedules])
-                row['DiskProfile'] = sync.ConfigSyncSchedules.compute_disks_size(disks)
-                row['LastReport'] = lifecycle_ignition[0].updated_date if lifecycle_ignition else None
-                row['UpToDate'] = lifecycle_ignition[0].up_to_date if lifecycle_ignition else None
-                row['LastChange'] = lifecycle_ignition[0].last_change_date if lifecycle_ignition else None
-                row['UpdateStrategy'] = lifecycle_rolling[0].strategy if lifecycle_rolling and lifecycle_rolling[
-                    0].enable else "Disable"
-
-                data.append(row)
+            return self._build_overview(
+                machines=session.query(Machine).all(),
+                mis=session.query(MachineInterface).filter(MachineInterface.as_boot == True).all(),
+                mds=session.query(MachineDisk).all(),
+                mss=session.query(MachineCurrentState).all(),
+                lis=session.query(LifecycleIgnition).all(),
+                lrs=session.query(LifecycleRolling).all(),
+                srs=session.query(Schedule).all(),
+            )
 
-        return data
+    def iter_machines_overview(self, after=None, limit=None):
+        """
+        Stream the overview ordered by machine id, batch by batch
+        Only the rows attached to the machines of the current batch are fetched
+        :param after: machine id to start after, the cursor
+        :param limit: max number of machines, None for all
+        :return: generator of (machine id, overview row)
+        """
+        with session_commit(sess_maker=self.__sess_maker) as session:
+            for machines in iter_by_keyset(session.query(Machine), Machine.id, after=after, limit=limit):
+                ids = [m.id for m in machines]
+                mis = session.query(MachineInterface) \
+                    .filter(MachineInterface.as_boot == True, MachineInterface.machine_id.in_(ids)) \
+                    .all()
+                macs = [mi.mac for mi in mis]
+                rows = self._build_overview(
+                    machines=machines,
+                    mis=mis,
+                    mds=session.query(MachineDisk).filter(MachineDisk.machine_id.in_(ids)).all(),
+                    mss=session.query(MachineCurrentState).filter(
+                        MachineCurrentState.machine_mac.in_(macs)).all() if macs else [],
+                    lis=session.query(LifecycleIgnition).filter(LifecycleIgnition.machine_id.in_(ids)).all(),
+                    lrs=session.query(LifecycleRolling).filter(LifecycleRolling.machine_id.in_(ids)).all(),
+                    srs=session.query(Schedule).filter(Schedule.machine_id.in_(ids)).all(),
+                )
+                for machine_id, row in zip(ids, rows):
+                    yield machine_id, row
@@ -1,26 +1,81 @@
 import logging
+import os
 import time
 
 import requests
-from flask import Flask, request, json, jsonify, render_template, Response, make_response
+from flask import Flask, request, json, jsonify, render_template, Response, make_response, stream_with_context, \
+    safe_join, send_from_directory
 from sqlalchemy.orm import sessionmaker
 from werkzeug.contrib.cache import BaseCache
 
 from enjoliver import crud, ops, tools
+from enjoliver.cache import LRUCache
 from enjoliver.configs import EnjoliverConfig
 from enjoliver.db import session_commit
+from enjoliver.events import EventLog
+from enjoliver.matchbox import MatchboxClient, IgnitionRenderCache, ignition_digest
 from enjoliver.model import MachineStates, ScheduleRoles
 from enjoliver.repositories.registry import RepositoryRegistry
 
 logger = logging.getLogger(__name__)
 
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# conditional and partial requests of the assets are passed through matchbox
+ASSETS_REQUEST_HEADERS = ["Range", "If-Range", "If-None-Match", "If-Modified-Since"]
+ASSETS_RESPONSE_HEADERS = ["Content-Length", "Content-Range", "Accept-Ranges", "ETag", "Last-Modified"]
+
+
+def _get_pagination():
+    """
+    Parse the cursor based pagination of the current request: ?limit=<int>&after=<machine id>
+    :return: tuple (after, limit), each one is None when not given
+    """
+    after, limit = request.args.get("after"), request.args.get("limit")
+    after = int(after) if after is not None else None
+    limit = int(limit) if limit is not None else None
+    if limit is not None and limit < 1:
+        raise ValueError("limit must be a positive integer: %d" % limit)
+    return after, limit
+
+
+def _wants_ndjson():
+    return request.args.get("format") == "ndjson" or request.accept_mimetypes.best == NDJSON_MIMETYPE
+
+
+def _ndjson_response(rows):
+    """
+    Stream one JSON document per line
+    :param rows: generator of (cursor, data)
+    :return: streamed Response
+    """
+    return Response(stream_with_context("%s\n" % json.dumps(data) for _, data in rows), mimetype=NDJSON_MIMETYPE)
+
+
+def _page_response(rows, limit):
+    """
+    Build the JSON list of a page, the cursor of the next page is given in the X-Next-After header
+    :param rows: generator of (cursor, data)
+    :param limit: the requested page size
+    :return: Response
+    """
+    data, last = [], None
+    for last, row in rows:
+        data.append(row)
+    resp = make_response(jsonify(data))
+    if limit is not None and len(data) == limit:
+        resp.headers["X-Next-After"] = "%s" % last
+    return resp
+
 
 def register_routes(
         app: Flask,
         ec: EnjoliverConfig,
         cache: BaseCache,
         sess_maker: sessionmaker,
-        registry: RepositoryRegistry):
+        registry: RepositoryRegistry,
+        render_cache: BaseCache = None,
+        events_cache: BaseCache = None):
     """
     Register all of the routes. Functions are sorted by alphabetical order, uri of the route being the key.
 
@@ -29,7 +84,21 @@ def register_routes(
     :param cache: the werkzeug cache instance
     :param sess_maker: the DB session factory
     :param registry: the service registry
+    :param render_cache: the werkzeug cache instance of the ignition renders, None for one in the process
+    :param events_cache: the werkzeug cache instance of the events, None for one in the process
     """
+    matchbox = MatchboxClient.from_config(ec)
+    if render_cache is None:
+        # the keys are the digests of the renders: a copy by worker stays right
+        render_cache = LRUCache(threshold=ec.ignition_cache_threshold)
+    ignition_cache = IgnitionRenderCache(ec.matchbox_path, render_cache, matchbox, ttl=ec.ignition_cache_ttl)
+    if events_cache is None:
+        events_cache = LRUCache(threshold=EventLog.cache_threshold)
+    # each worker has its own lru cache
+    events = EventLog(events_cache,
+                      shared=getattr(events_cache, "backend", None) != "lru" or int(ec.gunicorn_workers) == 1)
+    # a sync worker waiting on /events can't serve the machines booting
+    events_long_poll_sec = ec.events_long_poll_sec if ec.gunicorn_worker_type != "sync" else 0
 
     @app.errorhandler(404)
     def not_found(error):
@@ -73,13 +142,38 @@ def register_routes(
                 type: string
         """
         app.logger.info("%s %s" % (request.method, request.url))
+        if ec.assets_serve_local and path and os.path.isfile(safe_join(ec.matchbox_assets, path)):
+            if ec.assets_x_accel_redirect:
+                resp = Response(mimetype="application/octet-stream")
+                resp.headers["X-Accel-Redirect"] = "%s/%s" % (ec.assets_x_accel_redirect.rstrip("/"), path)
+                return resp
+            # the wsgi.file_wrapper of gunicorn uses sendfile
+            return send_from_directory(ec.matchbox_assets, path, mimetype="application/octet-stream",
+                                       conditional=True)
+
         matchbox_uri = app.config.get("MATCHBOX_URI")
         if matchbox_uri:
             url = "%s/assets/%s" % (matchbox_uri, path)
-            matchbox_resp = requests.get(url)
-            resp = matchbox_resp.content
-            matchbox_resp.close()
-            return Response(response=resp, mimetype="application/octet-stream")
+            headers = {k: request.headers[k] for k in ASSETS_REQUEST_HEADERS if k in request.headers}
+            try:
+                matchbox_resp = matchbox.get(url, "/assets", headers=headers, stream=True)
+            except requests.RequestException as e:
+                app.logger.error("fail to query matchbox assets %s" % e)
+                return Response("matchbox doesn't respond", status=502, mimetype="text/plain")
+
+            def chunks():
+                try:
+                    for chunk in matchbox_resp.iter_content(chunk_size=ec.assets_chunk_kb * 1024):
+                        yield chunk
+                finally:
+                    matchbox_resp.close()
+
+            resp = Response(stream_with_context(chunks()), status=matchbox_resp.status_code,
+                            mimetype="application/octet-stream")
+            for k in ASSETS_RESPONSE_HEADERS:
+                if k in matchbox_resp.headers:
+                    resp.headers[k] = matchbox_resp.headers[k]
+            return resp
 
         return Response("matchbox=%s" % matchbox_uri, status=404, mimetype="text/plain")
 
@@ -179,9 +273,16 @@ def register_routes(
             return err
 
         try:
-            new = registry.discovery.upsert(discovery_data)
-            registry.machine_state.update(discovery_data["boot-info"]["mac"], MachineStates.discovery)
+            if registry.discovery.is_unchanged(discovery_data):
+                return jsonify({"new-discovery": False}), 200
+
+            with session_commit(sess_maker=sess_maker) as session:
+                new = registry.discovery.upsert(discovery_data, session)
+                # written now: the next is_unchanged reads it
+                registry.machine_state.update_many({discovery_data["boot-info"]["mac"]: MachineStates.discovery},
+                                                   session)
             cache.delete(request.path)
+            events.publish("discovery", macs=[discovery_data["boot-info"]["mac"]])
             return jsonify({"new-discovery": new}), 200
         except TypeError as e:
             logger.error("fail to store discovery data: %s -> %s" % (request.get_data(), e))
@@ -195,18 +296,129 @@ def register_routes(
         ---
         tags:
           - discovery
+        parameters:
+          - name: limit
+            in: query
+            description: max number of machines in the page, the cursor of the next page is in X-Next-After
+            required: false
+            type: integer
+          - name: after
+            in: query
+            description: machine id cursor, start the page after this machine
+            required: false
+            type: integer
+          - name: format
+            in: query
+            description: ndjson to stream one machine per line
+            required: false
+            type: string
         responses:
           200:
             description: Discovery data
             schema:
                 type: list
+          406:
+            description: Incorrect pagination
+            schema:
+                type: dict
         """
+        try:
+            after, limit = _get_pagination()
+        except ValueError as e:
+            return jsonify({"message": "%s" % e}), 406
+
+        if _wants_ndjson():
+            return _ndjson_response(registry.discovery.iter_discovery(after=after, limit=limit))
+        if after is not None or limit is not None:
+            return _page_response(registry.discovery.iter_discovery(after=after, limit=limit), limit)
+
         all_data = cache.get(request.path)
         if not all_data:
             all_data = registry.discovery.fetch_all_discovery()
             cache.set(request.path, all_data, timeout=30)
         return jsonify(all_data)
 
+    @app.route('/discovery/batch', methods=['POST'])
+    def record_discovery_data_batch():
+        """
+        Discovery
+        Report the current facts of many machines in one transaction
+        ---
+        tags:
+          - discovery
+        responses:
+          200:
+            description: If each machine is new, in the order of the posted list
+            schema:
+                type: dict
+          406:
+            description: Incorrect body content, nothing is recorded
+            schema:
+                type: list
+        """
+        app.logger.info("%s %s" % (request.method, request.url))
+        err = jsonify([{u'boot-info': {}, u'lldp': {}, u'interfaces': [], u"disks": []}]), 406
+        try:
+            discovery_list = json.loads(request.get_data())
+            if type(discovery_list) is not list:
+                raise TypeError("%s is not a list" % type(discovery_list))
+            macs = [k["boot-info"]["mac"] for k in discovery_list]
+        except (KeyError, TypeError, ValueError):
+            logger.error("fail to parse discovery batch data: %s" % request.get_data())
+            return err
+
+        try:
+            with session_commit(sess_maker=sess_maker) as session:
+                new = registry.discovery.upsert_many(discovery_list, session)
+                registry.machine_state.update_many({mac: MachineStates.discovery for mac in macs}, session)
+            cache.delete("/discovery")
+            events.publish("discovery", macs=macs)
+            return jsonify({"new-discovery": new, "total": len(new)}), 200
+        except TypeError as e:
+            logger.error("fail to store discovery batch data: %s -> %s" % (request.get_data(), e))
+            return err
+
+    @app.route('/events', methods=['GET'])
+    def get_events():
+        """
+        Events
+        Long poll the changes of the discovery data and of the schedules
+        ---
+        tags:
+          - ops
+        parameters:
+          - name: since
+            in: query
+            description: the last sequence number known, answer without waiting when absent
+            required: false
+            type: integer
+          - name: timeout
+            in: query
+            description: max seconds to wait for a change, capped by events_long_poll_sec
+            required: false
+            type: number
+        responses:
+          200:
+            description: The current sequence number and the events after since
+            schema:
+                type: dict
+          406:
+            description: Incorrect query
+            schema:
+                type: dict
+        """
+        try:
+            since = request.args.get("since")
+            since = int(since) if since is not None else None
+            timeout = min(float(request.args.get("timeout", 0)), events_long_poll_sec)
+        except ValueError as e:
+            return jsonify({"message": "%s" % e}), 406
+
+        if since is None:
+            return jsonify({"seq": events.seq(), "events": []})
+        seq = events.wait(since, timeout)
+        return jsonify({"seq": seq, "events": events.since(since, seq) if seq > since else []})
+
     @app.route('/healthz', methods=['GET'])
     def healthz():
         """
@@ -221,7 +433,7 @@ def register_routes(
             schema:
                 type: dict
         """
-        data = ops.healthz(app, sess_maker, request)
+        data = ops.healthz(app, sess_maker, request, matchbox)
         res = jsonify(data), 503 if data["global"] is False else 200
         resp = make_response(res)
         resp.headers['Access-Control-Allow-Origin'] = '*'
@@ -265,12 +477,9 @@ def register_routes(
         matchbox_uri = app.config.get("MATCHBOX_URI")
         if matchbox_uri:
             try:
-                # remove the -pxe from the path because matchbox only serve /ignition
-                path = request.full_path.replace("/ignition-pxe?", "/ignition?")
-                matchbox_resp = requests.get("%s%s" % (matchbox_uri, path))
-                resp = matchbox_resp.content
-                matchbox_resp.close()
-                return Response(resp, status=matchbox_resp.status_code, mimetype="text/plain")
+                # matchbox only serve /ignition, the -pxe is just dropped
+                status, resp = ignition_cache.get(matchbox_uri, request.query_string.decode(), "/ignition")
+                return Response(resp, status=status, mimetype="text/plain")
             except requests.RequestException as e:
                 app.logger.error("fail to query matchbox ignition %s" % e)
                 return Response("matchbox doesn't respond", status=502, mimetype="text/plain")
@@ -373,10 +582,7 @@ def register_routes(
         """
         app.logger.info("%s %s" % (request.method, request.url))
         try:
-            matchbox_resp = requests.get(
-                "%s%s" % (
-                    app.config["MATCHBOX_URI"],
-                    request.full_path))
+            matchbox_resp = matchbox.get("%s%s" % (app.config["MATCHBOX_URI"], request.full_path), "/ipxe")
             matchbox_resp.close()
             response = matchbox_resp.content.decode()
 
@@ -386,7 +592,7 @@ def register_routes(
 
             return Response(response, status=200, mimetype="text/plain")
 
-        except requests.exceptions.ConnectionError:
+        except requests.RequestException:
             app.logger.warning("404 for /ipxe")
             return "404", 404
 
@@ -458,37 +664,56 @@ def register_routes(
     def submit_lifecycle_ignition(request_raw_query):
         """
         Lifecycle Ignition
+        Compare the ignition of the machine with matchbox: post the ignition or only its digest in the
+        X-Ignition-Digest header, see matchbox.ignition_digest
         ---
         tags:
           - lifecycle
         responses:
           200:
-            description: A JSON of the ignition status
+            description: A JSON of the ignition status, up to date
+          210:
+            description: A JSON of the ignition status, outdated
+          412:
+            description: The digest doesn't match, post the ignition
         """
+        digest = request.headers.get("X-Ignition-Digest")
+        if digest is None or request.get_data():
+            try:
+                digest = ignition_digest(json.loads(request.get_data()))
+            except ValueError:
+                app.logger.error("%s have incorrect content" % request.path)
+                return jsonify({"message": "FlaskValueError"}), 406
+        else:
+            app.logger.debug("%s posted the digest %s" % (request.path, digest))
+
         try:
-            machine_ignition = json.loads(request.get_data())
-        except ValueError:
-            app.logger.error("%s have incorrect content" % request.path)
-            return jsonify({"message": "FlaskValueError"}), 406
-        req = requests.get("%s/ignition?%s" % (ec.matchbox_uri, request_raw_query))
-        try:
-            matchbox_ignition = json.loads(req.content)
-            req.close()
+            up_to_date = digest == ignition_cache.digest(ec.matchbox_uri, request_raw_query, "/lifecycle/ignition")
         except ValueError:
             app.logger.error("%s have incorrect matchbox return" % request.path)
             return jsonify({"message": "MatchboxValueError"}), 406
 
-        with session_commit(sess_maker=sess_maker) as session:
-            try:
+        if not up_to_date and not request.get_data():
+            # the machine can have a different canonical JSON, it posts the full ignition to compare
+            return jsonify({"message": "DigestMismatch"}), 412
+
+        try:
+            mac = tools.get_mac_from_raw_query(request_raw_query)
+            if up_to_date and registry.lifecycle_ignition.bump_up_to_date(mac):
+                return jsonify({"message": "Up-to-date"}), 200
+            if not up_to_date:
+                # a buffered up-to-date report must not overwrite this one
+                registry.lifecycle_ignition.discard(mac)
+
+            with session_commit(sess_maker=sess_maker) as session:
                 inject = crud.InjectLifecycle(session, request_raw_query=request_raw_query)
-                if json.dumps(machine_ignition, sort_keys=True) == json.dumps(matchbox_ignition, sort_keys=True):
-                    inject.refresh_lifecycle_ignition(True)
+                inject.refresh_lifecycle_ignition(up_to_date)
+                if up_to_date:
+                    registry.lifecycle_ignition.remember(inject.mac, inject.machine_id)
                     return jsonify({"message": "Up-to-date"}), 200
-                else:
-                    inject.refresh_lifecycle_ignition(False)
-                    return jsonify({"message": "Outdated"}), 210
-            except AttributeError:
-                return jsonify({"message": "Unknown"}), 406
+                return jsonify({"message": "Outdated"}), 210
+        except AttributeError:
+            return jsonify({"message": "Unknown"}), 406
 
     @app.route("/lifecycle/rolling", methods=["GET"])
     def lifecycle_rolling_all():
@@ -634,7 +859,7 @@ def register_routes(
         """
         matchbox_uri = app.config.get("MATCHBOX_URI")
         if matchbox_uri:
-            matchbox_resp = requests.get("%s%s" % (matchbox_uri, request.full_path))
+            matchbox_resp = matchbox.get("%s%s" % (matchbox_uri, request.full_path), "/metadata")
             resp = matchbox_resp.content
             matchbox_resp.close()
             return Response(resp, status=matchbox_resp.status_code, mimetype="text/plain")
@@ -693,6 +918,7 @@ def register_routes(
 
         registry.machine_schedule.create_schedule(req)
         cache.delete(request.path)
+        events.publish("schedule", macs=[req.get("selector", {}).get("mac")])
         return jsonify(req)
 
     @app.route('/scheduler/<string:role>', methods=['GET'])
@@ -719,6 +945,41 @@ def register_routes(
         data = registry.machine_schedule.get_machines_by_roles(*multi)
         return jsonify(data)
 
+    @app.route('/scheduler/allocate', methods=['POST'])
+    def scheduler_allocate():
+        """
+        Scheduler
+        Allocate available machines to a set of roles until nb machines have these roles, all or nothing
+        Concurrent allocations of the same roles never exceed nb, omit nb to allocate all the available machines
+        ---
+        tags:
+          - scheduler
+        responses:
+          406:
+            description: Incorrect body content
+            schema:
+                type: dict
+          200:
+            description: The number of machines with the roles and the mac addresses allocated by this call
+            schema:
+                type: dict
+        """
+        err = jsonify({u"roles": ScheduleRoles.roles, u"nb": 0}), 406
+        try:
+            req = json.loads(request.get_data())
+            roles, nb = req["roles"], req.get("nb")
+            if type(roles) is not list or not roles or (nb is not None and type(nb) is not int):
+                raise TypeError("roles must be a non empty list and nb an integer: %s" % req)
+            result = registry.machine_schedule.allocate(roles, nb)
+        except (AttributeError, LookupError, TypeError, ValueError) as e:
+            logger.error("fail to allocate: %s -> %s" % (request.get_data(), e))
+            return err
+
+        if result["allocated"]:
+            cache.delete("/scheduler")
+            events.publish("schedule", macs=result["allocated"])
+        return jsonify(result)
+
     @app.route('/scheduler/available', methods=['GET'])
     def get_available_machine():
         """
@@ -736,6 +997,38 @@ def register_routes(
         data = registry.machine_schedule.get_available_machines()
         return jsonify(data)
 
+    @app.route('/scheduler/batch', methods=['POST'])
+    def scheduler_post_batch():
+        """
+        Scheduler
+        Affect the schedules of many machines in one transaction
+        ---
+        tags:
+          - scheduler
+        responses:
+          406:
+            description: Incorrect body content, nothing is scheduled
+            schema:
+                type: list
+          200:
+            description: The roles scheduled for each machine, in the order of the posted list, null if unknown
+            schema:
+                type: list
+        """
+        err = jsonify([{u"roles": ScheduleRoles.roles, u'selector': {u"mac": ""}}]), 406
+        try:
+            req = json.loads(request.get_data())
+            if type(req) is not list:
+                raise TypeError("%s is not a list" % type(req))
+            results = registry.machine_schedule.create_schedules_batch(req)
+        except (LookupError, TypeError, ValueError) as e:
+            logger.error("fail to schedule batch data: %s -> %s" % (request.get_data(), e))
+            return err
+
+        cache.delete("/scheduler")
+        events.publish("schedule", macs=[k["mac"] for k in results if k["roles"]])
+        return jsonify(results)
+
     @app.route('/scheduler/ip-list/<string:role>', methods=['GET'])
     def get_schedule_role_ip_list(role):
         """
@@ -817,9 +1110,19 @@ def register_routes(
 
     @app.route('/ui/view/machine', methods=['GET'])
     def user_view_machine():
-        res = jsonify(registry.user_interface.get_machines_overview())
-        resp = make_response(res)
+        try:
+            after, limit = _get_pagination()
+        except ValueError as e:
+            return jsonify({"message": "%s" % e}), 406
+
+        if _wants_ndjson():
+            resp = _ndjson_response(registry.user_interface.iter_machines_overview(after=after, limit=limit))
+        elif after is not None or limit is not None:
+            resp = _page_response(registry.user_interface.iter_machines_overview(after=after, limit=limit), limit)
+        else:
+            resp = make_response(jsonify(registry.user_interface.get_machines_overview()))
         resp.headers['Access-Control-Allow-Origin'] = '*'
+        resp.headers['Access-Control-Expose-Headers'] = 'X-Next-After'
 
         return resp
 
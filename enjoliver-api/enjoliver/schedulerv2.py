@@ -2,8 +2,11 @@
 Schedule the roles with the given constraints
 """
 import abc
+import collections
+import heapq
 import json
 import logging
+import re
 import time
 
 import requests
@@ -15,21 +18,131 @@ EC = EnjoliverConfig(importer=__file__)
 logger = logging.getLogger(__name__)
 
 
-class CommonScheduler:
+class PlacementPolicy:
     """
-    Base class to create profiles with deps
+    Choose the machines to allocate among the available ones, by the lowest mac
+    Each machine is a dict with: mac, fqdn, chassis (mac of the LLDP chassis or None), disks_size (bytes)
     """
-    apply_deps_tries = EC.apply_deps_tries
-    apply_deps_delay = EC.apply_deps_delay
+    name = "mac"
+    # the order of the available machines query: the repository keeps its LIMIT and skips place
+    by_mac = True
 
-    @staticmethod
-    def fetch_available(api_uri: str):
+    def place(self, candidates: list, scheduled: list, nb: int):
+        """
+        :param candidates: the available machines
+        :param scheduled: the machines already scheduled with the roles
+        :param nb: the number of machines to choose
+        :return: list of the chosen candidates
+        """
+        return heapq.nsmallest(nb, candidates, key=lambda k: k["mac"])
+
+
+class SpreadPlacementPolicy(PlacementPolicy):
+    """
+    Spread the machines over failure domains: each choice is the lowest mac of the least loaded domain, counting the
+    machines already scheduled
+    A machine without domain is its own domain, after the known ones at equal load
+    """
+    name = None
+    by_mac = False
+
+    def domain(self, machine: dict):
+        raise NotImplementedError
+
+    def place(self, candidates: list, scheduled: list, nb: int):
+        load = collections.Counter(self.domain(k) for k in scheduled)
+        by_domain = collections.defaultdict(list)
+        for k in candidates:
+            domain = self.domain(k)
+            by_domain[(0, domain) if domain is not None else (1, k["mac"])].append(k)
+
+        heap = []
+        for key, machines in by_domain.items():
+            # pop the lowest mac from the end
+            machines.sort(key=lambda k: k["mac"], reverse=True)
+            heap.append((load[key[1]] if key[0] == 0 else 0, key))
+        heapq.heapify(heap)
+
+        chosen = []
+        while heap and len(chosen) < nb:
+            nb_in_domain, key = heapq.heappop(heap)
+            machines = by_domain[key]
+            chosen.append(machines.pop())
+            if machines:
+                heapq.heappush(heap, (nb_in_domain + 1, key))
+        return chosen
+
+
+class SpreadByChassisPlacementPolicy(SpreadPlacementPolicy):
+    """
+    Spread over the LLDP chassis: the top of rack switches
+    """
+    name = "spread-chassis"
+
+    def domain(self, machine: dict):
+        return machine["chassis"]
+
+
+class SpreadByRackPlacementPolicy(SpreadPlacementPolicy):
+    """
+    Spread over the racks parsed from the fqdn like ConfigSyncSchedules.get_dns_attr: r13-srv3.dc-1 is the rack 13 of
+    the dc-1
+    """
+    name = "spread-rack"
+
+    def domain(self, machine: dict):
+        labels = (machine["fqdn"] or "").split(".")
+        parts = labels[0].split("-")
+        if len(labels) < 2 or len(parts) != 2:
+            return None
+        rack = re.sub("[^0-9]+", "", parts[0])
+        return "%s/%s" % (labels[1], rack) if rack else None
+
+
+class LargestDiskPlacementPolicy(PlacementPolicy):
+    """
+    Prefer the machines with the largest total disk size, then the lowest mac
+    """
+    name = "largest-disk"
+    by_mac = False
+
+    def place(self, candidates: list, scheduled: list, nb: int):
+        return heapq.nsmallest(nb, candidates, key=lambda k: (-k["disks_size"], k["mac"]))
+
+
+PLACEMENT_POLICIES = {k.name: k for k in [
+    PlacementPolicy,
+    SpreadByChassisPlacementPolicy,
+    SpreadByRackPlacementPolicy,
+    LargestDiskPlacementPolicy,
+]}
+
+
+def get_placement_policy(name: str):
+    """
+    :param name: mac, spread-chassis, spread-rack or largest-disk
+    :return: PlacementPolicy
+    """
+    try:
+        return PLACEMENT_POLICIES[name]()
+    except KeyError:
+        raise LookupError("placement policy %s not in %s" % (name, sorted(PLACEMENT_POLICIES)))
+
+
+class HttpSchedulerBackend:
+    """
+    Schedule through the API
+    """
+
+    def __init__(self, api_uri: str):
+        self.api_uri = api_uri
+
+    def fetch_available(self):
         """
         HTTP Get to the <api_uri>/scheduler/available
-        :param api_uri: str
         :return: list of interfaces
         """
-        query = "%s/scheduler/available" % api_uri
+        query = "%s/scheduler/available" % self.api_uri
         logger.debug("fetch %s" % query)
         try:
             r = requests.get(query)
@@ -41,6 +154,58 @@ class CommonScheduler:
             logger.error("fetch failed: %s" % query)
             return []
 
+    def allocate(self, roles: list, nb=None):
+        """
+        HTTP Post to the <api_uri>/scheduler/allocate
+        :param roles: the roles
+        :param nb: the number of machines expected with the roles, None for every available machine
+        :return: dict(scheduled=the number of machines with the roles, allocated=mac addresses allocated)
+        """
+        r = requests.post("%s/scheduler/allocate" % self.api_uri, data=json.dumps({"roles": roles, "nb": nb}))
+        content = r.content.decode()
+        r.close()
+        if r.status_code != 200:
+            raise ValueError("%s/scheduler/allocate answered %d: %s" % (self.api_uri, r.status_code, content))
+        return json.loads(content)
+
+
+class RepositorySchedulerBackend:
+    """
+    Schedule with the repositories of the API when co-located with its database: no HTTP round-trip and the whole
+    budget is allocated in one transaction
+    The API doesn't publish any event for these schedules, the caller syncs matchbox by itself
+    """
+
+    def __init__(self, registry):
+        """
+        :param registry: enjoliver.repositories.registry.RepositoryRegistry
+        """
+        self.registry = registry
+
+    def fetch_available(self):
+        return self.registry.machine_schedule.get_available_machines()
+
+    def allocate(self, roles: list, nb=None):
+        return self.registry.machine_schedule.allocate(roles, nb)
+
+
+class CommonScheduler:
+    """
+    Base class to create profiles with deps
+    """
+    apply_deps_tries = EC.apply_deps_tries
+    apply_deps_delay = EC.apply_deps_delay
+    backend = None
+
+    @staticmethod
+    def fetch_available(api_uri: str):
+        """
+        HTTP Get to the <api_uri>/scheduler/available
+        :param api_uri: str
+        :return: list of interfaces
+        """
+        return HttpSchedulerBackend(api_uri).fetch_available()
+
     def apply(self):
         """
         Entrypoint to apply the schedule plan
@@ -62,68 +227,29 @@ class CommonScheduler:
         raise RuntimeError("timeout after %d" % (
             self.apply_deps_delay * self.apply_deps_tries))
 
-    def _affect(self, available: dict):
-        mac = available["mac"]
-        r = requests.post("%s/scheduler" % self.api_uri, data=json.dumps(
-            {
-                "roles": self.roles,
-                "selector": {
-                    "mac": mac,
-                }
-            }
-        ))
-        r.close()
-        logger.info("mac:%s roles:%s" % (mac, str(self.roles)))
-        return 1
-
-    def __apply_available_budget(self):
-        available_list = self.fetch_available(self.api_uri)
-        if len(available_list) >= self.expected_nb:
-            logger.info("starting...")
-            available_list.sort(key=lambda k: k["mac"])
-            for i in range(self.expected_nb):
-                self._affect(available_list[i])
-            return True
-
-        else:
-            logger.info("not enough item %d/%d" % (len(available_list), self.expected_nb))
-            return False
-
     def _apply_budget(self):
-        url = "%s/scheduler/%s" % (self.api_uri, "&".join(self.roles))
         try:
-            r = requests.get(url)
-            done = json.loads(r.content.decode())
-            r.close()
-            if len(done) != self.expected_nb:
-                logger.info("%s -> done:%d expected:%d" % ("&".join(self.roles), len(done), self.expected_nb))
-            if len(done) < self.expected_nb:
-                logger.debug("%d < %d" % (len(done), self.expected_nb))
-                return self.__apply_available_budget()
-
-            return True
-        except (requests.exceptions.ConnectionError, ValueError):
-            logger.error("ConnectionError %s" % url)
+            result = self.backend.allocate(self.roles, self.expected_nb)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error("fail to allocate %s: %s" % ("&".join(self.roles), e))
             return False
 
+        if result["scheduled"] != self.expected_nb:
+            logger.info("%s -> done:%d expected:%d" % ("&".join(self.roles), result["scheduled"], self.expected_nb))
+        return result["scheduled"] >= self.expected_nb
+
     def _apply_everything(self):
-        url = "%s/scheduler/%s" % (self.api_uri, "&".join(self.roles))
         try:
-            r = requests.get(url)
-            done = len(json.loads(r.content.decode()))
-            r.close()
-            available_list = self.fetch_available(self.api_uri)
-            available_list.sort(key=lambda k: k["mac"])
-            if available_list:
-                logger.info("%s -> done:%d available:%d" % ("&".join(self.roles), done, len(available_list)))
-            for available in available_list:
-                done += self._affect(available)
-
-            return done
+            result = self.backend.allocate(self.roles)
         except requests.exceptions.ConnectionError:
-            logger.error("ConnectionError %s" % url)
+            logger.error("ConnectionError %s/scheduler/allocate" % self.api_uri)
             return 0
 
+        if result["allocated"]:
+            logger.info("%s -> done:%d allocated:%d" % (
+                "&".join(self.roles), result["scheduled"], len(result["allocated"])))
+        return result["scheduled"]
+
     def _apply_with_retry(self, apply_fn, nb_try: int, seconds_sleep: int):
         for i in range(nb_try):
             try:
@@ -144,9 +270,15 @@ class EtcdMemberKubernetesControlPlane(CommonScheduler):
     __name__ = "".join(roles)
 
     def __init__(self,
-                 api_uri: str):
+                 api_uri: str,
+                 backend=None):
+        """
+        :param api_uri: http://1.1.1.1:5000
+        :param backend: HttpSchedulerBackend or RepositorySchedulerBackend, HTTP to the api_uri by default
+        """
         logger.info("with api_uri %s" % api_uri)
         self.api_uri = api_uri
+        self.backend = backend if backend else HttpSchedulerBackend(api_uri)
 
     def apply(self, nb_try=2, seconds_sleep=0):
         return self._apply_with_retry(self._apply_budget, nb_try=nb_try, seconds_sleep=seconds_sleep)
@@ -159,13 +291,20 @@ class KubernetesNode(CommonScheduler):
 
     def __init__(self,
                  api_uri: str,
-                 apply_dep):
+                 apply_dep,
+                 backend=None):
+        """
+        :param api_uri: http://1.1.1.1:5000
+        :param apply_dep: wait the schedule of the control plane
+        :param backend: HttpSchedulerBackend or RepositorySchedulerBackend, HTTP to the api_uri by default
+        """
         logger.info("with api_uri %s" % api_uri)
         self.api_uri = api_uri
+        self.backend = backend if backend else HttpSchedulerBackend(api_uri)
 
         if apply_dep is True:
             logger.info("applying deps by instancing %s" % EtcdMemberKubernetesControlPlane.__name__)
-            sch_cp = EtcdMemberKubernetesControlPlane(self.api_uri)
+            sch_cp = EtcdMemberKubernetesControlPlane(self.api_uri, self.backend)
             self.apply_dep(sch_cp)
 
     def apply(self, nb_try=2, seconds_sleep=0):
@@ -1,11 +1,14 @@
 """
 Sync the matchbox configuration
 """
+import hashlib
 import json
 import logging
 import os
 import re
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from ipaddress import IPv4Interface
 
 import requests
@@ -19,6 +22,53 @@ EC = EnjoliverConfig(importer=__file__)
 logger = logging.getLogger(__name__)
 
 
+def _group_inputs(job: tuple):
+    """
+    Entry point of the sync_workers processes
+    :param job: the arguments of ConfigSyncSchedules.group_inputs
+    :return: tuple(group id, selector, extra metadata)
+    """
+    return ConfigSyncSchedules.group_inputs(*job)
+
+
+class SyncSnapshot:
+    """
+    The cluster-wide lists of a sync pass: the role lists are fetched once and the derived strings are precomputed,
+    then shared by every machine of the pass, whatever the sync_cache_ttl
+    Only plain attributes: it's sent to the sync_workers processes
+    """
+
+    def __init__(self, etcd_member_ip_list: list, kubernetes_control_plane_ip_list: list):
+        order_http_uri, order_etcd_named = ConfigSyncSchedules.order_http_uri, ConfigSyncSchedules.order_etcd_named
+
+        self.etcd_member_ip_list = sorted(etcd_member_ip_list)
+        self.kubernetes_control_plane_ip_list = sorted(kubernetes_control_plane_ip_list)
+
+        self.kubernetes_etcd_initial_cluster = order_etcd_named(
+            list(self.etcd_member_ip_list), EC.kubernetes_etcd_peer_port, secure=True)
+        self.vault_etcd_initial_cluster = order_etcd_named(
+            list(self.etcd_member_ip_list), EC.vault_etcd_peer_port, secure=True)
+        self.fleet_etcd_initial_cluster = order_etcd_named(
+            list(self.etcd_member_ip_list), EC.fleet_etcd_peer_port, secure=True)
+
+        self.kubernetes_etcd_member_client_uri_list = order_http_uri(
+            list(self.etcd_member_ip_list), EC.kubernetes_etcd_client_port, secure=True)
+        self.vault_etcd_member_client_uri_list = order_http_uri(
+            list(self.etcd_member_ip_list), EC.vault_etcd_client_port, secure=True)
+        self.fleet_etcd_member_client_uri_list = order_http_uri(
+            list(self.etcd_member_ip_list), EC.fleet_etcd_client_port, secure=True)
+
+        self.kubernetes_etcd_member_peer_uri_list = order_http_uri(
+            list(self.etcd_member_ip_list), EC.kubernetes_etcd_peer_port, secure=True)
+        self.vault_etcd_member_peer_uri_list = order_http_uri(
+            list(self.etcd_member_ip_list), EC.vault_etcd_peer_port, secure=True)
+        self.fleet_etcd_member_peer_uri_list = order_http_uri(
+            list(self.etcd_member_ip_list), EC.fleet_etcd_peer_port, secure=True)
+
+        self.kubernetes_control_plane = order_http_uri(
+            list(self.kubernetes_control_plane_ip_list), EC.kubernetes_apiserver_insecure_port)
+
+
 class ConfigSyncSchedules(object):
     __name__ = "ConfigSyncSchedules"
     sub_ips = EC.sub_ips
@@ -42,6 +92,16 @@ class ConfigSyncSchedules(object):
             self._cache_query = SimpleCache(default_timeout=EC.sync_cache_ttl)
         else:
             self._cache_query = NullCache()
+        # fingerprint of the inputs of each group written, to skip the machines unchanged since the last sync
+        self._fingerprints = dict()
+        self._ssh_authorized_keys_version = None
+        self.rewritten, self.skipped = 0, 0
+        self._lock = threading.Lock()
+        self._process_pool = None
+        self._thread_pool = None
+        self._snapshot = None
+        # the writer of the apply in progress, the files are dumped one by one outside of apply
+        self._writer = None
 
     def _reporting_ignitions(self):
         for k, v in self.ignition_dict.items():
@@ -231,14 +291,60 @@ class ConfigSyncSchedules(object):
 
         return ladder[-1][0]
 
+    def take_snapshot(self):
+        """
+        :return: SyncSnapshot of the current role lists
+        """
+        return SyncSnapshot(
+            etcd_member_ip_list=self.etcd_member_ip_list,
+            kubernetes_control_plane_ip_list=self.kubernetes_control_plane_ip_list,
+        )
+
+    def _current_snapshot(self):
+        """
+        :return: the SyncSnapshot of the apply in progress, a new one outside of apply
+        """
+        return self._snapshot if self._snapshot is not None else self.take_snapshot()
+
     def produce_matchbox_data(
             self,
             marker: str,
             i: int,
             m: dict,
             automatic_name: str,
+            update_extra_metadata=None,
+            snapshot=None,
+    ):
+        """
+        :param snapshot: SyncSnapshot of the pass
+        :return: True if the group of the machine is generated, False if skipped as unchanged
+        """
+        group_id, selector, extra_metadata = self.group_inputs(
+            snapshot if snapshot is not None else self._current_snapshot(),
+            self.extra_selector, marker, i, m, automatic_name, update_extra_metadata)
+        return self._write_group(marker, group_id, selector, extra_metadata)
+
+    @staticmethod
+    def group_inputs(
+            cluster: SyncSnapshot,
+            extra_selector: dict,
+            marker: str,
+            i: int,
+            m: dict,
+            automatic_name: str,
             update_extra_metadata=None
     ):
+        """
+        Compute the selector and the metadata of the group of a machine
+        :param cluster: the cluster-wide lists of the pass
+        :param extra_selector: the extra selectors given to matchbox
+        :param marker: the name of the profile
+        :param i: the index of the machine in its role
+        :param m: the machine
+        :param automatic_name: the name of the machine without fqdn
+        :param update_extra_metadata: the metadata of the role
+        :return: tuple(group id, selector, extra metadata)
+        """
         fqdn = automatic_name
         try:
             if m["fqdn"]:
@@ -247,17 +353,17 @@ class ConfigSyncSchedules(object):
             logger.warning("%s for %s" % (e, m["mac"]))
 
         etc_hosts = [k for k in EC.etc_hosts]
-        dns_attr = self.get_dns_attr(fqdn)
+        dns_attr = ConfigSyncSchedules.get_dns_attr(fqdn)
         etc_hosts.append("127.0.1.1 %s %s" % (fqdn, dns_attr["shortname"]))
-        cni_attr = self._cni_ipam(m["cidrv4"], m["gateway"])
+        cni_attr = ConfigSyncSchedules._cni_ipam(m["cidrv4"], m["gateway"])
         extra_metadata = {
             "etc_hosts": etc_hosts,
             # Etcd
             "etcd_name": m["ipv4"],
 
-            "kubernetes_etcd_initial_cluster": self.kubernetes_etcd_initial_cluster,
-            "vault_etcd_initial_cluster": self.vault_etcd_initial_cluster,
-            "fleet_etcd_initial_cluster": self.fleet_etcd_initial_cluster,
+            "kubernetes_etcd_initial_cluster": cluster.kubernetes_etcd_initial_cluster,
+            "vault_etcd_initial_cluster": cluster.vault_etcd_initial_cluster,
+            "fleet_etcd_initial_cluster": cluster.fleet_etcd_initial_cluster,
 
             "kubernetes_etcd_initial_advertise_peer_urls": "https://%s:%d" % (
                 m["ipv4"], EC.kubernetes_etcd_peer_port),
@@ -266,9 +372,9 @@ class ConfigSyncSchedules(object):
             "fleet_etcd_initial_advertise_peer_urls": "https://%s:%d" % (
                 m["ipv4"], EC.fleet_etcd_peer_port),
 
-            "kubernetes_etcd_member_client_uri_list": ",".join(self.kubernetes_etcd_member_client_uri_list),
-            "vault_etcd_member_client_uri_list": ",".join(self.vault_etcd_member_client_uri_list),
-            "fleet_etcd_member_client_uri_list": ",".join(self.fleet_etcd_member_client_uri_list),
+            "kubernetes_etcd_member_client_uri_list": ",".join(cluster.kubernetes_etcd_member_client_uri_list),
+            "vault_etcd_member_client_uri_list": ",".join(cluster.vault_etcd_member_client_uri_list),
+            "fleet_etcd_member_client_uri_list": ",".join(cluster.fleet_etcd_member_client_uri_list),
 
             "kubernetes_etcd_data_dir": EC.kubernetes_etcd_data_dir,
             "vault_etcd_data_dir": EC.vault_etcd_data_dir,
@@ -292,13 +398,13 @@ class ConfigSyncSchedules(object):
             "kubernetes_service_cluster_ip_range": EC.kubernetes_service_cluster_ip_range,
 
             # Vault are located with the etcd members
-            "vault_ip_list": ",".join(self.etcd_member_ip_list),
+            "vault_ip_list": ",".join(cluster.etcd_member_ip_list),
             "vault_port": EC.vault_port,
 
             "kubelet_healthz_port": EC.kubelet_healthz_port,
 
-            "etcd_member_kubernetes_control_plane_ip_list": ",".join(self.etcd_member_ip_list),
-            "etcd_member_kubernetes_control_plane_ip": self.etcd_member_ip_list,
+            "etcd_member_kubernetes_control_plane_ip_list": ",".join(cluster.etcd_member_ip_list),
+            "etcd_member_kubernetes_control_plane_ip": cluster.etcd_member_ip_list,
 
             "hyperkube_image_url": EC.hyperkube_image_url,
             "cephtools_image_url": EC.cephtools_image_url,
@@ -320,54 +426,91 @@ class ConfigSyncSchedules(object):
             "fallbackntp": " ".join(EC.fallbackntp),
             "vault_polling_sec": EC.vault_polling_sec,
             "lifecycle_update_polling_sec": EC.lifecycle_update_polling_sec,
-            "disk_profile": self.compute_disks_size(m["disks"]),
+            "disk_profile": ConfigSyncSchedules.compute_disks_size(m["disks"]),
 
         }
         selector = {"mac": m["mac"]}
-        selector.update(self.get_extra_selectors(self.extra_selector))
+        selector.update(ConfigSyncSchedules.get_extra_selectors(extra_selector))
         if update_extra_metadata:
             extra_metadata.update(update_extra_metadata)
+        group_id = "%s-%d" % (marker, i)  # one per machine
+        return group_id, selector, extra_metadata
+
+    def _write_group(self, marker: str, group_id: str, selector: dict, extra_metadata: dict, dump_profile=True):
+        """
+        Generate the group and the profile of a machine, unless the inputs are the same as the last written
+        :return: True if generated
+        """
+        ignition_id = "%s.yaml" % self.ignition_dict[marker]
+
+        if self._ssh_authorized_keys_version is None:
+            self._ssh_authorized_keys_version = self._get_ssh_authorized_keys_version()
+        fingerprint = hashlib.sha256(json.dumps(
+            [self.api_uri, marker, ignition_id, selector, extra_metadata, self._ssh_authorized_keys_version],
+            sort_keys=True).encode()).hexdigest()
+        if self._fingerprints.get(group_id) == fingerprint and \
+                os.path.isfile("%s/groups/%s.json" % (self.matchbox_path, group_id)):
+            with self._lock:
+                self.skipped += 1
+            return False
+
         gen = generator.Generator(
             api_uri=self.api_uri,
-            group_id="%s-%d" % (marker, i),  # one per machine
+            group_id=group_id,
             profile_id=marker,  # link to ignition
             name=marker,
-            ignition_id="%s.yaml" % self.ignition_dict[marker],
+            ignition_id=ignition_id,
             matchbox_path=self.matchbox_path,
             selector=selector,
             extra_metadata=extra_metadata,
         )
-        gen.dumps()
+        if dump_profile:
+            gen.profile.dump(self._writer)
+        gen.group.dump(self._writer)
+        with self._lock:
+            self._fingerprints[group_id] = fingerprint
+            self.rewritten += 1
+        return True
+
+    def _get_ssh_authorized_keys_version(self):
+        """
+        The keys read by GenerateGroup are an input of every group
+        :return: list of (name, mtime, size) of the ssh authorized keys
+        """
+        directory = "%s/ssh_authorized_keys" % self.matchbox_path
+        if os.path.isdir(directory) is False:
+            return []
+        version = []
+        for k in sorted(os.listdir(directory)):
+            st = os.stat("%s/%s" % (directory, k))
+            version.append((k, st.st_mtime_ns, st.st_size))
+        return version
 
     def etcd_member_kubernetes_control_plane(self):
         marker = self.etcd_member_kubernetes_control_plane.__name__
         roles = schedulerv2.EtcdMemberKubernetesControlPlane.roles
 
         machine_roles = self._query_roles(*roles)
-        for i, m in enumerate(machine_roles):
-            update_md = {
-                # Roles
-                "roles": ",".join(roles),
-                # Etcd Members
-                "kubernetes_etcd_member_peer_uri_list": ",".join(self.kubernetes_etcd_member_peer_uri_list),
-                "vault_etcd_member_peer_uri_list": ",".join(self.vault_etcd_member_peer_uri_list),
-                "fleet_etcd_member_peer_uri_list": ",".join(self.fleet_etcd_member_peer_uri_list),
-
-                "kubernetes_etcd_peer_port": EC.kubernetes_etcd_peer_port,
-                "vault_etcd_peer_port": EC.vault_etcd_peer_port,
-                "fleet_etcd_peer_port": EC.fleet_etcd_peer_port,
-
-                # K8s Control Plane
-                "kubernetes_apiserver_count": len(machine_roles),
-                "kubernetes_apiserver_insecure_bind_address": EC.kubernetes_apiserver_insecure_bind_address,
-            }
-            self.produce_matchbox_data(
-                marker=marker,
-                i=i,
-                m=m,
-                automatic_name="cp-%d-%s" % (i, m["ipv4"].replace(".", "-")),
-                update_extra_metadata=update_md,
-            )
+        snapshot = self._current_snapshot()
+        update_md = {
+            # Roles
+            "roles": ",".join(roles),
+            # Etcd Members
+            "kubernetes_etcd_member_peer_uri_list": ",".join(snapshot.kubernetes_etcd_member_peer_uri_list),
+            "vault_etcd_member_peer_uri_list": ",".join(snapshot.vault_etcd_member_peer_uri_list),
+            "fleet_etcd_member_peer_uri_list": ",".join(snapshot.fleet_etcd_member_peer_uri_list),
+
+            "kubernetes_etcd_peer_port": EC.kubernetes_etcd_peer_port,
+            "vault_etcd_peer_port": EC.vault_etcd_peer_port,
+            "fleet_etcd_peer_port": EC.fleet_etcd_peer_port,
+
+            # K8s Control Plane
+            "kubernetes_apiserver_count": len(machine_roles),
+            "kubernetes_apiserver_insecure_bind_address": EC.kubernetes_apiserver_insecure_bind_address,
+        }
+        self._produce_all(marker, [
+            (i, m, "cp-%d-%s" % (i, m["ipv4"].replace(".", "-"))) for i, m in enumerate(machine_roles)
+        ], update_md, snapshot)
         logger.info("synced %d" % len(machine_roles))
         return len(machine_roles)
 
@@ -376,21 +519,99 @@ class ConfigSyncSchedules(object):
         roles = schedulerv2.KubernetesNode.roles
 
         machine_roles = self._query_roles(*roles)
-        for i, m in enumerate(machine_roles):
-            update_md = {
-                # Roles
-                "roles": ",".join(roles),
-            }
-            self.produce_matchbox_data(
-                marker=marker,
-                i=i,
-                m=m,
-                automatic_name="no-%d-%s" % (i, m["ipv4"].replace(".", "-")),
-                update_extra_metadata=update_md,
-            )
+        update_md = {
+            # Roles
+            "roles": ",".join(roles),
+        }
+        self._produce_all(marker, [
+            (i, m, "no-%d-%s" % (i, m["ipv4"].replace(".", "-"))) for i, m in enumerate(machine_roles)
+        ], update_md, self._current_snapshot())
         logger.info("synced %d" % len(machine_roles))
         return len(machine_roles)
 
+    def _produce_all(self, marker: str, machines: list, update_extra_metadata: dict, snapshot: SyncSnapshot):
+        """
+        Produce the matchbox data of the machines of a role
+        With sync_workers > 1 the metadata are computed by a pool of processes, and the groups are written by a pool
+        of sync_write_threads threads
+        :param marker: the name of the profile
+        :param machines: list of tuple(index, machine, automatic name)
+        :param update_extra_metadata: the metadata of the role
+        :param snapshot: SyncSnapshot of the pass
+        :return:
+        """
+        if EC.sync_workers <= 1 or len(machines) < 2:
+            for i, m, automatic_name in machines:
+                self.produce_matchbox_data(marker, i, m, automatic_name, update_extra_metadata, snapshot)
+            return
+
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(EC.sync_workers)
+            self._thread_pool = ThreadPoolExecutor(EC.sync_write_threads)
+
+        jobs = [(snapshot, self.extra_selector, marker, i, m, automatic_name, update_extra_metadata)
+                for i, m, automatic_name in machines]
+        inputs = self._process_pool.map(_group_inputs, jobs, chunksize=len(jobs) // (EC.sync_workers * 4) + 1)
+
+        # the profile is the same for all the machines of the role
+        generator.GenerateProfile(
+            api_uri=self.api_uri,
+            _id=marker,
+            name=marker,
+            ignition_id="%s.yaml" % self.ignition_dict[marker],
+            matchbox_path=self.matchbox_path,
+        ).dump(self._writer)
+        # raise the first exception of the writes
+        list(self._thread_pool.map(lambda k: self._write_group(marker, *k, dump_profile=False), inputs))
+
+    def collect_garbage(self, marker: str, nb: int):
+        """
+        Remove the groups <marker>-<i>.json of the machines no longer scheduled in the role
+        Nothing is removed when the role is empty: a transient empty answer of the API would remove the whole role
+        :param marker: the name of the profile
+        :param nb: the number of machines in the role
+        :return: the number of groups removed
+        """
+        groups_path = "%s/groups" % self.matchbox_path
+        pattern = re.compile(r"^%s-(\d+)\.json$" % re.escape(marker))
+        stale = []
+        for name in os.listdir(groups_path):
+            match = pattern.match(name)
+            if match is not None and int(match.group(1)) >= nb:
+                stale.append(name)
+        if nb == 0 and stale:
+            logger.error("no machine in %s: keep its %d groups, remove them by hand if it's expected" % (
+                marker, len(stale)))
+            return 0
+
+        removed = 0
+        for name in stale:
+            os.remove("%s/%s" % (groups_path, name))
+            self._fingerprints.pop(name[:-len(".json")], None)
+            logger.info("removed: %s/%s" % (groups_path, name))
+            removed += 1
+        if removed:
+            os.utime(groups_path)
+        return removed
+
+    def close(self):
+        """
+        Stop the pools of the parallel sync
+        :return:
+        """
+        if self._process_pool is not None:
+            self._process_pool.shutdown()
+            self._thread_pool.shutdown()
+            self._process_pool, self._thread_pool = None, None
+
+    def clear_cache(self):
+        """
+        Forget the http queries cached for sync_cache_ttl, before a sync triggered by a change
+        The fingerprints are kept: they are computed on the fresh queries
+        :return:
+        """
+        self._cache_query.clear()
+
     def notify(self):
         """
         TODO if we need to notify the API for any reason
@@ -403,15 +624,32 @@ class ConfigSyncSchedules(object):
     def apply(self, nb_try=2, seconds_sleep=0):
         logger.info("start syncing...")
         for i in range(nb_try):
+            self.rewritten, self.skipped = 0, 0
+            self._ssh_authorized_keys_version = self._get_ssh_authorized_keys_version()
             try:
-                nb = self.etcd_member_kubernetes_control_plane()
-                nb += self.kubernetes_nodes()
+                self._snapshot = self.take_snapshot()
+                self._writer = generator.BatchWriter(self.matchbox_path, fsync=EC.sync_fsync)
+                nb_control_plane = self.etcd_member_kubernetes_control_plane()
+                nb_nodes = self.kubernetes_nodes()
+                self._writer.commit()
+                removed = self.collect_garbage(self.etcd_member_kubernetes_control_plane.__name__, nb_control_plane)
+                removed += self.collect_garbage(self.kubernetes_nodes.__name__, nb_nodes)
                 self.notify()
+                nb = nb_control_plane + nb_nodes
+                logger.info("synced %d machines: %d rewritten, %d skipped unchanged, %d removed" % (
+                    nb, self.rewritten, self.skipped, removed))
                 return nb
             except Exception as e:
                 logger.error("fail to apply the sync %s %s" % (type(e), e))
+                # the fingerprints of the groups staged and not committed don't match the disk
+                self._fingerprints.clear()
                 if i + 1 == nb_try:
                     raise
+            finally:
+                self._snapshot = None
+                if self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
 
             logger.warning("retry %d/%d in %d s" % (i + 1, nb_try, seconds_sleep))
             time.sleep(seconds_sleep)
@@ -1,6 +1,9 @@
 import logging
 import socket
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 
 from enjoliver.configs import EnjoliverConfig
 
@@ -25,46 +28,138 @@ def get_mac_from_raw_query(request_raw_query: str):
     return mac.replace("-", ":")
 
 
+class ReverseDNSResolver:
+    """
+    Reverse DNS lookups run in a thread pool, the names are kept in a TTL + LRU cache.
+    The failed lookups are cached too, during negative_ttl.
+    A lookup slower than the caller's deadline keeps running and fills the cache when it ends.
+    """
+
+    def __init__(self, max_workers=8, ttl=300, negative_ttl=30, max_size=4096, lookup=socket.gethostbyaddr):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._lookup = lookup
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._cache = OrderedDict()
+        self._pending = dict()
+        self._lock = threading.Lock()
+
+    def _resolve(self, ipv4: str):
+        try:
+            name, ttl = self._lookup(ipv4)[0], self.ttl
+            logger.debug("succeed to make dns request for %s:%s" % (ipv4, name))
+        except OSError as e:
+            logger.error("fail to make dns request for %s: %s" % (ipv4, e))
+            name, ttl = None, self.negative_ttl
+
+        with self._lock:
+            self._cache[ipv4] = (time.monotonic() + ttl, name)
+            self._cache.move_to_end(ipv4)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+            self._pending.pop(ipv4, None)
+        return name
+
+    def submit(self, ipv4: str) -> Future:
+        """
+        :param ipv4:
+        :return: Future of the name, None if the lookup failed
+        """
+        with self._lock:
+            cached = self._cache.get(ipv4)
+            if cached and cached[0] > time.monotonic():
+                self._cache.move_to_end(ipv4)
+                future = Future()
+                future.set_result(cached[1])
+                return future
+
+            future = self._pending.get(ipv4)
+            if future is None:
+                future = self._executor.submit(self._resolve, ipv4)
+                self._pending[ipv4] = future
+            return future
+
+    def resolve_many(self, ipv4_list: list, deadline: float):
+        """
+        Resolve concurrently
+        :param ipv4_list:
+        :param deadline: seconds to wait for all the lookups
+        :return: dict of name by ipv4, the lookups still running after the deadline are missing
+        """
+        futures = {ipv4: self.submit(ipv4) for ipv4 in set(ipv4_list)}
+        wait(futures.values(), timeout=deadline)
+        return {ipv4: f.result() for ipv4, f in futures.items() if f.done()}
+
+
+_resolver = None
+
+
+def get_resolver():
+    global _resolver
+    if _resolver is None:
+        _resolver = ReverseDNSResolver(
+            max_workers=int(EC.discovery_fqdn_workers),
+            ttl=float(EC.discovery_fqdn_cache_ttl),
+            negative_ttl=float(EC.discovery_fqdn_negative_ttl),
+            max_size=int(EC.discovery_fqdn_cache_size),
+        )
+    return _resolver
+
+
+def get_verified_dns_queries(interfaces: list, resolver: ReverseDNSResolver = None, deadline: float = None):
+    """
+    A discovery machine give a FQDN for each interface. This method verify them with concurrent reverse DNS lookups
+    before insert in the db.
+    :param interfaces: list of discovery interface
+    :param resolver: default to get_resolver()
+    :param deadline: seconds to wait for the lookups, default to discovery_fqdn_deadline_sec
+    :return: dict of verified fqdn or None by mac, the interfaces still resolving after the deadline are missing
+    """
+    resolver = get_resolver() if resolver is None else resolver
+    deadline = float(EC.discovery_fqdn_deadline_sec) if deadline is None else deadline
+
+    claimed = dict()
+    for interface in interfaces:
+        try:
+            claimed[interface["mac"]] = (interface["ipv4"], [k[:-1] if k[-1] == "." else k for k in interface["fqdn"]])
+        except (KeyError, TypeError):
+            logger.warning("No fqdn for %s returning None" % interface.get("ipv4"))
+            claimed[interface.get("mac")] = (interface.get("ipv4"), [])
+
+    if EC.discovery_fqdn_verify is False:
+        names = {ipv4: None for ipv4, _ in claimed.values()}
+    else:
+        names = resolver.resolve_many([ipv4 for ipv4, fqdn in claimed.values() if fqdn], deadline)
+
+    verified = dict()
+    for mac, (ipv4, fqdn) in claimed.items():
+        if fqdn and ipv4 not in names:
+            logger.warning("dns request for %s %s is still running after %ss" % (ipv4, mac, deadline))
+            continue
+
+        if EC.discovery_fqdn_verify is False:
+            for name in fqdn:
+                logger.warning("Adding a non verified fqdn entry: %s" % name)
+            fqdn_list = fqdn
+        else:
+            fqdn_list = [k for k in fqdn if k == names[ipv4]]
+            for name in set(fqdn) - set(fqdn_list):
+                logger.warning("fail to verify domain name discoveryC %s != %s socket.gethostbyaddr for %s %s" %
+                               (name, names[ipv4], ipv4, mac))
+
+        if len(fqdn_list) > 1:
+            raise AttributeError("Should be only one: %s" % fqdn_list)
+        verified[mac] = fqdn_list[0] if fqdn_list else None
+
+    return verified
+
+
 def get_verified_dns_query(interface: dict):
     """
     A discovery machine give a FQDN. This method will do the resolution before insert in the db
+    See get_verified_dns_queries
     :param interface:
     :return:
     """
-    fqdn_list = []
-    try:
-        for name in interface["fqdn"]:
-            if EC.discovery_fqdn_verify is False:
-                logger.warning("Adding a non verified fqdn entry: %s" % name)
-                fqdn_list.append(name)
-                continue
-
-            # Do 5 tries
-            max_tries = 5
-            for i in range(max_tries):
-                if i > 0:
-                    time.sleep(i / 10)
-                try:
-                    first_name = socket.gethostbyaddr(interface["ipv4"])[0]
-                    logger.debug("succeed to make dns request for %s:%s" % (interface["ipv4"], first_name))
-
-                    if name[-1] == ".":
-                        name = name[:-1]
-
-                    if name == first_name:
-                        fqdn_list.append(name)
-                        break
-                    else:
-                        logger.warning(
-                            "%d/%d fail to verify domain name discoveryC %s != %s socket.gethostbyaddr for %s %s"
-                            % (i + 1, max_tries, name, first_name, interface["ipv4"], interface["mac"]))
-                except socket.herror as e:
-                    logger.error(
-                        "%d/%d fail to verify name:%s ipv4:%s err: %s" % (i + 1, max_tries, name, interface["ipv4"], e))
-
-    except (KeyError, TypeError):
-        logger.warning("No fqdn for %s returning None" % interface["ipv4"])
-
-    if fqdn_list and len(fqdn_list) > 1:
-        raise AttributeError("Should be only one: %s" % fqdn_list)
-    return fqdn_list[0] if fqdn_list else None
+    return get_verified_dns_queries([interface]).get(interface.get("mac"))
@@ -8,7 +8,7 @@ setup(
     name='enjoliver-api',
     packages=find_packages(exclude=['tests', 'tests.*']),
     package_data={
-        'enjoliver': ['configs.yaml']
+        'enjoliver': ['configs.yaml', 'migrations/script.py.mako', 'migrations/versions/*.py']
     },
     data_files=[
         ('static', findall('static')),
@@ -17,6 +17,7 @@ setup(
     scripts=[],
     zip_safe=False,
     install_requires=[
+        'alembic',
         'boto3',
         'deepdiff',
         'flasgger',
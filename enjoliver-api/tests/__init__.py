@@ -0,0 +1,5 @@
+import os
+import unittest
+
+# the benchmarks are slow: ENJOLIVER_TEST_BENCH=1 runs them
+bench = unittest.skipUnless(os.getenv("ENJOLIVER_TEST_BENCH"), "set ENJOLIVER_TEST_BENCH=1 to run the benchmarks")
@@ -0,0 +1,112 @@
+import datetime
+import time
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+
+from enjoliver.db import session_commit
+from enjoliver.model import Base, Machine, LifecycleIgnition
+from enjoliver.repositories.lifecycle_ignition import LifecycleIgnitionRepository
+
+
+class TestLifecycleIgnitionRepo(unittest.TestCase):
+    engine = None  # type: Engine
+
+    @classmethod
+    def setUpClass(cls):
+        db_uri = 'postgresql+psycopg2://localhost/enjoliver_testing'
+        cls.engine = create_engine(db_uri)
+        cls.sess_maker = sessionmaker(bind=cls.engine)
+
+    def setUp(self):
+        Base.metadata.drop_all(bind=self.engine)
+        Base.metadata.create_all(bind=self.engine)
+        self.long_ago = datetime.datetime(2017, 1, 1)
+        with session_commit(sess_maker=self.sess_maker) as session:
+            for i, up_to_date in enumerate([True, False, True]):
+                machine = Machine(uuid="b7f5f93a-b029-475f-b3a4-479ba198cb8%d" % i)
+                session.add(machine)
+                session.flush()
+                session.add(LifecycleIgnition(machine_id=machine.id, up_to_date=up_to_date,
+                                              updated_date=self.long_ago, last_change_date=self.long_ago))
+
+    def _lifecycles(self):
+        with session_commit(sess_maker=self.sess_maker) as session:
+            return {k.machine_id: (k.up_to_date, k.updated_date, k.last_change_date)
+                    for k in session.query(LifecycleIgnition)}
+
+    def test_unknown(self):
+        lir = LifecycleIgnitionRepository(self.sess_maker)
+        self.assertFalse(lir.bump_up_to_date("52:54:00:e8:32:5b"))
+        self.assertEqual(0, lir.flush())
+
+    def test_flush(self):
+        lir = LifecycleIgnitionRepository(self.sess_maker, max_delay=3600)
+        for i in [1, 2]:
+            lir.remember("52:54:00:e8:32:0%d" % i, i)
+        for i in range(3):
+            self.assertTrue(lir.bump_up_to_date("52:54:00:e8:32:01"))
+            self.assertTrue(lir.bump_up_to_date("52:54:00:e8:32:02"))
+        self.assertEqual((True, self.long_ago, self.long_ago), self._lifecycles()[1])
+
+        self.assertEqual(2, lir.flush())
+        lifecycles = self._lifecycles()
+        up_to_date, updated_date, last_change_date = lifecycles[1]
+        self.assertTrue(up_to_date)
+        self.assertGreater(updated_date, self.long_ago)
+        self.assertEqual(self.long_ago, last_change_date)
+
+        up_to_date, updated_date, last_change_date = lifecycles[2]
+        self.assertTrue(up_to_date)
+        self.assertGreater(last_change_date, self.long_ago)
+
+        self.assertEqual((True, self.long_ago, self.long_ago), lifecycles[3])
+        self.assertEqual(0, lir.flush())
+
+    def test_flush_when_full(self):
+        lir = LifecycleIgnitionRepository(self.sess_maker, max_batch=2, max_delay=3600)
+        for i in [1, 2, 3]:
+            lir.remember("52:54:00:e8:32:0%d" % i, i)
+        lir.bump_up_to_date("52:54:00:e8:32:01")
+        self.assertEqual(self.long_ago, self._lifecycles()[1][1])
+        lir.bump_up_to_date("52:54:00:e8:32:03")
+        lifecycles = self._lifecycles()
+        self.assertGreater(lifecycles[1][1], self.long_ago)
+        self.assertGreater(lifecycles[3][1], self.long_ago)
+        self.assertEqual(self.long_ago, lifecycles[2][1])
+
+    def test_outdated_after_bump(self):
+        lir = LifecycleIgnitionRepository(self.sess_maker, max_delay=3600)
+        lir.remember("52:54:00:e8:32:01", 1)
+        lir.remember("52:54:00:e8:32:03", 3)
+        self.assertTrue(lir.bump_up_to_date("52:54:00:e8:32:01"))
+        self.assertTrue(lir.bump_up_to_date("52:54:00:e8:32:03"))
+
+        # the machine 1 reports outdated: the route discards before writing
+        lir.discard("52:54:00:e8:32:01")
+        # the machine 3 outdated report is written by an other worker, between the bump and the flush
+        time.sleep(0.01)
+        with session_commit(sess_maker=self.sess_maker) as session:
+            session.query(LifecycleIgnition).filter(LifecycleIgnition.machine_id.in_([1, 3])).update({
+                LifecycleIgnition.up_to_date: False,
+                LifecycleIgnition.updated_date: datetime.datetime.utcnow(),
+            }, synchronize_session=False)
+        time.sleep(0.01)
+
+        self.assertEqual(0, lir.flush())
+        lifecycles = self._lifecycles()
+        self.assertFalse(lifecycles[1][0])
+        self.assertFalse(lifecycles[3][0])
+        self.assertFalse(lir.bump_up_to_date("52:54:00:e8:32:01"))
+
+    def test_forget_stale(self):
+        lir = LifecycleIgnitionRepository(self.sess_maker, max_delay=3600)
+        lir.remember("52:54:00:e8:32:01", 1)
+        lir.remember("52:54:00:e8:32:09", 9)
+        self.assertTrue(lir.bump_up_to_date("52:54:00:e8:32:01"))
+        self.assertTrue(lir.bump_up_to_date("52:54:00:e8:32:09"))
+        self.assertEqual(1, lir.flush())
+        self.assertTrue(lir.bump_up_to_date("52:54:00:e8:32:01"))
+        self.assertFalse(lir.bump_up_to_date("52:54:00:e8:32:09"))
@@ -1,13 +1,19 @@
 import copy
+import threading
+import time
 import unittest
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 
+from enjoliver import tools
 from enjoliver.db import session_commit
-from enjoliver.model import MachineInterface, Machine, MachineDisk, Chassis, ChassisPort, Base
+from enjoliver.model import MachineInterface, Machine, MachineDisk, Chassis, ChassisPort, Base, MachineStates, \
+    MachineCurrentState
 from enjoliver.repositories.machine_discovery import MachineDiscoveryRepository
+from enjoliver.repositories.machine_state import MachineStateRepository
 
+from tests import bench
 from tests.fixtures import posts
 
 
@@ -109,3 +115,216 @@ class TestMachineStateRepo(unittest.TestCase):
         self.assertEqual(1, len(disco[0]["interfaces"]))
         self.assertEqual(posts.M01["boot-info"]["mac"], disco[0]["interfaces"][0]["mac"])
         self.assertTrue(disco[0]["interfaces"][0]["as_boot"])
+
+    def test_upsert_many(self):
+        mdr = MachineDiscoveryRepository(self.sess_maker)
+        self.assertEqual([True], mdr.upsert_many([posts.M01]))
+        self.assertEqual([False, True], mdr.upsert_many([posts.M01, posts.M02]))
+
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(2, session.query(Machine).count())
+            self.assertEqual(2, session.query(MachineInterface).count())
+            self.assertEqual(2, session.query(MachineDisk).count())
+            self.assertEqual(1, session.query(Chassis).count())
+            self.assertEqual(2, session.query(ChassisPort).count())
+
+    def test_upsert_many_bad_content(self):
+        mdr = MachineDiscoveryRepository(self.sess_maker)
+        with self.assertRaises(TypeError):
+            mdr.upsert_many([posts.M01, dict()])
+
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(0, session.query(Machine).count())
+
+    def test_upsert_many_in_session(self):
+        mdr = MachineDiscoveryRepository(self.sess_maker)
+        msr = MachineStateRepository(self.sess_maker)
+        macs = [posts.M01["boot-info"]["mac"], posts.M02["boot-info"]["mac"]]
+        with self.assertRaises(RuntimeError):
+            with session_commit(sess_maker=self.sess_maker) as session:
+                mdr.upsert_many([posts.M01, posts.M02], session)
+                msr.update_many({mac: MachineStates.discovery for mac in macs}, session)
+                raise RuntimeError("the transaction is aborted")
+
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(0, session.query(Machine).count())
+            self.assertEqual(0, session.query(MachineCurrentState).count())
+
+        with session_commit(sess_maker=self.sess_maker) as session:
+            mdr.upsert_many([posts.M01, posts.M02], session)
+            msr.update_many({mac: MachineStates.discovery for mac in macs}, session)
+        self.assertEqual(2, len(mdr.fetch_all_discovery()))
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(2, session.query(MachineCurrentState).count())
+
+    def test_upsert_unchanged_keeps_rows(self):
+        mdr = MachineDiscoveryRepository(self.sess_maker)
+        _, diff = mdr._upsert_many([posts.M01])
+        self.assertEqual(3, diff.total("inserted"))
+
+        with session_commit(sess_maker=self.sess_maker) as session:
+            ids = [session.query(k.id).one() for k in [MachineInterface, MachineDisk, ChassisPort]]
+
+        _, diff = mdr._upsert_many([posts.M01])
+        self.assertEqual(3, diff.total("unchanged"))
+        self.assertEqual(0, diff.total("inserted"))
+        self.assertEqual(0, diff.total("updated"))
+        self.assertEqual(0, diff.total("deleted"))
+
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(ids, [session.query(k.id).one() for k in [MachineInterface, MachineDisk, ChassisPort]])
+
+    def test_upsert_diff(self):
+        mdr = MachineDiscoveryRepository(self.sess_maker)
+        mdr.upsert(posts.M01)
+
+        changed = copy.deepcopy(posts.M01)
+        changed["disks"][0]["size-bytes"] += 1
+        changed["disks"].append({'size-bytes': 21474836481, 'path': '/dev/sdb'})
+        changed["lldp"] = {"is_file": False, "data": {"interfaces": None}}
+        _, diff = mdr._upsert_many([changed])
+        self.assertEqual({"machine_disk": 1}, dict(diff.counts["updated"]))
+        self.assertEqual({"machine_disk": 1}, dict(diff.counts["inserted"]))
+        self.assertEqual({"chassis_port": 1}, dict(diff.counts["deleted"]))
+        self.assertEqual({"machine_interface": 1}, dict(diff.counts["unchanged"]))
+
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(2, session.query(MachineDisk).count())
+            self.assertEqual(0, session.query(ChassisPort).count())
+            self.assertEqual(1, session.query(MachineInterface).count())
+
+    def test_fingerprint(self):
+        reordered = dict(reversed(list(copy.deepcopy(posts.M01).items())))
+        self.assertEqual(MachineDiscoveryRepository.fingerprint(posts.M01),
+                         MachineDiscoveryRepository.fingerprint(reordered))
+
+        changed = copy.deepcopy(posts.M01)
+        changed["disks"][0]["size-bytes"] += 1
+        self.assertNotEqual(MachineDiscoveryRepository.fingerprint(posts.M01),
+                            MachineDiscoveryRepository.fingerprint(changed))
+
+    def test_is_unchanged(self):
+        mdr = MachineDiscoveryRepository(self.sess_maker)
+        msr = MachineStateRepository(self.sess_maker)
+        mac = posts.M01["boot-info"]["mac"]
+        self.assertFalse(mdr.is_unchanged(copy.deepcopy(posts.M01)))
+
+        mdr.upsert(copy.deepcopy(posts.M01))
+        self.assertFalse(mdr.is_unchanged(copy.deepcopy(posts.M01)))
+
+        msr.update(mac, MachineStates.discovery)
+        self.assertTrue(mdr.is_unchanged(copy.deepcopy(posts.M01)))
+
+        changed = copy.deepcopy(posts.M01)
+        changed["disks"] = None
+        self.assertFalse(mdr.is_unchanged(changed))
+
+        msr.update(mac, MachineStates.os_installation_granted)
+        self.assertFalse(mdr.is_unchanged(copy.deepcopy(posts.M01)))
+
+        with self.assertRaises(TypeError):
+            mdr.is_unchanged(dict())
+
+    def test_backfill_fqdn(self):
+        release = threading.Event()
+
+        def lookup(ipv4):
+            release.wait(5)
+            return "1.host.enjoliver.local", [], [ipv4]
+
+        resolver, deadline = tools._resolver, tools.EC.discovery_fqdn_deadline_sec
+        tools._resolver, tools.EC.discovery_fqdn_deadline_sec = tools.ReverseDNSResolver(lookup=lookup), 0.1
+        try:
+            mdr = MachineDiscoveryRepository(self.sess_maker)
+            self.assertEqual(0, mdr.backfill_fqdn())
+            mdr.upsert(copy.deepcopy(posts.M01))
+            with session_commit(sess_maker=self.sess_maker) as session:
+                self.assertIsNone(session.query(MachineInterface.fqdn).one()[0])
+
+            self.assertEqual(0, mdr.backfill_fqdn())
+            release.set()
+            self.assertEqual(1, mdr.backfill_fqdn(deadline=1))
+            with session_commit(sess_maker=self.sess_maker) as session:
+                self.assertEqual("1.host.enjoliver.local", session.query(MachineInterface.fqdn).one()[0])
+
+            mdr.upsert(copy.deepcopy(posts.M01))
+            self.assertEqual(0, mdr.backfill_fqdn())
+            with session_commit(sess_maker=self.sess_maker) as session:
+                self.assertEqual("1.host.enjoliver.local", session.query(MachineInterface.fqdn).one()[0])
+        finally:
+            release.set()
+            tools._resolver, tools.EC.discovery_fqdn_deadline_sec = resolver, deadline
+
+
+def synthetic_discovery(i: int):
+    mac = "52:54:00:00:%02x:%02x" % (i // 256, i % 256)
+    return {
+        "boot-info": {"uuid": "b7f5f93a-b029-475f-b3a4-%012d" % i, "mac": mac},
+        "disks": [{"size-bytes": 21474836480, "path": "/dev/sda"}],
+        "lldp": {
+            "is_file": True,
+            "data": {"interfaces": [{
+                "chassis": {"id": "28:f1:0e:12:20:00", "name": "rack-%d" % (i // 48)},
+                "port": {"id": "fe:54:00:00:%02x:%02x" % (i // 256, i % 256)},
+                "name": "eth0",
+            }]},
+        },
+        "interfaces": [{
+            "mac": mac,
+            "netmask": 16,
+            "ipv4": "172.20.%d.%d" % (i // 256, i % 256),
+            "cidrv4": "172.20.%d.%d/16" % (i // 256, i % 256),
+            "name": "eth0",
+            "gateway": "172.20.0.1",
+        }],
+    }
+
+
+@bench
+class BenchMachineDiscoveryRepo(unittest.TestCase):
+    """
+    Compare the per machine and the batch discovery ingestion of a rack of 48 machines
+    """
+    nb = 48
+
+    def _bench(self, engine, upsert_fn):
+        Base.metadata.drop_all(bind=engine)
+        Base.metadata.create_all(bind=engine)
+        mdr = MachineDiscoveryRepository(sessionmaker(bind=engine))
+        payloads = [synthetic_discovery(i) for i in range(self.nb)]
+        queries = []
+
+        def count_queries(*args, **kwargs):
+            queries.append(1)
+
+        event.listen(engine, "before_cursor_execute", count_queries)
+        try:
+            start = time.time()
+            # the second pass re-posts the same facts, like discoveryC does
+            for _ in range(2):
+                upsert_fn(mdr, payloads)
+            duration = time.time() - start
+        finally:
+            event.remove(engine, "before_cursor_execute", count_queries)
+
+        self.assertEqual(self.nb, len(mdr.fetch_all_discovery()))
+        return duration, len(queries)
+
+    def _compare(self, engine):
+        def per_machine(mdr, payloads):
+            for k in payloads:
+                mdr.upsert(k)
+
+        def batch(mdr, payloads):
+            mdr.upsert_many(payloads)
+
+        one_duration, one_queries = self._bench(engine, per_machine)
+        batch_duration, batch_queries = self._bench(engine, batch)
+        self.assertLess(batch_queries * 4, one_queries)
+        self.assertLess(batch_duration, one_duration)
+
+    def test_bench_sqlite(self):
+        self._compare(create_engine("sqlite://"))
+
+    def test_bench_postgresql(self):
+        self._compare(create_engine('postgresql+psycopg2://localhost/enjoliver_testing'))
@@ -1,14 +1,21 @@
+import threading
 import unittest
+from unittest import mock
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.engine import Engine
 
 from enjoliver.db import session_commit
-from enjoliver.model import Base, Machine, MachineInterface, Schedule, ScheduleRoles
+from enjoliver.model import Base, Chassis, ChassisPort, Machine, MachineInterface, MachineDisk, Schedule, \
+    ScheduleRoles
 from enjoliver.repositories.machine_discovery import MachineDiscoveryRepository
 from enjoliver.repositories.machine_schedule import MachineScheduleRepository
+from enjoliver.repositories.registry import RepositoryRegistry
+from enjoliver.schedulerv2 import EtcdMemberKubernetesControlPlane, KubernetesNode, RepositorySchedulerBackend, \
+    get_placement_policy
 
+from tests import bench
 from tests.fixtures import posts
 
 
@@ -291,3 +298,205 @@ class TestMachineScheduleRepo(unittest.TestCase):
 
         # verify the scheduled machine is indexed by its boot-interface, the 3rd one in this case
         self.assertIn(mac.format(3), s)
+
+    def _add_scheduled_fleet(self, start: int, nb: int, scheduled=True):
+        with session_commit(sess_maker=self.sess_maker) as session:
+            for i in range(start, start + nb):
+                machine = Machine(uuid="b7f5f93a-b029-475f-b3a4-%012d" % i)
+                session.add(machine)
+                session.flush()
+                session.add(MachineInterface(
+                    machine_id=machine.id,
+                    mac="00:00:00:00:%02x:%02x" % (i // 256, i % 256),
+                    netmask=1,
+                    ipv4="10.10.10.10",
+                    cidrv4="127.0.0.1/8",
+                    as_boot=True,
+                    gateway="1.1.1.1",
+                    name="eth0"
+                ))
+                session.add(MachineDisk(machine_id=machine.id, path="/dev/sda", size=1024 * 1024 * 1024))
+                if not scheduled:
+                    continue
+                roles = [ScheduleRoles.etcd_member]
+                if i % 2 == 0:
+                    roles.append(ScheduleRoles.kubernetes_control_plane)
+                for role in roles:
+                    session.add(Schedule(machine_id=machine.id, role=role))
+            session.commit()
+
+    @bench
+    def test_bench_get_machines_by_roles_query_count(self):
+        ms = MachineScheduleRepository(sess_maker=self.sess_maker)
+        queries = []
+
+        def count_queries(*args, **kwargs):
+            queries.append(1)
+
+        event.listen(self.engine, "before_cursor_execute", count_queries)
+        try:
+            counts = []
+            for start, nb in [(0, 10), (10, 200)]:
+                self._add_scheduled_fleet(start, nb)
+                del queries[:]
+                ret = ms.get_machines_by_roles(ScheduleRoles.etcd_member, ScheduleRoles.kubernetes_control_plane)
+                self.assertEqual((start + nb) // 2, len(ret))
+                for machine in ret:
+                    self.assertEqual(1, len(machine["disks"]))
+                counts.append(len(queries))
+        finally:
+            event.remove(self.engine, "before_cursor_execute", count_queries)
+
+        # the number of queries must not depend on the size of the fleet
+        self.assertEqual(counts[0], counts[1])
+        self.assertLessEqual(counts[1], 2)
+
+    def test_create_schedules_batch_queries(self):
+        self._add_scheduled_fleet(0, 20, scheduled=False)
+        ms = MachineScheduleRepository(sess_maker=self.sess_maker)
+        macs = sorted(k["mac"] for k in ms.get_available_machines())
+        commits, queries = [], []
+
+        def count_commits(*args, **kwargs):
+            commits.append(1)
+
+        def count_queries(*args, **kwargs):
+            queries.append(1)
+
+        event.listen(self.engine, "commit", count_commits)
+        event.listen(self.engine, "before_cursor_execute", count_queries)
+        try:
+            results = ms.create_schedules_batch([{"roles": [ScheduleRoles.kubernetes_node], "selector": {"mac": mac}}
+                                                 for mac in macs + ["00:00:00:00:ff:ff"]])
+        finally:
+            event.remove(self.engine, "commit", count_commits)
+            event.remove(self.engine, "before_cursor_execute", count_queries)
+        self.assertEqual(20, len([k for k in results if k["roles"] is not None]))
+        self.assertEqual(1, len(commits))
+        # the machines, their schedules and one bulk insert
+        self.assertEqual(3, len(queries))
+        self.assertEqual(0, len(ms.get_available_machines()))
+
+        ms.create_schedules_batch([{"roles": [ScheduleRoles.kubernetes_node, ScheduleRoles.etcd_member],
+                                    "selector": {"mac": mac}} for mac in macs[:2]])
+        self.assertEqual({mac: [ScheduleRoles.kubernetes_node] for mac in macs[2:]},
+                         {k: v for k, v in ms.get_all_schedules().items() if k not in macs[:2]})
+        for mac in macs[:2]:
+            self.assertEqual([ScheduleRoles.kubernetes_node, ScheduleRoles.etcd_member],
+                             ms.get_roles_by_mac_selector(mac))
+
+    def test_create_schedules_batch(self):
+        self._add_scheduled_fleet(0, 2, scheduled=False)
+        ms = MachineScheduleRepository(sess_maker=self.sess_maker)
+        macs = sorted(k["mac"] for k in ms.get_available_machines())
+        results = ms.create_schedules_batch([
+            {"roles": [ScheduleRoles.etcd_member, ScheduleRoles.kubernetes_control_plane], "selector": {"mac": macs[0]}},
+            {"roles": [ScheduleRoles.kubernetes_node], "selector": {"mac": "00:00:00:00:ff:ff"}},
+            {"roles": [ScheduleRoles.kubernetes_node], "selector": {"mac": macs[1]}},
+            {"roles": [ScheduleRoles.etcd_member], "selector": {"mac": macs[0]}},
+        ])
+        self.assertEqual([
+            {"mac": macs[0], "roles": [ScheduleRoles.etcd_member, ScheduleRoles.kubernetes_control_plane]},
+            {"mac": "00:00:00:00:ff:ff", "roles": None},
+            {"mac": macs[1], "roles": [ScheduleRoles.kubernetes_node]},
+            {"mac": macs[0], "roles": []},
+        ], results)
+        self.assertEqual([], ms.create_schedules_batch([]))
+
+        with self.assertRaises(LookupError):
+            ms.create_schedules_batch([{"roles": ["not-existing"], "selector": {"mac": macs[0]}}])
+        with self.assertRaises(TypeError):
+            ms.create_schedules_batch([{"roles": [ScheduleRoles.kubernetes_node]}])
+        self.assertEqual({
+            macs[0]: [ScheduleRoles.etcd_member, ScheduleRoles.kubernetes_control_plane],
+            macs[1]: [ScheduleRoles.kubernetes_node],
+        }, ms.get_all_schedules())
+
+    def test_allocate(self):
+        self._add_scheduled_fleet(0, 5, scheduled=False)
+        ms = MachineScheduleRepository(sess_maker=self.sess_maker)
+        macs = sorted(k["mac"] for k in ms.get_available_machines())
+        roles = [ScheduleRoles.kubernetes_control_plane, ScheduleRoles.etcd_member]
+
+        self.assertEqual({"scheduled": 0, "allocated": []}, ms.allocate(roles, 6))
+        self.assertEqual({"scheduled": 3, "allocated": macs[:3]}, ms.allocate(roles, 3))
+        self.assertEqual({"scheduled": 3, "allocated": []}, ms.allocate(roles, 3))
+        self.assertEqual({"scheduled": 3, "allocated": []}, ms.allocate(roles, 2))
+        self.assertEqual(3, len(ms.get_machines_by_roles(*roles)))
+
+        self.assertEqual({"scheduled": 2, "allocated": macs[3:]}, ms.allocate([ScheduleRoles.kubernetes_node]))
+        self.assertEqual({"scheduled": 2, "allocated": []}, ms.allocate([ScheduleRoles.kubernetes_node]))
+        self.assertEqual({"scheduled": 3, "allocated": []}, ms.allocate(roles, 4))
+        with self.assertRaises(LookupError):
+            ms.allocate(["not-existing"], 1)
+
+    def test_allocate_placement(self):
+        # the machines 0, 1, 2 are behind the first switch and 3, 4, 5 behind the second
+        self._add_scheduled_fleet(0, 6, scheduled=False)
+        with session_commit(sess_maker=self.sess_maker) as session:
+            for c in range(2):
+                chassis = Chassis(name="switch-%d" % c, mac="aa:bb:cc:dd:ee:0%d" % c)
+                session.add(chassis)
+                session.flush()
+                for interface in session.query(MachineInterface).order_by(MachineInterface.mac)[c * 3:c * 3 + 3]:
+                    session.add(ChassisPort(mac="port-%d" % interface.id, chassis_id=chassis.id,
+                                            machine_interface=interface.id))
+            session.add(MachineDisk(machine_id=session.query(MachineInterface.machine_id).filter(
+                MachineInterface.mac == "00:00:00:00:00:02").scalar(), path="/dev/sdb", size=1024))
+
+        ms = MachineScheduleRepository(sess_maker=self.sess_maker, placement=get_placement_policy("spread-chassis"))
+        self.assertEqual({"scheduled": 1, "allocated": ["00:00:00:00:00:00"]},
+                         ms.allocate([ScheduleRoles.etcd_member], 1))
+        self.assertEqual({"scheduled": 3, "allocated": ["00:00:00:00:00:03", "00:00:00:00:00:01"]},
+                         ms.allocate([ScheduleRoles.etcd_member], 3))
+
+        ms.placement = get_placement_policy("largest-disk")
+        self.assertEqual({"scheduled": 1, "allocated": ["00:00:00:00:00:02"]},
+                         ms.allocate([ScheduleRoles.kubernetes_control_plane], 1))
+
+        # the lowest macs are the order of the query: no need to describe the whole fleet
+        ms.placement = get_placement_policy("mac")
+        with mock.patch.object(ms, "_place") as place:
+            self.assertEqual({"scheduled": 1, "allocated": ["00:00:00:00:00:04"]},
+                             ms.allocate([ScheduleRoles.kubernetes_node], 1))
+            place.assert_not_called()
+
+    def test_allocate_concurrent(self):
+        self._add_scheduled_fleet(0, 20, scheduled=False)
+        ms = MachineScheduleRepository(sess_maker=self.sess_maker)
+        roles = [ScheduleRoles.etcd_member, ScheduleRoles.kubernetes_control_plane]
+        results, errors = [], []
+
+        def allocate():
+            try:
+                results.append(ms.allocate(roles, 3, tries=10))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=allocate) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([], errors)
+        self.assertEqual(3, sum(len(k["allocated"]) for k in results))
+        self.assertEqual(3, len(ms.get_machines_by_roles(*roles)))
+        self.assertEqual(17, len(ms.get_available_machines()))
+
+    def test_scheduler_repository_backend(self):
+        self._add_scheduled_fleet(0, 10, scheduled=False)
+        registry = RepositoryRegistry(self.sess_maker)
+        backend = RepositorySchedulerBackend(registry)
+        # nothing listens on the api_uri
+        api_uri = "http://127.0.0.1:1"
+        expected_nb = EtcdMemberKubernetesControlPlane.expected_nb
+
+        sch_cp = EtcdMemberKubernetesControlPlane(api_uri, backend=backend)
+        self.assertTrue(sch_cp.apply())
+        self.assertEqual(expected_nb, len(registry.machine_schedule.get_machines_by_roles(*sch_cp.roles)))
+        self.assertTrue(sch_cp.apply())
+
+        sch_no = KubernetesNode(api_uri, apply_dep=True, backend=backend)
+        self.assertEqual(10 - expected_nb, sch_no.apply())
+        self.assertEqual(10 - expected_nb, sch_no.apply())
+        self.assertEqual([], backend.fetch_available())
@@ -98,3 +98,39 @@ class TestMachineStateRepo(unittest.TestCase):
             "state": new_state,
             "date": updated_date
         }], ret)
+
+    def _states(self):
+        with session_commit(sess_maker=self.sess_maker) as session:
+            return {k.machine_mac: k.state_name for k in session.query(MachineCurrentState)}
+
+    def test_buffered(self):
+        msr = MachineStateRepository(sess_maker=self.sess_maker, max_delay=3600)
+        for state in [MachineStates.booting, MachineStates.os_installation_granted]:
+            msr.update("00:00:00:00:00:01", state)
+        msr.update("00:00:00:00:00:02", MachineStates.booting)
+        self.assertEqual({}, self._states())
+
+        self.assertEqual(2, msr.flush())
+        self.assertEqual({
+            "00:00:00:00:00:01": MachineStates.os_installation_granted,
+            "00:00:00:00:00:02": MachineStates.booting,
+        }, self._states())
+        self.assertEqual(0, msr.flush())
+
+        with self.assertRaises(LookupError):
+            msr.update("00:00:00:00:00:01", "unknown")
+
+    def test_flush_when_full(self):
+        msr = MachineStateRepository(sess_maker=self.sess_maker, max_batch=2, max_delay=3600)
+        msr.update("00:00:00:00:00:01", MachineStates.booting)
+        msr.update("00:00:00:00:00:01", MachineStates.booting)
+        self.assertEqual({}, self._states())
+        msr.update("00:00:00:00:00:02", MachineStates.booting)
+        self.assertEqual(2, len(self._states()))
+
+    def test_update_many_wins(self):
+        msr = MachineStateRepository(sess_maker=self.sess_maker, max_delay=3600)
+        msr.update("00:00:00:00:00:01", MachineStates.booting)
+        msr.update_many({"00:00:00:00:00:01": MachineStates.discovery})
+        self.assertEqual(0, msr.flush())
+        self.assertEqual({"00:00:00:00:00:01": MachineStates.discovery}, self._states())
@@ -1,6 +1,9 @@
+import http.server
 import json
 import os
 import shutil
+import tempfile
+import threading
 import time
 import unittest
 from unittest.mock import Mock
@@ -11,7 +14,11 @@ from sqlalchemy.orm import sessionmaker
 
 from enjoliver import configs
 from enjoliver.app import create_app
-from enjoliver.model import Base
+from enjoliver.cache import LRUCache
+from enjoliver.events import EventLog
+from enjoliver.matchbox import ignition_digest
+from enjoliver.db import session_commit
+from enjoliver.model import Base, Machine, MachineDisk, MachineInterface
 from enjoliver.repositories.registry import RepositoryRegistry
 from enjoliver.routes import register_routes
 
@@ -40,9 +47,9 @@ class TestAPI(unittest.TestCase):
         cls.engine = create_engine('postgresql+psycopg2://localhost/enjoliver_testing')
         cls.init_db()
 
-        sess_maker = sessionmaker(bind=cls.engine)
-        registry = RepositoryRegistry(sess_maker=sess_maker)
-        register_routes(app=app, ec=cls.ec, cache=SimpleCache(), sess_maker=sess_maker, registry=registry)
+        cls.sess_maker = sessionmaker(bind=cls.engine)
+        registry = RepositoryRegistry(sess_maker=cls.sess_maker)
+        register_routes(app=app, ec=cls.ec, cache=SimpleCache(), sess_maker=cls.sess_maker, registry=registry)
 
         cls.app = app.test_client()
 
@@ -140,6 +147,99 @@ class TestAPI(unittest.TestCase):
             data = json.loads(r.data.decode())
             self.assertEqual(2, len(data))
 
+    def test_discovery_03_paginated(self):
+        r = self.app.get("/discovery?limit=1")
+        self.assertEqual(200, r.status_code)
+        first = json.loads(r.data.decode())
+        self.assertEqual(1, len(first))
+        after = r.headers["X-Next-After"]
+
+        r = self.app.get("/discovery?limit=1&after=%s" % after)
+        self.assertEqual(200, r.status_code)
+        second = json.loads(r.data.decode())
+        self.assertEqual(1, len(second))
+        self.assertNotEqual(first[0]["boot-info"]["uuid"], second[0]["boot-info"]["uuid"])
+
+        r = self.app.get("/discovery?limit=1&after=%s" % r.headers["X-Next-After"])
+        self.assertEqual([], json.loads(r.data.decode()))
+        self.assertNotIn("X-Next-After", r.headers)
+
+        r = self.app.get("/discovery?limit=foo")
+        self.assertEqual(406, r.status_code)
+
+    def test_discovery_04_ndjson(self):
+        r = self.app.get("/discovery?format=ndjson")
+        self.assertEqual(200, r.status_code)
+        self.assertEqual("application/x-ndjson", r.mimetype)
+        lines = [json.loads(k) for k in r.data.decode().splitlines()]
+        self.assertEqual(2, len(lines))
+
+    def test_discovery_05_batch(self):
+        r = self.app.post('/discovery/batch', data=json.dumps([posts.M01, posts.M02]),
+                          content_type='application/json')
+        self.assertEqual(200, r.status_code)
+        self.assertEqual({"new-discovery": [False, False], "total": 2}, json.loads(r.data.decode()))
+
+        r = self.app.post('/discovery/batch', data=json.dumps(posts.M01), content_type='application/json')
+        self.assertEqual(406, r.status_code)
+        r = self.app.post('/discovery/batch', data=json.dumps([{}]), content_type='application/json')
+        self.assertEqual(406, r.status_code)
+
+        r = self.app.get("/discovery")
+        self.assertEqual(2, len(json.loads(r.data.decode())))
+
+    def _discovery_rows(self):
+        with session_commit(sess_maker=self.sess_maker) as session:
+            return (
+                sorted((k.uuid, k.updated_date) for k in session.query(Machine)),
+                session.query(MachineInterface).count(),
+                session.query(MachineDisk).count(),
+            )
+
+    def test_discovery_06_unchanged(self):
+        before = self._discovery_rows()
+        for i in range(3):
+            r = self.app.post('/discovery', data=json.dumps(posts.M01), content_type='application/json')
+            self.assertEqual(200, r.status_code)
+            self.assertEqual({'new-discovery': False}, json.loads(r.data.decode()))
+        self.assertEqual(before, self._discovery_rows())
+
+        r = self.app.get("/discovery")
+        self.assertEqual(2, len(json.loads(r.data.decode())))
+
+    def test_events(self):
+        r = self.app.get("/events")
+        self.assertEqual(200, r.status_code)
+        seq = json.loads(r.data.decode())["seq"]
+
+        r = self.app.get("/events?since=%d&timeout=0" % seq)
+        self.assertEqual({"seq": seq, "events": []}, json.loads(r.data.decode()))
+
+        self.app.post('/discovery/batch', data=json.dumps([posts.M01]), content_type='application/json')
+        r = self.app.get("/events?since=%d&timeout=10" % seq)
+        content = json.loads(r.data.decode())
+        self.assertEqual(seq + 1, content["seq"])
+        self.assertEqual(["discovery"], [k["kind"] for k in content["events"]])
+        self.assertEqual([posts.M01["boot-info"]["mac"]], content["events"][0]["macs"])
+
+        r = self.app.get("/events?since=abc")
+        self.assertEqual(406, r.status_code)
+
+    def test_events_01_own_cache(self):
+        cache, events_cache = LRUCache(threshold=2), LRUCache(threshold=EventLog.cache_threshold)
+        app = create_app('EnjoliverTestEvents', ec=self.ec)
+        app.testing = True
+        register_routes(app=app, ec=self.ec, cache=cache, sess_maker=self.sess_maker,
+                        registry=RepositoryRegistry(sess_maker=self.sess_maker), events_cache=events_cache)
+        client = app.test_client()
+
+        client.post('/discovery/batch', data=json.dumps([posts.M01]), content_type='application/json')
+        self.assertEqual(1, json.loads(client.get("/events").data.decode())["seq"])
+        for i in range(10):
+            cache.set("key-%d" % i, i)
+        self.assertEqual(1, json.loads(client.get("/events").data.decode())["seq"])
+        self.assertNotIn(EventLog.event_key % 1, cache._cache)
+
     def test_scheduler_00(self):
         r = self.app.get("/scheduler")
         self.assertEqual(200, r.status_code)
@@ -214,6 +314,40 @@ class TestAPI(unittest.TestCase):
         r = self.app.get("/scheduler/available")
         self.assertEqual(1, len(json.loads(r.data.decode())))
 
+    def test_scheduler_09_batch(self):
+        mac = posts.M01["boot-info"]["mac"]
+        data = [
+            {u'roles': [u'etcd-member'], u'selector': {u'mac': mac}},
+            {u'roles': [u'kubernetes-node'], u'selector': {u'mac': u'00:00:00:00:00:99'}},
+        ]
+        r = self.app.post("/scheduler/batch", data=json.dumps(data), content_type='application/json')
+        self.assertEqual(200, r.status_code)
+        self.assertEqual([{u"mac": mac, u"roles": []}, {u"mac": u'00:00:00:00:00:99', u"roles": None}],
+                         json.loads(r.data.decode()))
+
+        for data in [data[0], [{u'roles': [u'not-existing'], u'selector': {u'mac': mac}}], [{u'roles': []}]]:
+            r = self.app.post("/scheduler/batch", data=json.dumps(data), content_type='application/json')
+            self.assertEqual(406, r.status_code)
+        r = self.app.get("/scheduler/available")
+        self.assertEqual(1, len(json.loads(r.data.decode())))
+
+    def test_scheduler_10_allocate(self):
+        roles = [u'etcd-member', u'kubernetes-control-plane']
+        r = self.app.post("/scheduler/allocate", data=json.dumps({u"roles": roles, u"nb": 1}),
+                          content_type='application/json')
+        self.assertEqual(200, r.status_code)
+        self.assertEqual({u"scheduled": 1, u"allocated": []}, json.loads(r.data.decode()))
+
+        r = self.app.post("/scheduler/allocate", data=json.dumps({u"roles": roles, u"nb": 3}),
+                          content_type='application/json')
+        self.assertEqual({u"scheduled": 1, u"allocated": []}, json.loads(r.data.decode()))
+
+        for data in [roles, {u"roles": []}, {u"roles": roles, u"nb": u"3"}, {u"roles": [u"not-existing"]}]:
+            r = self.app.post("/scheduler/allocate", data=json.dumps(data), content_type='application/json')
+            self.assertEqual(406, r.status_code)
+        r = self.app.get("/scheduler/available")
+        self.assertEqual(1, len(json.loads(r.data.decode())))
+
     def test_lifecycle_01(self):
         r = self.app.get("/lifecycle/coreos-install")
         self.assertEqual([], json.loads(r.data.decode()))
@@ -291,6 +425,23 @@ class TestAPI(unittest.TestCase):
         json.loads(r.data.decode())
         self.assertEqual(200, r.status_code)
 
+    def test_vue_machine_paginated(self):
+        full = json.loads(self.app.get("/ui/view/machine").data.decode())
+        r = self.app.get("/ui/view/machine?limit=1")
+        self.assertEqual(200, r.status_code)
+        # the unpaginated overview has no order: find the first page by the keyset column, the machine id
+        with session_commit(sess_maker=self.sess_maker) as session:
+            first_mac = session.query(MachineInterface.mac) \
+                .filter(MachineInterface.as_boot == True) \
+                .order_by(MachineInterface.machine_id) \
+                .first().mac
+        self.assertEqual([k for k in full if k["MAC"] == first_mac], json.loads(r.data.decode()))
+
+        r = self.app.get("/ui/view/machine", headers={"Accept": "application/x-ndjson"})
+        self.assertEqual(200, r.status_code)
+        lines = [json.loads(k) for k in r.data.decode().splitlines()]
+        self.assertCountEqual(full, lines)
+
     def test_sync_notify_00_outofsync(self):
         r = self.app.get("/ignition")
         r.close()
@@ -315,6 +466,53 @@ class TestAPI(unittest.TestCase):
         r.close()
         self.assertEqual(502, r.status_code)
 
+    def test_sync_notify_03_renders_evict_nothing(self):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                body = json.dumps({"ignition": {"version": "2.0.0"}, "query": self.path}).encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        matchbox_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, matchbox_path)
+        for d, name, content in [("groups", "all.json", {"id": "all", "profile": "node"}),
+                                 ("profiles", "node.json", {"id": "node", "ignition_id": "node.yaml"}),
+                                 ("ignition", "node.yaml", "---")]:
+            os.makedirs(os.path.join(matchbox_path, d))
+            with open(os.path.join(matchbox_path, d, name), "w") as f:
+                f.write(content if type(content) is str else json.dumps(content))
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        ec = configs.EnjoliverConfig(importer=__file__)
+        ec.matchbox_path = matchbox_path
+        ec.matchbox_uri = "http://127.0.0.1:%d" % server.server_address[1]
+        ec.ignition_cache_threshold = 10
+        app = create_app('EnjoliverTestRenders', ec=ec)
+        app.testing = True
+        render_cache = LRUCache(threshold=ec.ignition_cache_threshold)
+        register_routes(app=app, ec=ec, cache=LRUCache(threshold=5), sess_maker=self.sess_maker,
+                        registry=RepositoryRegistry(sess_maker=self.sess_maker), render_cache=render_cache)
+        client = app.test_client()
+
+        self.assertEqual(200, client.post("/sync-notify").status_code)
+        for i in range(50):
+            r = client.get("/ignition?uuid=%d&mac=52-54-00-00-00-%02x" % (i, i))
+            self.assertEqual(200, r.status_code)
+        self.assertEqual(10, len(render_cache._cache))
+        self.assertEqual(200, client.get("/sync-notify").status_code)
+        self.assertEqual(200, client.get("/ignition?uuid=0&mac=52-54-00-00-00-00").status_code)
+
     def test_install_authorization(self):
         r = self.app.get("/install-authorization/mac=01-02-03-04-05-06")
         r.close()
@@ -322,3 +520,143 @@ class TestAPI(unittest.TestCase):
         r = self.app.get("/install-authorization/mac=01-02-03-04-05-07")
         r.close()
         self.assertEqual(403, r.status_code)
+
+    def test_assets_local(self):
+        directory = tempfile.mkdtemp()
+        matchbox_assets = self.ec.matchbox_assets
+        try:
+            os.makedirs(os.path.join(directory, "coreos"))
+            with open(os.path.join(directory, "coreos", "image.bin"), "wb") as f:
+                f.write(b"0123456789")
+            self.ec.matchbox_assets = directory
+
+            r = self.app.get("/assets/coreos/image.bin")
+            self.assertEqual(200, r.status_code)
+            self.assertEqual(b"0123456789", r.data)
+            etag = r.headers["ETag"]
+            r.close()
+
+            r = self.app.get("/assets/coreos/image.bin", headers={"Range": "bytes=2-4"})
+            self.assertEqual(206, r.status_code)
+            self.assertEqual(b"234", r.data)
+            r.close()
+
+            r = self.app.get("/assets/coreos/image.bin", headers={"If-None-Match": etag})
+            self.assertEqual(304, r.status_code)
+            r.close()
+
+            r = self.app.get("/assets/../coreos/image.bin")
+            self.assertEqual(404, r.status_code)
+
+            self.ec.assets_x_accel_redirect = "/internal-assets/"
+            r = self.app.get("/assets/coreos/image.bin")
+            self.assertEqual(200, r.status_code)
+            self.assertEqual("/internal-assets/coreos/image.bin", r.headers["X-Accel-Redirect"])
+            self.assertEqual(b"", r.data)
+        finally:
+            self.ec.assets_x_accel_redirect = None
+            self.ec.matchbox_assets = matchbox_assets
+            shutil.rmtree(directory)
+
+    def test_assets_proxy(self):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                body = b"0123456789" * 1000
+                if self.headers.get("If-None-Match") == '"v1"':
+                    self.send_response(304)
+                    self.send_header("ETag", '"v1"')
+                    self.end_headers()
+                    return
+                if self.headers.get("Range") == "bytes=2-4":
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes 2-4/%d" % len(body))
+                    body = body[2:5]
+                else:
+                    self.send_response(200)
+                self.send_header("ETag", '"v1"')
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        flask_app = self.app.application
+        matchbox_uri = flask_app.config["MATCHBOX_URI"]
+        try:
+            flask_app.config["MATCHBOX_URI"] = "http://127.0.0.1:%d" % server.server_address[1]
+            r = self.app.get("/assets/coreos/image.bin")
+            self.assertEqual(200, r.status_code)
+            self.assertEqual(b"0123456789" * 1000, r.data)
+            self.assertEqual('"v1"', r.headers["ETag"])
+            self.assertEqual("10000", r.headers["Content-Length"])
+            r.close()
+
+            r = self.app.get("/assets/coreos/image.bin", headers={"Range": "bytes=2-4"})
+            self.assertEqual(206, r.status_code)
+            self.assertEqual(b"234", r.data)
+            self.assertEqual("bytes 2-4/10000", r.headers["Content-Range"])
+            r.close()
+
+            r = self.app.get("/assets/coreos/image.bin", headers={"If-None-Match": '"v1"'})
+            self.assertEqual(304, r.status_code)
+            r.close()
+        finally:
+            flask_app.config["MATCHBOX_URI"] = matchbox_uri
+            server.shutdown()
+            server.server_close()
+
+        r = self.app.get("/assets/coreos/image.bin")
+        self.assertEqual(502, r.status_code)
+
+    def test_lifecycle_09_digest(self):
+        ignition = {"ignition": {"version": "2.0.0"}, "storage": {"files": []}}
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            calls = []
+
+            def do_GET(self):
+                self.calls.append(self.path)
+                body = json.dumps(ignition, indent=2).encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        matchbox_uri = self.ec.matchbox_uri
+        rawq = "mac=%s&uuid=%s&os=installed" % (
+            posts.M01["boot-info"]["mac"].replace(":", "-"), posts.M01["boot-info"]["uuid"])
+        digest = ignition_digest(ignition)
+        try:
+            self.ec.matchbox_uri = "http://127.0.0.1:%d" % server.server_address[1]
+            r = self.app.post("/lifecycle/ignition/%s" % rawq, headers={"X-Ignition-Digest": "0" * 64})
+            self.assertEqual(412, r.status_code)
+
+            r = self.app.post("/lifecycle/ignition/%s" % rawq, data=json.dumps({"ignition": {}}))
+            self.assertEqual(210, r.status_code)
+
+            r = self.app.post("/lifecycle/ignition/%s" % rawq, data=json.dumps(ignition))
+            self.assertEqual(200, r.status_code)
+            self.assertEqual({"message": "Up-to-date"}, json.loads(r.data.decode()))
+
+            for i in range(3):
+                r = self.app.post("/lifecycle/ignition/%s" % rawq, headers={"X-Ignition-Digest": digest})
+                self.assertEqual(200, r.status_code)
+            self.assertTrue(json.loads(self.app.get("/lifecycle/ignition").data.decode())[0]["up-to-date"])
+
+            r = self.app.post("/lifecycle/ignition/mac=00-00-00-00-00-00", headers={"X-Ignition-Digest": digest})
+            self.assertEqual(406, r.status_code)
+        finally:
+            self.ec.matchbox_uri = matchbox_uri
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,195 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+
+from prometheus_client import REGISTRY
+from werkzeug.contrib.cache import FileSystemCache, RedisCache
+
+from enjoliver.cache import LRUCache, MmapCache, MonitoredCache, create_cache
+
+from tests import bench
+
+
+def _set_in_child(path: str):
+    cache = MmapCache(path, slots=16, slot_size=4096)
+    cache.set("from-child", {"pid": os.getpid()})
+    cache.delete("from-parent")
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_get_set(self):
+        cache = LRUCache()
+        self.assertIsNone(cache.get("key"))
+        self.assertTrue(cache.set("key", {"a": [1]}))
+        self.assertEqual({"a": [1]}, cache.get("key"))
+        self.assertFalse(cache.add("key", "other"))
+        self.assertTrue(cache.delete("key"))
+        self.assertFalse(cache.delete("key"))
+        self.assertTrue(cache.add("key", "other"))
+        self.assertEqual("other", cache.get("key"))
+
+    def test_timeout(self):
+        cache = LRUCache()
+        cache.set("expired", 1, timeout=-1)
+        cache.set("forever", 1, timeout=0)
+        self.assertIsNone(cache.get("expired"))
+        self.assertFalse(cache.has("expired"))
+        self.assertEqual(1, cache.get("forever"))
+
+    def test_eviction(self):
+        cache = LRUCache(threshold=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(1, cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(3, cache.get("c"))
+
+
+class TestMmapCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "cache.mmap")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_set(self):
+        cache = MmapCache(self.path, slots=16, slot_size=4096)
+        self.assertIsNone(cache.get("key"))
+        self.assertTrue(cache.set("key", {"a": [1]}))
+        self.assertEqual({"a": [1]}, cache.get("key"))
+        self.assertTrue(cache.set("key", "updated"))
+        self.assertEqual("updated", cache.get("key"))
+        self.assertFalse(cache.add("key", "other"))
+        self.assertTrue(cache.delete("key"))
+        self.assertFalse(cache.has("key"))
+        self.assertTrue(cache.add("key", "other"))
+        cache.clear()
+        self.assertIsNone(cache.get("key"))
+
+    def test_timeout(self):
+        cache = MmapCache(self.path, slots=16, slot_size=4096)
+        cache.set("expired", 1, timeout=-1)
+        cache.set("forever", 1, timeout=0)
+        self.assertIsNone(cache.get("expired"))
+        self.assertEqual(1, cache.get("forever"))
+
+    def test_too_big(self):
+        cache = MmapCache(self.path, slots=16, slot_size=4096)
+        cache.set("key", "small")
+        self.assertFalse(cache.set("key", "b" * 4096))
+        self.assertIsNone(cache.get("key"))
+
+    def test_overflow(self):
+        overflow = FileSystemCache(os.path.join(self.directory, "overflow"))
+        cache = MmapCache(self.path, slots=16, slot_size=4096, overflow=overflow)
+        big = ["b" * 1024] * 8
+        self.assertTrue(cache.set("key", big))
+        self.assertEqual(big, cache.get("key"))
+        self.assertEqual(big, MmapCache(self.path, slots=16, slot_size=4096, overflow=overflow).get("key"))
+        self.assertTrue(cache.has("key"))
+        self.assertFalse(cache.add("key", "other"))
+
+        self.assertTrue(cache.set("key", "small"))
+        self.assertEqual("small", cache.get("key"))
+        self.assertTrue(cache.set("key", big))
+        self.assertTrue(cache.delete("key"))
+        self.assertIsNone(cache.get("key"))
+        self.assertIsNone(overflow.get("key"))
+
+    def test_eviction(self):
+        cache = MmapCache(self.path, slots=4, slot_size=1024, max_probes=4)
+        for i in range(4):
+            cache.set("k%d" % i, i, timeout=100 + i)
+        cache.set("forever", "f", timeout=0)
+        self.assertIsNone(cache.get("k0"))
+        self.assertEqual([1, 2, 3, "f"], [cache.get(k) for k in ["k1", "k2", "k3", "forever"]])
+
+    def test_shared_between_processes(self):
+        cache = MmapCache(self.path, slots=16, slot_size=4096)
+        cache.set("from-parent", 1)
+        p = multiprocessing.Process(target=_set_in_child, args=(self.path,))
+        p.start()
+        p.join(10)
+        self.assertEqual(0, p.exitcode)
+        self.assertEqual({"pid": p.pid}, cache.get("from-child"))
+        self.assertIsNone(cache.get("from-parent"))
+
+
+class TestCreateCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_namespace(self):
+        for backend in ["filesystem", "mmap"]:
+            ec = SimpleNamespace(cache_backend=backend, cache_threshold=4, gunicorn_workers=1, cache_mmap_slot_kb=4,
+                                 werkzeug_fs_cache_dir=os.path.join(self.directory, backend),
+                                 cache_mmap_path=os.path.join(self.directory, backend, "cache.mmap"))
+            api, renders = create_cache(ec), create_cache(ec, "ignition", threshold=16)
+            api.set("sync-notify", 1)
+            for i in range(32):
+                renders.set("ignition-render:%d" % i, i)
+            self.assertEqual(1, api.get("sync-notify"))
+            self.assertIsNone(renders.get("sync-notify"))
+            self.assertEqual("%s-ignition" % backend, renders.backend)
+
+
+class TestMonitoredCache(unittest.TestCase):
+    def test_hit_miss(self):
+        cache = MonitoredCache(LRUCache(), "test-lru")
+
+        def count(result):
+            return REGISTRY.get_sample_value(
+                "enjoliver_cache_request_total", {"backend": "test-lru", "result": result}) or 0
+
+        cache.set("key", "value")
+        for i in range(3):
+            cache.get("key")
+        cache.get("missing")
+        self.assertEqual(3, count("hit"))
+        self.assertEqual(1, count("miss"))
+
+
+@bench
+class BenchCache(unittest.TestCase):
+    """
+    Compare the latency of cache.get, like /ignition with the sync-notify key
+    """
+    nb = 2000
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _bench(self, cache):
+        for i in range(100):
+            cache.set("key-%d" % i, {"ts": time.time(), "i": i})
+        cache.set("sync-notify", time.time())
+        start = time.perf_counter()
+        for i in range(self.nb):
+            self.assertIsNotNone(cache.get("sync-notify"))
+        return (time.perf_counter() - start) / self.nb
+
+    def test_bench_get(self):
+        backends = {
+            "filesystem": FileSystemCache(os.path.join(self.directory, "fs")),
+            "lru": LRUCache(),
+            "mmap": MmapCache(os.path.join(self.directory, "cache.mmap")),
+        }
+        if os.getenv("ENJOLIVER_TEST_REDIS_HOST"):
+            backends["redis"] = RedisCache(host=os.getenv("ENJOLIVER_TEST_REDIS_HOST"), key_prefix="enjoliver-test:")
+
+        latencies = {name: self._bench(cache) for name, cache in backends.items()}
+        self.assertLess(latencies["lru"], latencies["filesystem"])
+        self.assertLess(latencies["mmap"], latencies["filesystem"])
@@ -0,0 +1,71 @@
+import threading
+import time
+import unittest
+
+from werkzeug.contrib.cache import SimpleCache
+
+from enjoliver.cache import LRUCache
+from enjoliver.events import EventLog
+
+
+class TestEventLog(unittest.TestCase):
+    def test_publish(self):
+        events = EventLog(SimpleCache())
+        self.assertEqual(0, events.seq())
+        self.assertEqual([], events.since(0, 0))
+
+        self.assertEqual(1, events.publish("discovery", macs=["52:54:00:e8:32:5b"]))
+        self.assertEqual(2, events.publish("schedule", macs=["52:54:00:e8:32:5b"]))
+        self.assertEqual(2, events.seq())
+        self.assertEqual(["discovery", "schedule"], [k["kind"] for k in events.since(0, 2)])
+        self.assertEqual(["schedule"], [k["kind"] for k in events.since(1, 2)])
+
+    def test_workers(self):
+        cache = SimpleCache()
+        workers = [EventLog(cache), EventLog(cache)]
+        for i in range(4):
+            workers[i % 2].publish("discovery")
+        # a worker late to write the head
+        cache.set(EventLog.head_key, 1)
+        self.assertEqual(4, workers[1].seq())
+        self.assertEqual(5, workers[1].publish("schedule"))
+        self.assertEqual(5, len(workers[0].since(0, 5)))
+
+    def test_max_events(self):
+        events = EventLog(LRUCache(threshold=20), max_events=3)
+        for i in range(10):
+            events.publish("discovery", i=i)
+        self.assertEqual([7, 8, 9], [k["i"] for k in events.since(0, 10)])
+
+    def test_bounded_keys(self):
+        cache = SimpleCache()
+        events = EventLog(cache, max_events=3)
+        for i in range(10):
+            events.publish("discovery", i=i)
+        self.assertEqual(["event:10", "event:8", "event:9", EventLog.head_key], sorted(cache._cache))
+        self.assertEqual([7, 8, 9], [k["i"] for k in events.since(0, 10)])
+        self.assertEqual(10, events.seq())
+
+    def test_not_shared(self):
+        events = EventLog(SimpleCache(), shared=False)
+        self.assertEqual(0, events.publish("discovery"))
+        self.assertEqual(0, events.seq())
+
+    def test_evicted(self):
+        cache = SimpleCache()
+        events = EventLog(cache)
+        events.publish("discovery")
+        cache.clear()
+        # the consumer resyncs when the sequence moves backward
+        self.assertEqual(0, events.wait(1, 10))
+
+    def test_wait(self):
+        events = EventLog(SimpleCache(), poll_interval=0.01)
+        start = time.time()
+        self.assertEqual(0, events.wait(0, 0.1))
+        self.assertGreaterEqual(time.time() - start, 0.1)
+
+        threading.Timer(0.1, events.publish, args=("schedule",)).start()
+        start = time.time()
+        self.assertEqual(1, events.wait(0, 10))
+        self.assertLess(time.time() - start, 5)
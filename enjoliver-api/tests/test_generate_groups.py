@@ -1,10 +1,13 @@
 import os
+import time
 from shutil import rmtree
 from tempfile import mkdtemp
 from unittest import TestCase
 
 from enjoliver import generator
 
+from tests import bench
+
 
 class GenerateGroupTestCase(TestCase):
     api_uri = None
@@ -342,3 +345,59 @@ class TestGenerateGroupsExtraMetadata(GenerateGroupTestCase):
         new.api_uri = "http://google.com"
         self.assertTrue(new.dump())
         self.assertFalse(new.dump())
+
+    def test_992_dump_batch(self):
+        file_path = "%s/groups/etcd-batch.json" % self.test_matchbox_path
+        new = generator.GenerateGroup(
+            api_uri=self.api_uri,
+            _id="etcd-batch", name="etcd-test", profile="etcd-test.yaml",
+            matchbox_path=self.test_matchbox_path,
+            selector={"mac": "08:00:27:37:28:2e"}
+        )
+        writer = generator.BatchWriter(self.test_matchbox_path)
+        self.addCleanup(writer.close)
+        self.assertTrue(new.dump(writer))
+        self.assertFalse(writer.stage(file_path, new.render()))
+        self.assertFalse(os.path.isfile(file_path))
+        self.assertEqual(1, writer.commit())
+        self.assertTrue(os.path.isfile(file_path))
+        self.assertFalse(new.dump(writer))
+        self.assertEqual(0, writer.commit())
+
+        new.api_uri = "http://google.com"
+        self.assertTrue(new.dump(writer))
+        writer.close()
+        self.assertFalse(os.path.isdir(writer.staging_path))
+        self.assertTrue(new.dump())
+        os.remove(file_path)
+
+
+@bench
+class BenchDump(GenerateGroupTestCase):
+    """
+    Dump groups with large metadata, the second pass finds them all unchanged on disk
+    """
+    nb = 1000
+
+    def test_bench_dump(self):
+        groups = [generator.GenerateGroup(
+            api_uri=self.api_uri,
+            _id="bench-%d" % i, name="bench", profile="bench.yaml",
+            matchbox_path=self.test_matchbox_path,
+            selector={"mac": "08:00:27:%02x:%02x:%02x" % (i >> 16 & 255, i >> 8 & 255, i & 255)},
+            metadata={
+                "etc_hosts": ["10.0.%d.%d r%d-srv%d" % (k // 250, k % 250, k // 40, k % 40) for k in range(200)],
+                "kubernetes_etcd_member_client_uri_list": ",".join(
+                    "https://10.1.0.%d:2379" % k for k in range(5)),
+                "cni": {"ipam": {"routes": [{"dst": "0.0.0.0/0"}], "subnet": "10.0.0.0/8"}},
+            },
+        ) for i in range(self.nb)]
+
+        start = time.perf_counter()
+        self.assertEqual(self.nb, sum(g.dump() for g in groups))
+        written = time.perf_counter() - start
+        start = time.perf_counter()
+        self.assertEqual(0, sum(g.dump() for g in groups))
+        unchanged = time.perf_counter() - start
+        # the unchanged groups are only read
+        self.assertLess(unchanged, written)
@@ -1,5 +1,6 @@
 import os
-from unittest import TestCase
+import time
+from unittest import TestCase, mock
 
 from enjoliver.k8s_2t import Kubernetes2Tiers
 
@@ -26,6 +27,8 @@ class TestKubernetes2tiers(TestCase):
 
     def setUp(self):
         self.clean_sandbox()
+        # the groups and profiles written are test output, not fixtures
+        self.addCleanup(self.clean_sandbox)
 
     def test_00(self):
         Kubernetes2Tiers(
@@ -40,3 +43,35 @@ class TestKubernetes2tiers(TestCase):
             api_uri=self.api_uri,
             extra_selectors={}
         )
+
+    def test_close(self):
+        k2t = Kubernetes2Tiers(
+            ignition_dict={"discovery": "unit-testkubernetes2tiers-discovery"},
+            matchbox_path=self.test_matchbox_path,
+            api_uri=self.api_uri,
+            extra_selectors={}
+        )
+        k2t.close()
+        k2t.close()
+
+    def test_run_min_interval(self):
+        k2t = Kubernetes2Tiers(
+            ignition_dict={"discovery": "unit-testkubernetes2tiers-discovery"},
+            matchbox_path=self.test_matchbox_path,
+            api_uri=self.api_uri,
+            extra_selectors={}
+        )
+        self.addCleanup(k2t.close)
+        starts = []
+
+        def apply():
+            starts.append(time.time())
+            if len(starts) == 3:
+                raise StopIteration
+
+        # each long poll answers a change right away
+        with mock.patch.object(k2t, "wait_change", return_value=True), mock.patch.object(k2t, "apply", apply):
+            with self.assertRaises(StopIteration):
+                k2t.run(interval=300, poll=20, notify_interval=20, min_interval=0.2)
+        self.assertGreaterEqual(starts[1] - starts[0], 0.2)
+        self.assertGreaterEqual(starts[2] - starts[1], 0.2)
@@ -0,0 +1,191 @@
+import http.server
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import requests
+from prometheus_client import REGISTRY
+from werkzeug.contrib.cache import SimpleCache
+
+from enjoliver.generator import GenerateGroup
+from enjoliver.matchbox import MatchboxClient, IgnitionRenderCache, ignition_digest
+
+
+class MatchboxHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.peers.add(self.client_address)
+        self.server.requests.append(self.path)
+        if self.path == "/slow":
+            time.sleep(0.5)
+        status = 503 if "unavailable" in self.path else 200
+        body = b"matchbox"
+        try:
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except ConnectionError:
+            # the client timed out
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMatchboxClient(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), MatchboxHandler)
+        cls.server.daemon_threads = True
+        cls.uri = "http://127.0.0.1:%d" % cls.server.server_address[1]
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.peers = set()
+        self.server.requests = []
+
+    def test_keep_alive(self):
+        client = MatchboxClient()
+        for i in range(20):
+            r = client.get("%s/ipxe?mac=%d" % (self.uri, i), "/ipxe")
+            self.assertEqual(200, r.status_code)
+            self.assertEqual(b"matchbox", r.content)
+        self.assertEqual(20, len(self.server.requests))
+        self.assertEqual(1, len(self.server.peers))
+
+    def test_retries(self):
+        client = MatchboxClient(retries=2, backoff_factor=0)
+        r = client.get("%s/unavailable" % self.uri, "/ipxe")
+        self.assertEqual(503, r.status_code)
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_timeout(self):
+        client = MatchboxClient(read_timeout=0.1, retries=0)
+        with self.assertRaises(requests.RequestException):
+            client.get("%s/slow" % self.uri, "/ipxe")
+
+    def test_connection_error(self):
+        client = MatchboxClient(retries=1, backoff_factor=0)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            client.get("http://127.0.0.1:1/ipxe", "/ipxe")
+
+    def test_latency(self):
+        def count():
+            return REGISTRY.get_sample_value(
+                "enjoliver_matchbox_request_duration_seconds_count", {"route": "/test-latency"}) or 0
+
+        before = count()
+        client = MatchboxClient()
+        for i in range(3):
+            client.get("%s/metadata" % self.uri, "/test-latency")
+        self.assertEqual(before + 3, count())
+
+
+class TestIgnitionRenderCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), MatchboxHandler)
+        cls.server.daemon_threads = True
+        cls.uri = "http://127.0.0.1:%d" % cls.server.server_address[1]
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.peers = set()
+        self.server.requests = []
+        self.matchbox_path = tempfile.mkdtemp()
+        for d in ["groups", "profiles", "ignition"]:
+            os.makedirs(os.path.join(self.matchbox_path, d))
+        for name in ["discovery", "node"]:
+            self._write("profiles", name, {"id": name, "ignition_id": "%s.yaml" % name})
+            self._write("ignition", name, "---", ext="yaml")
+        self._write("groups", "discovery", {"id": "discovery", "profile": "discovery"})
+        self.render = IgnitionRenderCache(self.matchbox_path, SimpleCache(), MatchboxClient())
+
+    def tearDown(self):
+        shutil.rmtree(self.matchbox_path)
+
+    def _write(self, directory: str, name: str, content, ext="json"):
+        with open(os.path.join(self.matchbox_path, directory, "%s.%s" % (name, ext)), "w") as f:
+            f.write(content if ext != "json" else json.dumps(content))
+
+    def _group(self, mac: str):
+        return GenerateGroup(api_uri="http://127.0.0.1:5000", _id="node-%s" % mac.replace(":", ""), name="node",
+                             profile="node", selector={"mac": mac}, matchbox_path=self.matchbox_path)
+
+    def test_cached(self):
+        raw_query = "uuid=b7f5f93a-b029-475f-b3a4-479ba198cb8a&mac=52-54-00-e8-32-5b"
+        for i in range(5):
+            self.assertEqual((200, b"matchbox"), self.render.get(self.uri, raw_query, "/ignition"))
+        self.assertEqual(["/ignition?%s" % raw_query], self.server.requests)
+
+        self.render.get(self.uri, "uuid=a21a9123-302d-488d-976c-5d6ded84a32d&mac=52-54-00-a5-24-f5", "/ignition")
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_invalidated_by_dump(self):
+        raw_query = "uuid=b7f5f93a-b029-475f-b3a4-479ba198cb8a&mac=52-54-00-e8-32-5b"
+        discovery = self.render.key(raw_query)
+        other = self.render.key(raw_query.replace("5b", "5c"))
+        self.render.get(self.uri, raw_query, "/ignition")
+
+        group = self._group("52:54:00:e8:32:5b")
+        self.assertTrue(group.dump())
+        node = self.render.key(raw_query)
+        self.assertNotEqual(discovery, node)
+        self.assertEqual(other, self.render.key(raw_query.replace("5b", "5c")))
+
+        self.render.get(self.uri, raw_query, "/ignition")
+        self.render.get(self.uri, raw_query, "/ignition")
+        self.assertEqual(2, len(self.server.requests))
+
+        group.extra_metadata["k8s_apiserver_count"] = 3
+        self.assertTrue(group.dump())
+        self.assertNotEqual(node, self.render.key(raw_query))
+
+    def test_invalidated_by_ignition(self):
+        raw_query = "uuid=b7f5f93a-b029-475f-b3a4-479ba198cb8a&mac=52-54-00-e8-32-5b"
+        key = self.render.key(raw_query)
+        ignition = os.path.join(self.matchbox_path, "ignition", "discovery.yaml")
+        os.utime(ignition, ns=(0, os.stat(ignition).st_mtime_ns + 1))
+        self.assertNotEqual(key, self.render.key(raw_query))
+
+    def test_not_cached(self):
+        os.remove(os.path.join(self.matchbox_path, "groups", "discovery.json"))
+        self.assertIsNone(self.render.key("mac=52-54-00-e8-32-5b"))
+        for i in range(2):
+            self.render.get(self.uri, "mac=52-54-00-e8-32-5b", "/ignition")
+        self.assertEqual(2, len(self.server.requests))
+
+        self.render.ttl = 0
+        self._write("groups", "discovery", {"id": "discovery", "profile": "discovery"})
+        for i in range(2):
+            self.render.get(self.uri, "mac=52-54-00-e8-32-5b", "/ignition")
+        self.assertEqual(4, len(self.server.requests))
+
+    def test_unavailable(self):
+        for i in range(2):
+            status, _ = self.render.get(self.uri, "mac=52-54-00-e8-32-5b&unavailable", "/ignition")
+        self.assertEqual(503, status)
+
+    def test_digest(self):
+        # echo '{"b":[1,2],"a":"é/x","c":{"z":null,"y":true}}' | jq -cS . | sha256sum
+        self.assertEqual("2aecce3d4a77b0eef3bb92c9d3693ccafe631fd94e0381779dacf338f9780820",
+                         ignition_digest({"b": [1, 2], "a": "é/x", "c": {"z": None, "y": True}}))
+        with self.assertRaises(ValueError):
+            self.render.digest(self.uri, "mac=52-54-00-e8-32-5b", "/lifecycle/ignition")
@@ -7,7 +7,7 @@ from sqlalchemy.orm import sessionmaker
 
 from enjoliver import crud, ops
 from enjoliver.db import session_commit
-from enjoliver.model import Base, ScheduleRoles
+from enjoliver.model import Base, ScheduleRoles, LifecycleCoreosInstall, LifecycleIgnition
 from enjoliver.repositories.registry import RepositoryRegistry
 
 from tests.fixtures import posts
@@ -417,6 +417,30 @@ class ModelTestCase(unittest.TestCase):
         r = f.get_all_rolling_status()
         self.assertEqual(1, len(r))
 
+    def test_38(self):
+        rq = "uuid=%s&mac=%s&os=installed" % (posts.M04["boot-info"]["uuid"], posts.M04["boot-info"]["mac"])
+        for success in [False, True]:
+            with session_commit(sess_maker=self.sess_maker) as session:
+                i = crud.InjectLifecycle(session, request_raw_query=rq)
+                i.refresh_lifecycle_coreos_install(success)
+                i.refresh_lifecycle_ignition(True)
+
+        f = crud.FetchLifecycle(sess_maker=self.sess_maker)
+        self.assertTrue(f.get_coreos_install_status(posts.M04["boot-info"]["mac"]))
+        with session_commit(sess_maker=self.sess_maker) as session:
+            self.assertEqual(1, session.query(LifecycleCoreosInstall).filter(
+                LifecycleCoreosInstall.machine_id == i.machine_id).count())
+            lifecycle = session.query(LifecycleIgnition).filter(LifecycleIgnition.machine_id == i.machine_id).one()
+            self.assertIsNone(lifecycle.last_change_date)
+            self.assertIsNotNone(lifecycle.updated_date)
+
+        with session_commit(sess_maker=self.sess_maker) as session:
+            crud.InjectLifecycle(session, request_raw_query=rq).refresh_lifecycle_ignition(False)
+        with session_commit(sess_maker=self.sess_maker) as session:
+            lifecycle = session.query(LifecycleIgnition).filter(LifecycleIgnition.machine_id == i.machine_id).one()
+            self.assertFalse(lifecycle.up_to_date)
+            self.assertIsNotNone(lifecycle.last_change_date)
+
     def test_39(self):
         playbook = crud.BackupExport(sess_maker=self.sess_maker).get_playbook()
         self.assertEqual(10, len(playbook))
@@ -0,0 +1,52 @@
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Query, sessionmaker
+
+from enjoliver.db import session_commit
+from enjoliver.model import Base, LifecycleCoreosInstall, LifecycleIgnition, LifecycleRolling, Machine, \
+    MachineCurrentState, MachineInterface, Schedule, ScheduleRoles
+
+
+class TestModelExplain(unittest.TestCase):
+    """
+    The hot queries have to be served by an index: with enable_seqscan off, PostgreSQL still plans a sequential scan
+    only when there is no usable index
+    """
+    engine = None  # type: Engine
+
+    @classmethod
+    def setUpClass(cls):
+        db_uri = 'postgresql+psycopg2://localhost/enjoliver_testing'
+        cls.engine = create_engine(db_uri)
+        cls.sess_maker = sessionmaker(bind=cls.engine)
+        Base.metadata.drop_all(bind=cls.engine)
+        Base.metadata.create_all(bind=cls.engine)
+
+    def assertIndexScan(self, query: Query):
+        with session_commit(sess_maker=self.sess_maker) as session:
+            session.execute("SET LOCAL enable_seqscan = off")
+            statement = query.statement.compile(bind=self.engine, compile_kwargs={"literal_binds": True})
+            plan = "\n".join(k[0] for k in session.execute("EXPLAIN %s" % statement))
+        self.assertNotIn("Seq Scan", plan)
+
+    def test_machine_by_uuid(self):
+        self.assertIndexScan(Query(Machine).filter(Machine.uuid == "b7f5f93a-b029-475f-b3a4-479ba198cb8a"))
+
+    def test_interface_by_mac(self):
+        self.assertIndexScan(Query(MachineInterface).filter(MachineInterface.mac == "52:54:00:e8:32:5b"))
+
+    def test_boot_interface(self):
+        self.assertIndexScan(Query(MachineInterface)
+                             .filter(MachineInterface.machine_id == 1, MachineInterface.as_boot == True))
+
+    def test_schedule_by_role(self):
+        self.assertIndexScan(Query(Schedule.machine_id).filter(Schedule.role == ScheduleRoles.etcd_member))
+
+    def test_lifecycle_by_machine(self):
+        for model in [LifecycleCoreosInstall, LifecycleIgnition, LifecycleRolling]:
+            self.assertIndexScan(Query(model).filter(model.machine_id == 1))
+
+    def test_state_by_mac(self):
+        self.assertIndexScan(Query(MachineCurrentState).filter(MachineCurrentState.machine_mac == "52:54:00:e8:32:5b"))
@@ -0,0 +1,84 @@
+import time
+from unittest import TestCase, mock
+
+from enjoliver import schedulerv2
+
+from tests import bench
+
+
+def machine(i: int, chassis=None, fqdn=None, disks_size=0):
+    return {
+        "mac": "52:54:00:00:%02x:%02x" % (i // 256, i % 256),
+        "fqdn": fqdn,
+        "chassis": chassis,
+        "disks_size": disks_size,
+    }
+
+
+class TestPlacementPolicy(TestCase):
+    def test_get(self):
+        for name in ["mac", "spread-chassis", "spread-rack", "largest-disk"]:
+            self.assertEqual(name, schedulerv2.get_placement_policy(name).name)
+        with self.assertRaises(LookupError):
+            schedulerv2.get_placement_policy("random")
+
+    def test_mac(self):
+        candidates = [machine(i) for i in [4, 1, 3, 2]]
+        chosen = schedulerv2.get_placement_policy("mac").place(candidates, [], 2)
+        self.assertEqual([machine(1), machine(2)], chosen)
+
+    def test_spread_chassis(self):
+        # 4 machines behind the switch a, 2 behind b and one unknown
+        candidates = [machine(i, chassis="a") for i in range(4)] + \
+                     [machine(i, chassis="b") for i in range(4, 6)] + [machine(6)]
+        policy = schedulerv2.get_placement_policy("spread-chassis")
+        self.assertEqual([0, 4, 6], [int(k["mac"][-2:], 16) for k in policy.place(candidates, [], 3)])
+        self.assertEqual([0, 4, 6, 1, 5, 2], [int(k["mac"][-2:], 16) for k in policy.place(candidates, [], 6)])
+
+        # a member is already behind a
+        chosen = policy.place(candidates[1:], [candidates[0]], 2)
+        self.assertEqual([4, 6], [int(k["mac"][-2:], 16) for k in chosen])
+
+    def test_spread_rack(self):
+        candidates = [
+            machine(0, fqdn="r1-srv0.dc-1.foo.bar.cr"),
+            machine(1, fqdn="r1-srv1.dc-1.foo.bar.cr"),
+            machine(2, fqdn="r1-srv2.dc-2.foo.bar.cr"),
+            machine(3, fqdn="r2-srv0.dc-1.foo.bar.cr"),
+            machine(4, fqdn="node-4"),
+        ]
+        policy = schedulerv2.get_placement_policy("spread-rack")
+        self.assertEqual("dc-1/1", policy.domain(candidates[0]))
+        self.assertIsNone(policy.domain(candidates[4]))
+        self.assertIsNone(policy.domain(machine(5)))
+        self.assertEqual([0, 2, 3], sorted(int(k["mac"][-2:], 16) for k in policy.place(candidates, [], 3)))
+
+    def test_largest_disk(self):
+        candidates = [machine(i, disks_size=size) for i, size in enumerate([10, 30, 20, 30])]
+        chosen = schedulerv2.get_placement_policy("largest-disk").place(candidates, [], 3)
+        self.assertEqual([1, 3, 2], [int(k["mac"][-2:], 16) for k in chosen])
+
+    @bench
+    def test_bench_place(self):
+        nb = 20000
+        candidates = [machine(i, chassis="chassis-%d" % (i % 500), fqdn="r%d-srv%d.dc-1.foo.bar.cr" % (i % 500, i),
+                              disks_size=i % 7) for i in range(nb)]
+        for name in ["mac", "spread-chassis", "spread-rack", "largest-disk"]:
+            policy = schedulerv2.get_placement_policy(name)
+            start = time.perf_counter()
+            chosen = policy.place(candidates, candidates[:100], nb // 2)
+            elapsed = time.perf_counter() - start
+            self.assertEqual(nb // 2, len(chosen))
+            self.assertLess(elapsed, 2)
+
+
+class TestHttpSchedulerBackend(TestCase):
+    def test_allocate_refused(self):
+        answer = mock.Mock(status_code=503, content=b"database is locked")
+        sch = schedulerv2.EtcdMemberKubernetesControlPlane("http://127.0.0.1:1")
+        with mock.patch.object(schedulerv2.requests, "post", return_value=answer):
+            with self.assertRaisesRegex(ValueError, "answered 503: database is locked"):
+                sch.backend.allocate(sch.roles, 3)
+            with self.assertLogs(schedulerv2.logger, "ERROR") as logs:
+                self.assertFalse(sch._apply_budget())
+        self.assertIn("503: database is locked", logs.output[0])
@@ -1,9 +1,16 @@
 import json
 import os
+import shutil
+import tempfile
+import time
 from unittest import TestCase
 
+from werkzeug.contrib.cache import SimpleCache
+
 from enjoliver import sync
 
+from tests import bench
+
 
 class TestConfigSyncSchedules(TestCase):
     unit_path = "%s" % os.path.dirname(__file__)
@@ -167,3 +174,149 @@ class TestConfigSyncSchedules(TestCase):
             },
         ])
         self.assertEqual("S", r)
+
+    def test_07_incremental(self):
+        s, matchbox_path = sync_sandbox(self.api_uri, 3)
+        self.addCleanup(shutil.rmtree, matchbox_path)
+        machines = s._cache_query.get("/scheduler/kubernetes-node")
+
+        self.assertEqual(3, s.kubernetes_nodes())
+        self.assertEqual((3, 0), (s.rewritten, s.skipped))
+        self.assertEqual(3, s.kubernetes_nodes())
+        self.assertEqual((3, 3), (s.rewritten, s.skipped))
+
+        machines[1]["fqdn"] = "r1-srv1.dc-1.foo.bar.cr"
+        s._cache_query.set("/scheduler/kubernetes-node", machines)
+        os.remove(os.path.join(matchbox_path, "groups", "kubernetes_nodes-2.json"))
+        s.kubernetes_nodes()
+        self.assertEqual((5, 4), (s.rewritten, s.skipped))
+
+        s._cache_query.set("/scheduler/ip-list/etcd-member", ["172.20.0.10", "172.20.0.11"])
+        s.kubernetes_nodes()
+        self.assertEqual((8, 4), (s.rewritten, s.skipped))
+
+        with open(os.path.join(matchbox_path, "ssh_authorized_keys", "user"), "w") as f:
+            f.write("ssh-rsa AAAA user")
+        s._ssh_authorized_keys_version = None
+        s.kubernetes_nodes()
+        self.assertEqual((11, 4), (s.rewritten, s.skipped))
+        with open(os.path.join(matchbox_path, "groups", "kubernetes_nodes-0.json")) as f:
+            self.assertEqual(["ssh-rsa AAAA user"], json.load(f)["metadata"]["ssh_authorized_keys"])
+
+    def test_08_snapshot(self):
+        s, matchbox_path = sync_sandbox(self.api_uri, 20)
+        self.addCleanup(shutil.rmtree, matchbox_path)
+        s.ignition_dict["etcd_member_kubernetes_control_plane"] = "node"
+        s._cache_query.set("/scheduler/etcd-member&kubernetes-control-plane", [])
+        s.notify = lambda: None
+        queried = []
+        query_ip_list = s._query_ip_list
+
+        def count(role):
+            queried.append(role)
+            return query_ip_list(role)
+
+        s._query_ip_list = count
+        self.assertEqual(20, s.apply())
+        self.assertEqual(["etcd-member", "kubernetes-control-plane"], queried)
+        self.assertIsNone(s._snapshot)
+
+        s._cache_query.set("/scheduler/ip-list/etcd-member", ["172.20.0.11", "172.20.0.10"])
+        s.apply()
+        with open(os.path.join(matchbox_path, "groups", "kubernetes_nodes-19.json")) as f:
+            self.assertEqual("https://172.20.0.10:%d,https://172.20.0.11:%d" % (
+                (sync.EC.kubernetes_etcd_client_port,) * 2), json.load(f)["metadata"]["kubernetes_etcd_member_client_uri_list"])
+
+    def test_09_collect_garbage(self):
+        s, matchbox_path = sync_sandbox(self.api_uri, 5)
+        self.addCleanup(shutil.rmtree, matchbox_path)
+        s.ignition_dict["etcd_member_kubernetes_control_plane"] = "node"
+        s._cache_query.set("/scheduler/etcd-member&kubernetes-control-plane", [])
+        s.notify = lambda: None
+        groups_path = os.path.join(matchbox_path, "groups")
+        with open(os.path.join(groups_path, "etcd_member_kubernetes_control_plane-0.json"), "w") as f:
+            f.write("{}")
+
+        # the control plane is empty: its group is kept
+        self.assertEqual(5, s.apply())
+        self.assertEqual(["etcd_member_kubernetes_control_plane-0.json"] +
+                         ["kubernetes_nodes-%d.json" % i for i in range(5)], sorted(os.listdir(groups_path)))
+        self.assertEqual(["groups", "ignition", "profiles", "ssh_authorized_keys"], sorted(os.listdir(matchbox_path)))
+        os.remove(os.path.join(groups_path, "etcd_member_kubernetes_control_plane-0.json"))
+
+        nodes = s._cache_query.get("/scheduler/kubernetes-node")
+        s._cache_query.set("/scheduler/kubernetes-node", nodes[:3])
+        self.assertEqual(3, s.apply())
+        self.assertEqual(["kubernetes_nodes-%d.json" % i for i in range(3)], sorted(os.listdir(groups_path)))
+        self.assertEqual((0, 3), (s.rewritten, s.skipped))
+
+        s._cache_query.set("/scheduler/kubernetes-node", [])
+        self.assertEqual(0, s.apply())
+        self.assertEqual(["kubernetes_nodes-%d.json" % i for i in range(3)], sorted(os.listdir(groups_path)))
+
+
+def sync_sandbox(api_uri: str, nb: int):
+    """
+    A ConfigSyncSchedules of nb kubernetes nodes over a temporary matchbox directory, the API queries are cached
+    :return: tuple(ConfigSyncSchedules, matchbox path)
+    """
+    matchbox_path = tempfile.mkdtemp()
+    for d in ["groups", "profiles", "ignition", "ssh_authorized_keys"]:
+        os.makedirs(os.path.join(matchbox_path, d))
+    with open(os.path.join(matchbox_path, "ignition", "node.yaml"), "w") as f:
+        f.write("---")
+
+    s = sync.ConfigSyncSchedules(
+        api_uri=api_uri,
+        matchbox_path=matchbox_path,
+        ignition_dict={},
+        extra_selector_dict=None,
+    )
+    s.ignition_dict = {"kubernetes_nodes": "node"}
+    s._cache_query = SimpleCache(default_timeout=0)
+    for role in ["etcd-member", "kubernetes-control-plane", "kubernetes-node"]:
+        s._cache_query.set("/scheduler/ip-list/%s" % role, ["172.20.0.10"])
+    s._cache_query.set("/scheduler/kubernetes-node", [{
+        "mac": "52:54:%02x:%02x:%02x:%02x" % (i >> 24 & 255, i >> 16 & 255, i >> 8 & 255, i & 255),
+        "fqdn": "r%d-srv%d.dc-1.foo.bar.cr" % (i // 40, i % 40),
+        "ipv4": "10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255),
+        "cidrv4": "10.%d.%d.%d/8" % (i >> 16 & 255, i >> 8 & 255, i & 255),
+        "gateway": "10.0.0.1",
+        "disks": [{"path": "/dev/sda", "size-bytes": 21474836480}],
+    } for i in range(nb)])
+    return s, matchbox_path
+
+
+@bench
+class BenchSync(TestCase):
+    """
+    Sync synthetic machines against a temporary matchbox directory, sequentially and with sync_workers
+    """
+    nb = 5000
+    api_uri = "http://127.0.0.1:5000"
+
+    def _bench(self, workers: int):
+        s, matchbox_path = sync_sandbox(self.api_uri, self.nb)
+        self.addCleanup(shutil.rmtree, matchbox_path)
+        self.addCleanup(s.close)
+        sync_workers = sync.EC.sync_workers
+        sync.EC.sync_workers = workers
+        try:
+            start = time.perf_counter()
+            self.assertEqual(self.nb, s.kubernetes_nodes())
+            elapsed = time.perf_counter() - start
+        finally:
+            sync.EC.sync_workers = sync_workers
+
+        self.assertEqual((self.nb, 0), (s.rewritten, s.skipped))
+        groups = dict()
+        for name in os.listdir(os.path.join(matchbox_path, "groups")):
+            with open(os.path.join(matchbox_path, "groups", name)) as f:
+                groups[name] = f.read()
+        return elapsed, groups
+
+    def test_bench_sync(self):
+        _, expected = self._bench(0)
+        _, groups = self._bench(4)
+        self.assertEqual(self.nb, len(groups))
+        self.assertEqual(expected, groups)
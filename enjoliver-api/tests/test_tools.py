@@ -1,4 +1,7 @@
 import os
+import socket
+import threading
+import time
 from unittest import TestCase
 
 from enjoliver import tools
@@ -20,3 +23,72 @@ class TestTools(TestCase):
                 "1.host.enjoliver.local"
             ]
         }))
+
+
+class TestReverseDNSResolver(TestCase):
+    def setUp(self):
+        self.calls = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def lookup(self, ipv4: str):
+        self.calls.append(ipv4)
+        self.release.wait(5)
+        if ipv4.startswith("10."):
+            raise socket.herror(1, "Unknown host")
+        return "%s.host.enjoliver.local" % ipv4.split(".")[-1], [], [ipv4]
+
+    def test_cache(self):
+        resolver = tools.ReverseDNSResolver(lookup=self.lookup)
+        for i in range(3):
+            self.assertEqual({"172.20.0.65": "65.host.enjoliver.local", "10.0.0.1": None},
+                             resolver.resolve_many(["172.20.0.65", "10.0.0.1", "172.20.0.65"], 1))
+        self.assertEqual(["10.0.0.1", "172.20.0.65"], sorted(self.calls))
+
+    def test_ttl(self):
+        resolver = tools.ReverseDNSResolver(lookup=self.lookup, ttl=60, negative_ttl=0)
+        for i in range(3):
+            resolver.resolve_many(["172.20.0.65", "10.0.0.1"], 1)
+        self.assertEqual(1, self.calls.count("172.20.0.65"))
+        self.assertEqual(3, self.calls.count("10.0.0.1"))
+
+    def test_lru(self):
+        resolver = tools.ReverseDNSResolver(lookup=self.lookup, max_size=2)
+        for ipv4 in ["172.20.0.1", "172.20.0.2", "172.20.0.1", "172.20.0.3", "172.20.0.1", "172.20.0.2"]:
+            resolver.resolve_many([ipv4], 1)
+        self.assertEqual(["172.20.0.1", "172.20.0.2", "172.20.0.3", "172.20.0.2"], self.calls)
+
+    def test_deadline(self):
+        resolver = tools.ReverseDNSResolver(lookup=self.lookup)
+        self.release.clear()
+        start = time.time()
+        self.assertEqual({}, resolver.resolve_many(["172.20.0.65", "172.20.0.66"], 0.1))
+        self.assertLess(time.time() - start, 1)
+
+        self.release.set()
+        resolver.submit("172.20.0.65").result(1)
+        resolver.submit("172.20.0.66").result(1)
+        self.assertEqual({"172.20.0.65": "65.host.enjoliver.local"}, resolver.resolve_many(["172.20.0.65"], 0))
+        self.assertEqual(2, len(self.calls))
+
+    def test_verified_dns_queries(self):
+        resolver = tools.ReverseDNSResolver(lookup=self.lookup)
+        interfaces = [
+            {"mac": "52:54:00:e8:32:5b", "ipv4": "172.20.0.65", "fqdn": ["65.host.enjoliver.local."]},
+            {"mac": "52:54:00:e8:32:5c", "ipv4": "172.20.0.66", "fqdn": ["other.host.enjoliver.local"]},
+            {"mac": "52:54:00:e8:32:5d", "ipv4": "10.0.0.1", "fqdn": ["1.host.enjoliver.local"]},
+            {"mac": "52:54:00:e8:32:5e", "ipv4": "172.20.0.67"},
+        ]
+        self.assertEqual({
+            "52:54:00:e8:32:5b": "65.host.enjoliver.local",
+            "52:54:00:e8:32:5c": None,
+            "52:54:00:e8:32:5d": None,
+            "52:54:00:e8:32:5e": None,
+        }, tools.get_verified_dns_queries(interfaces, resolver=resolver, deadline=1))
+        self.assertNotIn("172.20.0.67", self.calls)
+
+        self.release.clear()
+        slow = tools.ReverseDNSResolver(lookup=self.lookup)
+        self.assertEqual({"52:54:00:e8:32:5e": None},
+                         tools.get_verified_dns_queries(interfaces, resolver=slow, deadline=0.1))
+        self.release.set()
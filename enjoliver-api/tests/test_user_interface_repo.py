@@ -1,4 +1,6 @@
+import time
 import unittest
+from types import SimpleNamespace
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
@@ -17,6 +19,8 @@ from enjoliver.model import (
 )
 from enjoliver.repositories import user_interface
 
+from tests import bench
+
 
 class TestMachineStateRepo(unittest.TestCase):
     engine = None
@@ -235,3 +239,27 @@ class TestMachineStateRepo(unittest.TestCase):
         ui = user_interface.UserInterfaceRepository(sess_maker=self.sess_maker)
         data = ui.get_machines_overview()
         self.assertCountEqual(expect, data)
+
+    @bench
+    def test_bench_build_overview_10k(self):
+        nb = 10000
+        machines = [SimpleNamespace(id=i) for i in range(nb)]
+        mis = [SimpleNamespace(machine_id=i, mac="00:00:00:00:%02x:%02x" % (i // 256, i % 256), fqdn=None,
+                               cidrv4="10.0.0.1/8") for i in range(nb)]
+        mds = [SimpleNamespace(machine_id=i, path="/dev/sda", size=1024 * 1024 * 1024) for i in range(nb)]
+        mss = [SimpleNamespace(machine_mac=mi.mac, state_name=MachineStates.discovery) for mi in mis]
+        lis = [SimpleNamespace(machine_id=i, updated_date=None, up_to_date=True, last_change_date=None)
+               for i in range(nb)]
+        lrs = [SimpleNamespace(machine_id=i, strategy="kexec", enable=True) for i in range(nb)]
+        srs = [SimpleNamespace(machine_id=i, role=ScheduleRoles.kubernetes_node) for i in range(nb)]
+
+        start = time.time()
+        data = user_interface.UserInterfaceRepository._build_overview(machines, mis, mds, mss, lis, lrs, srs)
+        duration = time.time() - start
+
+        self.assertEqual(nb, len(data))
+        self.assertEqual(mis[-1].mac, data[-1]["MAC"])
+        self.assertEqual(MachineStates.discovery, data[-1]["LastState"])
+        self.assertEqual("kexec", data[-1]["UpdateStrategy"])
+        # a quadratic join takes minutes here
+        self.assertLess(duration, 5)
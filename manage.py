@@ -5,11 +5,10 @@ import signal
 import sys
 
 import click
-from sqlalchemy import create_engine
 
 try:
-    from enjoliver import configs, gunicorn_conf
-    from enjoliver.model import Base
+    from alembic import command
+    from enjoliver import configs, gunicorn_conf, migrations
 except ModuleNotFoundError:
     click.echo('please install enjoliver first: cd enjoliver-api && pip install -e .')
     sys.exit(255)
@@ -29,9 +28,8 @@ def _fs_gunicorn_cleaning(ec):
 
 
 def _init_db(ec):
-    click.echo("initializing db")
-    engine = create_engine(ec.db_uri)
-    Base.metadata.create_all(bind=engine)
+    click.echo("migrating db")
+    migrations.upgrade(ec.db_uri)
 
 
 def _init_journal_dir(ec):
@@ -128,6 +126,20 @@ def validate():
     os.execvpe(cmd[0], cmd, os.environ)
 
 
+@manage.command()
+@click.argument('revision', default='head')
+def migrate(revision):
+    ec = configs.EnjoliverConfig(importer=__file__)
+    migrations.upgrade(ec.db_uri, revision)
+
+
+@manage.command('make-migration')
+@click.argument('message')
+def make_migration(message):
+    ec = configs.EnjoliverConfig(importer=__file__)
+    command.revision(migrations.alembic_config(ec.db_uri), message=message, autogenerate=True)
+
+
 @manage.command('show-configs')
 def show_configs():
     ec = configs.EnjoliverConfig(importer=__file__)